@@ -0,0 +1,346 @@
+"""Benchmarks for the upload -> aggregate -> download pipeline.
+
+Generates a synthetic sales CSV, times the aggregation stages on their own and
+then whole requests through the gateway and an in-process gRPC server. Celery
+runs eagerly with in-memory broker and result backend, so no Redis or worker
+is needed. Results are written as JSON so runs can be compared across commits:
+
+    python benchmark.py --rows 1000000 --output after.json
+    python benchmark.py --compare before.json after.json
+"""
+
+import argparse
+import asyncio
+import gzip
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from typing import Callable, Dict, List, Optional
+
+# Configure Celery and the results directory before the pipeline modules read
+# their settings at import time
+os.environ["CELERY_BROKER_URL"] = "memory://"
+os.environ["CELERY_RESULT_BACKEND"] = "cache+memory://"
+os.environ.setdefault("RESULTS_DIR", tempfile.mkdtemp(prefix="csv-benchmark-"))
+# Every repetition must do the work rather than hit the result cache
+os.environ["RESULT_CACHE_MAX_BYTES"] = "0"
+
+import grpc
+import httpx
+
+import csv_processor_pb2_grpc
+import gateway
+from celery_app import (
+    ENGINES,
+    aggregate_reader,
+    aggregate_sales,
+    celery_app,
+    create_csv_from_aggregated,
+    open_sales_reader,
+    pyarrow,
+    read_csv_rows,
+)
+from csv_processor_service import CsvProcessorService
+
+celery_app.conf.update(task_always_eager=True, task_store_eager_result=True)
+
+DIRTY_VALUES = ("", "n/a", "12.5", "-", "1e3")
+
+
+def generate_sales_csv(
+    path: str,
+    rows: int,
+    departments: int = 50,
+    dirty_rate: float = 0.0,
+    seed: int = 0,
+) -> int:
+    """Write ``rows`` random sales records to ``path`` and return its size.
+
+    A ``dirty_rate`` fraction of the records is malformed the way real exports
+    are: truncated rows and non-integer sale counts, which the aggregators
+    skip.
+    """
+    rng = random.Random(seed)
+    names = [f"Department {i:04d}" for i in range(departments)]
+    first_day = date(2023, 1, 1)
+    with open(path, "w", newline="") as f:
+        f.write("Department Name,Date,Number of Sales\n")
+        lines = []
+        for _ in range(rows):
+            dept = rng.choice(names)
+            day = first_day + timedelta(days=rng.randrange(365))
+            if dirty_rate and rng.random() < dirty_rate:
+                if rng.random() < 0.5:
+                    lines.append(f"{dept},{day}\n")
+                else:
+                    lines.append(f"{dept},{day},{rng.choice(DIRTY_VALUES)}\n")
+            else:
+                lines.append(f"{dept},{day},{rng.randrange(1000)}\n")
+            if len(lines) >= 10000:
+                f.writelines(lines)
+                lines.clear()
+        f.writelines(lines)
+    return os.path.getsize(path)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of ``values`` for ``q`` in [0, 100]."""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def summarize(durations: List[float], rows: int, size: int) -> dict:
+    """Latency percentiles and the throughput of the median run."""
+    p50 = percentile(durations, 50)
+    return {
+        "runs": len(durations),
+        "seconds": {
+            "p50": p50,
+            "p99": percentile(durations, 99),
+            "mean": sum(durations) / len(durations),
+        },
+        "rows_per_second": rows / p50 if p50 else 0.0,
+        "mb_per_second": size / (1024 * 1024) / p50 if p50 else 0.0,
+        # High-water mark of the whole process up to and including this stage
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def time_runs(func: Callable[[], object], repeat: int) -> List[float]:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def bench_stages(path: str, rows: int, size: int, repeat: int) -> Dict[str, dict]:
+    stages = {}
+    stages["read_csv_rows"] = summarize(
+        time_runs(lambda: sum(1 for _ in read_csv_rows(path)), repeat), rows, size
+    )
+    # Aggregate already parsed rows so this stage excludes reading
+    parsed = list(read_csv_rows(path))
+    stages["aggregate_sales"] = summarize(
+        time_runs(lambda: aggregate_sales(parsed), repeat), rows, size
+    )
+    sales = aggregate_sales(parsed)
+    del parsed
+    stages["create_csv_from_aggregated"] = summarize(
+        time_runs(lambda: create_csv_from_aggregated(sales, io.StringIO()), repeat),
+        len(sales),
+        0,
+    )
+    for engine in ENGINES:
+        if engine == "arrow" and pyarrow is None:
+            continue
+        stages[f"aggregate_file[{engine}]"] = summarize(
+            time_runs(
+                lambda: aggregate_reader(open_sales_reader(path, engine=engine)),
+                repeat,
+            ),
+            rows,
+            size,
+        )
+    return stages
+
+
+async def bench_end_to_end(
+    path: str,
+    rows: int,
+    size: int,
+    requests: int,
+    concurrency: int,
+    params: dict,
+    upload_compression: Optional[str] = None,
+) -> dict:
+    """Upload, wait for and download ``requests`` results through the gateway."""
+    server = grpc.aio.server()
+    csv_processor_pb2_grpc.add_CsvProcessorServicer_to_server(
+        CsvProcessorService(), server
+    )
+    port = server.add_insecure_port("127.0.0.1:0")
+    await server.start()
+    gateway.grpc_host, gateway.grpc_port = "127.0.0.1", str(port)
+    with open(path, "rb") as f:
+        data = f.read()
+    if upload_compression == "gzip":
+        data = gzip.compress(data, compresslevel=6)
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=gateway.app)
+
+    async def pipeline(client: httpx.AsyncClient) -> float:
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(
+                "/upload", files={"file": ("bench.csv", data)}, params=params
+            )
+            response.raise_for_status()
+            task_id = response.json()["task_id"]
+            while not (await client.get(f"/status/{task_id}")).json()["completed"]:
+                await asyncio.sleep(0.01)
+            download = await client.get(f"/download/{task_id}")
+            download.raise_for_status()
+            return time.perf_counter() - start
+
+    try:
+        async with gateway.lifespan(gateway.app):
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://benchmark", timeout=None
+            ) as client:
+                started = time.perf_counter()
+                durations = await asyncio.gather(
+                    *(pipeline(client) for _ in range(requests))
+                )
+                wall_time = time.perf_counter() - started
+    finally:
+        await server.stop(None)
+    result = summarize(list(durations), rows, size)
+    result.update(
+        concurrency=concurrency,
+        params=params,
+        upload_compression=upload_compression,
+        upload_bytes=len(data),
+        # Aggregate throughput with all requests in flight
+        total_rows_per_second=rows * requests / wall_time,
+        total_mb_per_second=size * requests / (1024 * 1024) / wall_time,
+    )
+    return result
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    with tempfile.TemporaryDirectory(prefix="csv-benchmark-") as tmp:
+        path = os.path.join(tmp, "sales.csv")
+        size = generate_sales_csv(
+            path, args.rows, args.departments, args.dirty_rate, args.seed
+        )
+        report = {
+            "commit": current_commit(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "dataset": {
+                "rows": args.rows,
+                "bytes": size,
+                "departments": args.departments,
+                "dirty_rate": args.dirty_rate,
+                "seed": args.seed,
+            },
+            "stages": bench_stages(path, args.rows, size, args.repeat),
+        }
+        params = {"engine": args.engine}
+        if args.chunks:
+            params["chunks"] = args.chunks
+        if args.streaming:
+            params["streaming"] = "true"
+        report["end_to_end"] = asyncio.run(
+            bench_end_to_end(
+                path,
+                args.rows,
+                size,
+                args.requests,
+                args.concurrency,
+                params,
+                args.upload_compression,
+            )
+        )
+    return report
+
+
+def compare(before: dict, after: dict, max_regression: float) -> int:
+    """Print throughput changes between two reports; 1 if any regressed."""
+    sections = dict(before["stages"], end_to_end=before["end_to_end"])
+    current = dict(after["stages"], end_to_end=after["end_to_end"])
+    regressed = False
+    print(f"{'stage':36} {'rows/s before':>14} {'rows/s after':>14} {'change':>8}")
+    for name, old in sections.items():
+        new = current.get(name)
+        if new is None or not old["rows_per_second"]:
+            continue
+        change = new["rows_per_second"] / old["rows_per_second"] - 1
+        flag = ""
+        if change < -max_regression:
+            regressed = True
+            flag = "  REGRESSION"
+        print(
+            f"{name:36} {old['rows_per_second']:14.0f}"
+            f" {new['rows_per_second']:14.0f} {change:+8.1%}{flag}"
+        )
+    return 1 if regressed else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--departments", type=int, default=50)
+    parser.add_argument("--dirty-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per stage")
+    parser.add_argument("--requests", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--engine", choices=ENGINES, default="python")
+    parser.add_argument("--chunks", type=int, help="parallel ranges per upload")
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument(
+        "--upload-compression", choices=["gzip"], help="compress uploads first"
+    )
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BEFORE", "AFTER"),
+        help="compare two reports instead of running",
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.1,
+        help="throughput drop that fails --compare",
+    )
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        reports = []
+        for report_path in args.compare:
+            with open(report_path) as f:
+                reports.append(json.load(f))
+        return compare(*reports, args.max_regression)
+
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,151 @@
+import array
+import base64
+import bisect
+import contextlib
+import cProfile
 import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import mmap
+import operator
 import os
+import pstats
+import shutil
+import struct
+import sys
+import tempfile
+import threading
 import time
 import typing
-from collections import defaultdict
-from typing import Callable, Dict, Generator, List
+import uuid
+import zlib
+from collections import OrderedDict, defaultdict
+from datetime import date, timedelta
+from typing import Callable, Dict, Generator, Iterable, List, Optional, Tuple
 
-from celery import Celery
+from celery import Celery, chord
+from celery.backends.redis import RedisBackend
+from celery.exceptions import Ignore
+from celery.result import AsyncResult
+from celery.signals import (
+    after_task_publish,
+    task_postrun,
+    task_prerun,
+    task_revoked,
+    worker_init,
+    worker_process_shutdown,
+)
+from kombu import Queue
+from kombu.exceptions import OperationalError
+
+import telemetry
+from scheduling import Scheduler
+
+try:
+    import pyarrow
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.ipc
+except ImportError:  # The columnar engine is optional
+    pyarrow = None
+
+try:
+    import zstandard
+except ImportError:  # zstd-compressed uploads are optional
+    zstandard = None
 
 RESULTS_DIR = os.getenv("RESULTS_DIR", "results")
 if not os.path.isabs(RESULTS_DIR):
     RESULTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), RESULTS_DIR))
 os.makedirs(RESULTS_DIR, exist_ok=True)
 
+# Bytes read from disk per parser block; each block ends on a record boundary.
+READ_BLOCK_SIZE = int(os.getenv("READ_BLOCK_SIZE", 4 * 1024 * 1024))
+# A quoted field left open for this many bytes is taken to be malformed, and
+# records are cut at the last newline instead of waiting for it to close
+MAX_RECORD_BYTES = int(os.getenv("MAX_RECORD_BYTES", 64 * 1024 * 1024))
+# Uploads larger than this are split into record-aligned ranges of roughly this
+# size and aggregated by parallel subtasks.
+PARALLEL_CHUNK_BYTES = int(os.getenv("PARALLEL_CHUNK_BYTES", 256 * 1024 * 1024))
+PARALLEL_MAX_CHUNKS = int(os.getenv("PARALLEL_MAX_CHUNKS", 32))
+# Progress is written to the result backend at most this many times per second
+# per task (0 for no cap), and only when another PROGRESS_PERCENT_STEP percent
+# of the input has been consumed or PROGRESS_HEARTBEAT_SECONDS have passed.
+PROGRESS_MAX_UPDATES_PER_SECOND = float(os.getenv("PROGRESS_MAX_UPDATES_PER_SECOND", 2))
+PROGRESS_PERCENT_STEP = float(os.getenv("PROGRESS_PERCENT_STEP", 1))
+PROGRESS_HEARTBEAT_SECONDS = float(os.getenv("PROGRESS_HEARTBEAT_SECONDS", 5))
+# A running task checks whether it was cancelled this often, whether or not
+# its progress is due to be written.
+CANCEL_CHECK_SECONDS = float(os.getenv("CANCEL_CHECK_SECONDS", 1))
+# Bytes per record batch for the columnar ("arrow") engine.
+COLUMNAR_BLOCK_SIZE = int(os.getenv("COLUMNAR_BLOCK_SIZE", 16 * 1024 * 1024))
+ENGINES = ("python", "arrow")
+# Groups of an aggregation estimated to take more than this many bytes are
+# spilled to sorted, hash-partitioned files under SPILL_DIR and merged at the
+# end, so workers stay within their memory limit; 0 never spills.
+AGGREGATION_MEMORY_BUDGET = int(
+    os.getenv("AGGREGATION_MEMORY_BUDGET", 1024 * 1024 * 1024)
+)
+SPILL_PARTITIONS = int(os.getenv("SPILL_PARTITIONS", 16))
+# Spill files the final merge reads at once; partitions are compacted first
+# when there are more runs than this.
+SPILL_MAX_OPEN_RUNS = int(os.getenv("SPILL_MAX_OPEN_RUNS", 256))
+SPILL_DIR = os.path.join(RESULTS_DIR, "spill")
+# Sketched uploads publish the top SKETCH_TOP departments and a distinct
+# department count while they run. The top-K summary keeps SKETCH_COUNTERS
+# counters, so its estimates are at most 1 / (SKETCH_COUNTERS + 1) of the
+# sales seen too low; the count uses 2 ** SKETCH_HLL_PRECISION HyperLogLog
+# registers, for a standard error of 1.04 / sqrt(2 ** SKETCH_HLL_PRECISION).
+SKETCH_COUNTERS = int(os.getenv("SKETCH_COUNTERS", 256))
+SKETCH_TOP = int(os.getenv("SKETCH_TOP", 20))
+SKETCH_HLL_PRECISION = int(os.getenv("SKETCH_HLL_PRECISION", 12))
+# Distinct date strings whose parsed form is kept while bucketing sales by day.
+DATE_CACHE_SIZE = int(os.getenv("DATE_CACHE_SIZE", 100_000))
+# Aggregate stores the gRPC server keeps mapped for reuse, least recently
+# used closed first.
+AGGREGATE_STORE_MAX_OPEN = int(os.getenv("AGGREGATE_STORE_MAX_OPEN", 256))
+# Results of identical uploads are cached by content digest. Entries unused for
+# RESULT_CACHE_TTL_SECONDS are dropped, then the least recently used ones until
+# the cache fits in RESULT_CACHE_MAX_BYTES; 0 disables the cache.
+RESULT_CACHE_DIR = os.path.join(RESULTS_DIR, "cache")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+# A serial pass saves its position and partial totals under CHECKPOINT_DIR
+# once another CHECKPOINT_BYTES of the upload have been read or
+# CHECKPOINT_SECONDS have passed (0 turns either off), so a task redelivered
+# after its worker died resumes from there.
+CHECKPOINT_DIR = os.path.join(RESULTS_DIR, "checkpoints")
+CHECKPOINT_BYTES = int(os.getenv("CHECKPOINT_BYTES", 256 * 1024 * 1024))
+CHECKPOINT_SECONDS = float(os.getenv("CHECKPOINT_SECONDS", 300))
+# Seconds the Redis broker waits for an unacknowledged task before handing it
+# to another worker. Tasks are acknowledged once they finish, so this must be
+# longer than the longest task.
+BROKER_VISIBILITY_TIMEOUT = int(os.getenv("BROKER_VISIBILITY_TIMEOUT", 12 * 3600))
+
+# Port a Celery worker serves its Prometheus metrics on; 0 serves none. Prefork
+# workers need PROMETHEUS_MULTIPROC_DIR to report their child processes.
+CELERY_METRICS_PORT = int(os.getenv("CELERY_METRICS_PORT", 0))
+# Functions listed by the text rendering of a task's profile
+PROFILE_TOP_FUNCTIONS = int(os.getenv("PROFILE_TOP_FUNCTIONS", 40))
+
+# Uploads of up to FAST_QUEUE_MAX_BYTES go to the fast queue and larger ones to
+# the bulk queue, so small uploads never wait behind large ones
+FAST_QUEUE = os.getenv("FAST_QUEUE", "csv_fast")
+BULK_QUEUE = os.getenv("BULK_QUEUE", "csv_bulk")
+FAST_QUEUE_MAX_BYTES = int(os.getenv("FAST_QUEUE_MAX_BYTES", 64 * 1024 * 1024))
+# Jobs a tenant may run at once, 0 for no cap. A job over the cap goes back to
+# the end of its queue and tries again after TENANT_RETRY_SECONDS.
+TENANT_MAX_RUNNING = int(os.getenv("TENANT_MAX_RUNNING", 0))
+TENANT_RETRY_SECONDS = float(os.getenv("TENANT_RETRY_SECONDS", 5))
+# How long queue positions and tenant slots of lost tasks are kept
+SCHEDULER_ENTRY_TTL_SECONDS = float(os.getenv("SCHEDULER_ENTRY_TTL_SECONDS", 6 * 3600))
+
 celery_app = Celery(
     "csv_processor",
     broker=os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"),
@@ -24,26 +158,300 @@ celery_app.conf.update(
     result_serializer="json",
     timezone="UTC",
     enable_utc=True,
+    # Workers consume both queues unless started with -Q
+    task_queues=(Queue(FAST_QUEUE), Queue(BULK_QUEUE)),
+    task_default_queue=FAST_QUEUE,
+    # A task whose worker dies before it finishes is delivered again, and
+    # resumes from its last checkpoint
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    broker_transport_options={"visibility_timeout": BROKER_VISIBILITY_TIMEOUT},
 )
 
 
-def read_csv_rows(file_path: str) -> Generator[List[str], None, None]:
-    with open(file_path, "r", newline="") as f:
-        reader = csv.reader(f)
-        try:
-            _ = next(reader)  # Skip header
-            for row in reader:
-                yield row
-        except StopIteration:
-            pass
+class RecordSplitter:
+    """Cut CSV bytes handed over piece by piece on record boundaries.
+
+    A newline ends a record unless it is inside a quoted field. As with
+    ``csv.reader``, a quote only opens a quoted field at the start of a field,
+    so a stray quote such as ``12" TVs`` is part of the value, and a doubled
+    quote inside a quoted field stands for a quote. Whether the bytes seen so
+    far end inside a quoted field carries from one piece to the next, so each
+    byte is scanned once however many pieces a record spans.
+
+    The stream must start on a record boundary. A quoted field still open
+    after ``max_record_bytes`` is taken to be malformed and the records are
+    cut at the last newline instead.
+    """
+
+    def __init__(self, max_record_bytes: int = MAX_RECORD_BYTES):
+        self.max_record_bytes = max_record_bytes
+        # Bytes after the last whole record, and how many of them are scanned
+        self.pending = b""
+        self._scanned = 0
+        self._in_quotes = False
+        self._field_start = True
+
+    def feed(self, data: bytes) -> bytes:
+        """Add ``data``; return the records it completes, whole."""
+        data = self.pending + data if self.pending else data
+        end = self._scan(data)
+        if not end and len(data) > self.max_record_bytes:
+            end = data.rfind(b"\n") + 1
+            if end:
+                self._scanned, self._in_quotes, self._field_start = end, False, True
+        self.pending = data[end:]
+        self._scanned -= end
+        return data[:end]
+
+    def _scan(self, data: bytes) -> int:
+        """Scan ``data`` on from ``_scanned``; return the end of its last record."""
+        pos, size, end = self._scanned, len(data), 0
+        in_quotes, field_start = self._in_quotes, self._field_start
+        while pos < size:
+            quote = data.find(b'"', pos)
+            if in_quotes:
+                if quote < 0:
+                    pos = size
+                elif quote + 1 == size:
+                    break  # A doubled quote may follow in the next piece
+                elif data[quote + 1] == 0x22:
+                    pos = quote + 2
+                else:
+                    in_quotes = False
+                    pos = quote + 1
+                continue
+            stop = size if quote < 0 else quote
+            newline = data.rfind(b"\n", pos, stop)
+            if newline >= 0:
+                end = newline + 1
+            if stop > pos:
+                field_start = data[stop - 1] in b",\r\n"
+            if quote >= 0:
+                in_quotes = field_start
+                field_start = False
+                stop += 1
+            pos = stop
+        self._scanned, self._in_quotes, self._field_start = pos, in_quotes, field_start
+        return end
+
+
+def split_line_ranges(file_path: str, chunks: int) -> List[Tuple[int, int]]:
+    """Split a file into at most ``chunks`` byte ranges starting on record boundaries.
+
+    Each boundary is the start of the record holding an even split point, so
+    no range starts inside a quoted field, newlines and all. Telling where
+    records start takes one pass over the file with a :class:`RecordSplitter`.
+    """
+    size = os.path.getsize(file_path)
+    targets = sorted({size * i // chunks for i in range(1, chunks)} - {0})
+    boundaries = [0]
+    splitter = RecordSplitter()
+    offset = 0
+    with open(file_path, "rb") as f:
+        for target in targets:
+            while offset < target:
+                data = f.read(min(READ_BLOCK_SIZE, target - offset))
+                if not data:
+                    break
+                offset += len(data)
+                splitter.feed(data)
+            boundary = offset - len(splitter.pending)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    boundaries.append(size)
+    return [
+        (start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start
+    ]
+
+
+# Uploads are recognised as compressed by their leading magic bytes.
+COMPRESSION_MAGIC = {"gzip": b"\x1f\x8b", "zstd": b"\x28\xb5\x2f\xfd"}
+
+
+def sniff_compression(head: bytes) -> Optional[str]:
+    """Return ``"gzip"`` or ``"zstd"`` if ``head`` starts that format, else None."""
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def file_compression(file_path: str) -> Optional[str]:
+    with open(file_path, "rb") as f:
+        return sniff_compression(f.read(4))
+
+
+def compression_supported(compression: Optional[str]) -> bool:
+    return compression != "zstd" or zstandard is not None
+
+
+def open_decompressed(f: typing.BinaryIO, compression: Optional[str]):
+    """Wrap the binary file ``f`` so reads return decompressed bytes."""
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f)
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd uploads require zstandard to be installed")
+        return zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+    return f
+
+
+def open_compressed(f: typing.BinaryIO, compression: str):
+    """Wrap the binary file ``f`` so writes are compressed; closing the wrapper
+    leaves ``f`` open."""
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=1)
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression requires zstandard to be installed")
+        return zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+    raise ValueError(f"Unknown compression: {compression!r}")
+
+
+class StreamDecompressor:
+    """Decompress a gzip or zstd stream handed over in arbitrary pieces.
+
+    Concatenated members (``cat a.gz b.gz``) and multi-frame zstd streams
+    are decompressed in full, like the file readers do.
+    """
+
+    def __init__(self, compression: str):
+        if not compression_supported(compression):
+            raise RuntimeError("zstd uploads require zstandard to be installed")
+        self.compression = compression
+        self._decompressor = self._new()
+
+    def _new(self):
+        if self.compression == "gzip":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data: bytes) -> bytes:
+        out = []
+        while data:
+            out.append(self._decompressor.decompress(data))
+            if not self._decompressor.eof:
+                break
+            data = self._decompressor.unused_data
+            self._decompressor = self._new()
+        return b"".join(out)
+
+
+class CsvRowReader:
+    """Iterate the CSV rows stored in ``[start, end)`` of a file.
+
+    The range is read in blocks of ``block_size`` bytes cut on record
+    boundaries, so ``position`` is always the offset just past the last block
+    handed to the parser. The header row is skipped when ``start`` is 0.
+
+    gzip and zstd files are decompressed as they are read. They cannot be
+    split, so the range must cover the whole file, and ``position`` counts
+    compressed bytes consumed.
+
+    Rows are parsed ``PARSE_ROWS`` at a time, and ``parse_seconds`` adds up
+    the time spent reading and parsing, without timing single rows.
+
+    ``pause``, when set, is asked at every block boundary, with ``position``,
+    whether to stop there. Iteration then ends early with ``paused`` set,
+    once every row before ``position`` has been handed out, and iterating
+    again carries on from ``position``.
+    """
+
+    PARSE_ROWS = 1024
+
+    def __init__(
+        self,
+        file_path: str,
+        start: int = 0,
+        end: Optional[int] = None,
+        block_size: int = READ_BLOCK_SIZE,
+    ):
+        self.file_path = file_path
+        self.start = start
+        self.end = end
+        self.block_size = block_size
+        self.position = start
+        self.parse_seconds = 0.0
+        self.pause: Optional[Callable[[int], bool]] = None
+        self.paused = False
+
+    def blocks(self) -> Generator[str, None, None]:
+        with open(self.file_path, "rb") as raw:
+            offset = self.position
+            compression = sniff_compression(raw.read(4)) if offset == 0 else None
+            raw.seek(offset)
+            f = open_decompressed(raw, compression)
+            end = None if compression else self.end
+            splitter = RecordSplitter()
+            while True:
+                size = self.block_size
+                if end is not None:
+                    size = min(size, end - offset)
+                data = f.read(size) if size > 0 else b""
+                offset += len(data)
+                if not data:
+                    if splitter.pending:
+                        self.position = raw.tell() if compression else offset
+                        yield splitter.pending.decode("utf-8")
+                    return
+                records = splitter.feed(data)
+                if records:
+                    self.position = (
+                        raw.tell() if compression else offset - len(splitter.pending)
+                    )
+                    yield records.decode("utf-8")
+
+    def __iter__(self) -> Generator[List[str], None, None]:
+        skip_header = self.position == 0
+        self.paused = False
+        resumed_at = self.position
+        blocks = self.blocks()
+        clock = time.perf_counter
+        while True:
+            if (
+                self.pause is not None
+                and self.position != resumed_at
+                and self.pause(self.position)
+            ):
+                self.paused = True
+                blocks.close()
+                return
+            started = clock()
+            block = next(blocks, None)
+            if block is None:
+                self.parse_seconds += clock() - started
+                return
+            reader = csv.reader(io.StringIO(block, newline=""))
+            if skip_header:
+                skip_header = False
+                next(reader, None)
+            while rows := list(itertools.islice(reader, self.PARSE_ROWS)):
+                self.parse_seconds += clock() - started
+                yield from rows
+                started = clock()
+            self.parse_seconds += clock() - started
+
+
+def read_csv_rows(
+    file_path: str, start: int = 0, end: Optional[int] = None
+) -> Generator[List[str], None, None]:
+    yield from CsvRowReader(file_path, start, end)
 
 
 def aggregate_sales(
-    rows: Generator[List[str], None, None],
+    rows: Iterable[List[str]],
     progress_callback: Callable[[int, int], None] = None,
-    progress_interval: int = 10,
+    progress_interval: int = 1000,
+    sales: Optional[Dict[str, int]] = None,
 ) -> Dict[str, int]:
-    sales = defaultdict(int)
+    """Sum ``Number of Sales`` per department.
+
+    Totals are folded into ``sales`` when given (it must default missing
+    departments to 0), which lets callers aggregate a file piece by piece.
+    """
+    sales = defaultdict(int) if sales is None else sales
+    row_number = 0
     for row_number, row in enumerate(rows, start=1):
         if len(row) < 3:
             continue  # Skip invalid rows
@@ -54,12 +462,372 @@ def aggregate_sales(
             pass  # Handle errors
         if progress_callback and row_number % progress_interval == 0:
             progress_callback(row_number, len(sales))
-            time.sleep(0.3)
     if progress_callback:
         progress_callback(row_number, len(sales), "SUCCESS")
     return sales
 
 
+TIME_BUCKETS = ("day", "week", "month")
+
+
+def parse_day(text: str) -> str:
+    """ISO form of the date in ``text``, or "" if it is not a date."""
+    try:
+        return date.fromisoformat(text.strip()).isoformat()
+    except ValueError:
+        return ""
+
+
+def aggregate_sales_by_day(
+    rows: Iterable[List[str]],
+    progress_callback: Callable[[int, int], None] = None,
+    progress_interval: int = 1000,
+    sales: Optional[Dict[str, int]] = None,
+    daily: Optional[Dict[str, int]] = None,
+) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """Sum ``Number of Sales`` per department and per department and day.
+
+    ``daily`` is keyed by the ISO date followed by the department name
+    (``"2023-01-31Books"``), so its keys sort by day, then department. Rows
+    whose date does not parse still count towards the department totals.
+    Parsed dates are cached by their text, since an export repeats the same
+    few hundred dates over and over.
+    """
+    sales = defaultdict(int) if sales is None else sales
+    daily = defaultdict(int) if daily is None else daily
+    days = {}
+    row_number = 0
+    for row_number, row in enumerate(rows, start=1):
+        if len(row) < 3:
+            continue  # Skip invalid rows
+        dept, day_text, num_sales = row
+        # Listed even when none of its values parse, as by aggregate_sales
+        sales[dept] += 0
+        try:
+            num_sales = int(num_sales)
+        except ValueError:
+            pass  # Handle errors
+        else:
+            sales[dept] += num_sales
+            try:
+                day = days[day_text]
+            except KeyError:
+                if len(days) >= DATE_CACHE_SIZE:
+                    days.clear()
+                day = days[day_text] = parse_day(day_text)
+            if day:
+                daily[day + dept] += num_sales
+        if progress_callback and row_number % progress_interval == 0:
+            progress_callback(row_number, len(sales))
+    if progress_callback:
+        progress_callback(row_number, len(sales), "SUCCESS")
+    return sales, daily
+
+
+def bucket_start(day: date, granularity: str) -> date:
+    """First day of the ``granularity`` bucket holding ``day``.
+
+    Weeks start on Monday.
+    """
+    if granularity == "day":
+        return day
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    if granularity == "month":
+        return day.replace(day=1)
+    raise ValueError(f"Unknown time bucket: {granularity!r}")
+
+
+def rollup_daily(
+    items: Iterable[Tuple[str, int]],
+    granularity: str,
+    department: Optional[str] = None,
+) -> List[Tuple[str, str, int]]:
+    """Fold ``daily`` entries into ``(period, department, total)`` rows.
+
+    ``period`` is the ISO date the bucket starts on. Rows are ordered by
+    period, then department.
+    """
+    totals = defaultdict(int)
+    periods = {}
+    for key, total in items:
+        day, dept = key[:10], key[10:]
+        if department is not None and dept != department:
+            continue
+        period = periods.get(day)
+        if period is None:
+            period = periods[day] = bucket_start(
+                date.fromisoformat(day), granularity
+            ).isoformat()
+        totals[period, dept] += total
+    return [(period, dept, total) for (period, dept), total in sorted(totals.items())]
+
+
+class _RangeFile(io.RawIOBase):
+    """Read-only view of ``[start, end)`` of a binary file."""
+
+    def __init__(self, f: typing.BinaryIO, start: int, end: Optional[int]):
+        self._f = f
+        self._f.seek(start)
+        self.position = start
+        self.end = end
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = len(buffer)
+        if self.end is not None:
+            size = min(size, self.end - self.position)
+        if size <= 0:
+            return 0
+        read = self._f.readinto(memoryview(buffer)[:size])
+        self.position += read
+        return read
+
+
+class ColumnarSalesReader:
+    """Columnar counterpart of :class:`CsvRowReader` and :func:`aggregate_sales`.
+
+    The range is parsed by pyarrow in record batches of ``block_size`` bytes.
+    Each batch is grouped on ``Department Name`` with a hash group-by kernel
+    that sums ``Number of Sales``, then folded into the running totals.
+
+    Skip semantics match the row-by-row engine: short rows are dropped, rows
+    whose sales value ``int()`` rejects still register their department with
+    0, and rows with extra columns are an error. Values that are not plain
+    decimal literals (``1_000``, non-ASCII digits, very large numbers) are
+    converted with ``int()`` one by one. Compressed files are handled as by
+    :class:`CsvRowReader`.
+    """
+
+    # Plain literals of at most 12 digits keep each batch's int64 sums far
+    # from overflowing; anything else takes the int() path.
+    FAST_INTEGER = r"^[+-]?[0-9]{1,12}$"
+
+    def __init__(
+        self,
+        file_path: str,
+        start: int = 0,
+        end: Optional[int] = None,
+        block_size: int = COLUMNAR_BLOCK_SIZE,
+    ):
+        if pyarrow is None:
+            raise RuntimeError("The arrow engine requires pyarrow to be installed")
+        self.file_path = file_path
+        self.start = start
+        self.end = end
+        self.block_size = block_size
+        self.position = start
+        self.parse_seconds = 0.0
+
+    @staticmethod
+    def _skip_short_rows(row) -> str:
+        return "skip" if row.actual_columns < row.expected_columns else "error"
+
+    def batches(self):
+        with open(self.file_path, "rb") as f:
+            compression = sniff_compression(f.read(4)) if self.start == 0 else None
+            if compression:
+                f.seek(0)
+                source = open_decompressed(f, compression)
+            else:
+                source = _RangeFile(f, self.start, self.end)
+            reader = pa_csv.open_csv(
+                source,
+                read_options=pa_csv.ReadOptions(
+                    column_names=["dept", "date", "sales"],
+                    skip_rows=1 if self.start == 0 else 0,
+                    block_size=self.block_size,
+                ),
+                parse_options=pa_csv.ParseOptions(
+                    newlines_in_values=True,
+                    invalid_row_handler=self._skip_short_rows,
+                ),
+                convert_options=pa_csv.ConvertOptions(
+                    include_columns=["dept", "sales"],
+                    column_types={"dept": pyarrow.string(), "sales": pyarrow.string()},
+                    strings_can_be_null=False,
+                    quoted_strings_can_be_null=False,
+                ),
+            )
+            while True:
+                started = time.perf_counter()
+                batch = next(reader, None)
+                self.parse_seconds += time.perf_counter() - started
+                if batch is None:
+                    return
+                self.position = f.tell() if compression else source.position
+                yield batch
+
+    def aggregate(
+        self,
+        progress_callback: Callable[[int, int], None] = None,
+        sales: Optional[Dict[str, int]] = None,
+        sketches: Optional["SalesSketches"] = None,
+    ) -> Dict[str, int]:
+        """Fold the range into ``sales``; ``sketches`` see each batch's totals."""
+        sales = defaultdict(int) if sales is None else sales
+        row_number = 0
+        for batch in self.batches():
+            totals = sales if sketches is None else defaultdict(int)
+            depts = batch.column("dept")
+            raw = pc.utf8_trim_whitespace(batch.column("sales"))
+            fast = pc.match_substring_regex(raw, self.FAST_INTEGER)
+            values = pc.cast(
+                pc.replace_substring_regex(pc.if_else(fast, raw, "0"), r"^\+", ""),
+                pyarrow.int64(),
+            )
+            # Grouping every row, including ones with unparseable values,
+            # registers departments in first-seen order like the row engine.
+            grouped = (
+                pyarrow.table({"dept": depts, "sales": values})
+                .group_by("dept", use_threads=False)
+                .aggregate([("sales", "sum")])
+            )
+            for dept, total in zip(
+                grouped.column("dept").to_pylist(),
+                grouped.column("sales_sum").to_pylist(),
+            ):
+                totals[dept] += total
+            slow = pc.invert(fast)
+            for dept, num_sales in zip(
+                depts.filter(slow).to_pylist(),
+                batch.column("sales").filter(slow).to_pylist(),
+            ):
+                try:
+                    totals[dept] += int(num_sales)
+                except ValueError:
+                    pass
+            if sketches is not None:
+                new = [dept for dept in totals if dept not in sales]
+                for dept, total in totals.items():
+                    sales[dept] += total
+                sketches.update(totals, new)
+            row_number += batch.num_rows
+            if progress_callback:
+                progress_callback(row_number, len(sales))
+        if progress_callback:
+            progress_callback(row_number, len(sales), "SUCCESS")
+        return sales
+
+
+def open_sales_reader(
+    file_path: str, start: int = 0, end: Optional[int] = None, engine: str = "python"
+):
+    if engine == "arrow":
+        return ColumnarSalesReader(file_path, start, end)
+    if engine == "python":
+        return CsvRowReader(file_path, start, end)
+    raise ValueError(f"Unknown aggregation engine: {engine!r}")
+
+
+def aggregate_reader(
+    reader,
+    progress_callback: Callable[[int, int], None] = None,
+    sales: Optional[Dict[str, int]] = None,
+    daily: Optional[Dict[str, int]] = None,
+    sketches: Optional["SalesSketches"] = None,
+) -> Dict[str, int]:
+    """Aggregate ``reader`` with the function its engine and options call for.
+
+    Per-day totals are folded into ``daily`` when given (python engine only),
+    and ``sketches`` when given are kept up to date as rows are read.
+    """
+    if isinstance(reader, ColumnarSalesReader):
+        return reader.aggregate(progress_callback, sales=sales, sketches=sketches)
+    if sketches is not None:
+        return aggregate_sketched(reader, sketches, progress_callback, sales, daily)
+    if daily is not None:
+        return aggregate_sales_by_day(
+            reader, progress_callback=progress_callback, sales=sales, daily=daily
+        )[0]
+    return aggregate_sales(reader, progress_callback=progress_callback, sales=sales)
+
+
+class StreamingSalesAggregator:
+    """Aggregate an upload from its chunks as they arrive.
+
+    Chunks are cut on record boundaries with a :class:`RecordSplitter`; the
+    incomplete tail of a chunk, including a quoted field or a UTF-8 sequence
+    split across chunks, is held back until the next chunk completes it.
+    A gzip or zstd upload, recognised by its first chunk, is decompressed on
+    the fly; ``bytes_processed`` counts the bytes received.
+
+    With an aggregation ``spec`` the plan is compiled from the header row and
+    :meth:`close` returns its groups instead of per-department totals. With
+    ``time_buckets``, sales are also summed per day into ``daily``.
+    """
+
+    def __init__(self, spec: Optional[dict] = None, time_buckets: bool = False):
+        self.sales = defaultdict(int)
+        self.daily = defaultdict(int) if time_buckets else None
+        self.spec = spec
+        self.plan = None
+        self.groups = {}
+        self.lines_processed = 0
+        self.bytes_processed = 0
+        self._splitter = RecordSplitter()
+        self._header_skipped = False
+        self._block_rows = 0
+        self._decompressor = None
+        self._head = b""
+
+    def feed(self, data: bytes) -> None:
+        self.bytes_processed += len(data)
+        if self._head is not None:
+            # Hold the first bytes back until they tell the upload's format
+            self._head += data
+            if len(self._head) < 4:
+                return
+            data, self._head = self._head, None
+            compression = sniff_compression(data)
+            if compression:
+                self._decompressor = StreamDecompressor(compression)
+        if self._decompressor:
+            data = self._decompressor.decompress(data)
+        records = self._splitter.feed(data)
+        if records:
+            self._aggregate(records)
+
+    def close(self) -> Dict[str, int]:
+        # Whatever is left is the last record, missing its newline
+        tail, self._head = self._head or self._splitter.pending, None
+        if tail:
+            self._aggregate(tail)
+            self._splitter = RecordSplitter()
+        if self.spec is None:
+            return self.sales
+        if self.plan is None:
+            raise ValueError("The upload has no header row")
+        return self.groups
+
+    def _count_rows(self, current: int, departments: int, state: str = "PENDING"):
+        self._block_rows = current
+
+    def _aggregate(self, data: bytes) -> None:
+        rows = csv.reader(io.StringIO(data.decode("utf-8"), newline=""))
+        if not self._header_skipped:
+            header = next(rows, None)
+            self._header_skipped = header is not None
+            if header is not None and self.spec is not None:
+                self.plan = AggregationPlan(self.spec, header)
+        if self.plan is not None:
+            self.plan.aggregate(
+                rows, groups=self.groups, progress_callback=self._count_rows
+            )
+        elif self.daily is not None:
+            aggregate_sales_by_day(
+                rows,
+                progress_callback=self._count_rows,
+                sales=self.sales,
+                daily=self.daily,
+            )
+        elif self.spec is None:
+            aggregate_sales(rows, progress_callback=self._count_rows, sales=self.sales)
+        self.lines_processed += self._block_rows
+
+
 def create_csv_from_aggregated(sales: Dict[str, int], output: typing.TextIO) -> None:
     writer = csv.writer(output)
     writer.writerow(["Department Name", "Total Sales"])
@@ -68,37 +836,2222 @@ def create_csv_from_aggregated(sales: Dict[str, int], output: typing.TextIO) ->
     output.seek(0)  # Reset to beginning for reading
 
 
-@celery_app.task(bind=True)
-def process_csv_task(self, file_path: str) -> dict:
-    rows = read_csv_rows(file_path)
-    start_time = time.time()
-    result_path = os.path.join(RESULTS_DIR, f"{process_csv_task.request.id}_result.csv")
-    progress_dict = {
-        "lines_processed": 0,
-        "departments": 0,
-        "time_elapsed": 0.0,
-        "result_path": result_path,
-    }
+def merge_partial_sales(partials: Iterable[Dict[str, int]]) -> Dict[str, int]:
+    """Sum per-department partials, keeping departments in first-seen order.
+
+    Merging the partials of consecutive ranges in file order yields exactly the
+    totals and ordering of a serial pass over the whole file.
+    """
+    sales = defaultdict(int)
+    for partial in partials:
+        for dept, total in partial.items():
+            sales[dept] += total
+    return sales
+
+
+class TopKSketch:
+    """Mergeable summary of the heaviest keys of a weighted stream.
+
+    A Misra-Gries summary, the mergeable form of Space-Saving: at most
+    ``capacity`` counters are kept, and whenever more are needed every
+    counter is lowered by the (capacity + 1)-th largest and the ones left
+    at zero are dropped. An estimate is therefore never above a key's true
+    total and at most ``error`` below it, where ``error``, the sum of those
+    reductions, never exceeds ``total / (capacity + 1)``. The bound needs
+    non-negative weights, so negative ones are ignored.
+    """
+
+    def __init__(
+        self,
+        capacity: int = SKETCH_COUNTERS,
+        counters: Optional[Dict[str, int]] = None,
+        total: int = 0,
+        error: int = 0,
+    ):
+        self.capacity = capacity
+        self.counters = counters or {}
+        self.total = total
+        self.error = error
+
+    def update(self, items: Iterable[Tuple[str, int]]) -> None:
+        counters = self.counters
+        for key, weight in items:
+            if weight > 0:
+                counters[key] = counters.get(key, 0) + weight
+                self.total += weight
+        if len(counters) > self.capacity:
+            self._shrink()
+
+    def merge(self, other: "TopKSketch") -> None:
+        self.update(other.counters.items())
+        # update() counted the other summary's estimates; use its true total
+        self.total += other.total - sum(other.counters.values())
+        self.error += other.error
+
+    def _shrink(self) -> None:
+        cut = heapq.nlargest(self.capacity + 1, self.counters.values())[-1]
+        self.error += cut
+        self.counters = {
+            key: count - cut for key, count in self.counters.items() if count > cut
+        }
+
+    def top(self, n: int) -> List[Tuple[str, int]]:
+        """The ``n`` keys with the largest estimates, heaviest first."""
+        return heapq.nlargest(n, self.counters.items(), key=operator.itemgetter(1))
+
+    def to_dict(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "counters": self.counters,
+            "total": self.total,
+            "error": self.error,
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict) -> "TopKSketch":
+        return cls(state["capacity"], state["counters"], state["total"], state["error"])
+
+
+class HyperLogLog:
+    """Mergeable estimate of the number of distinct keys.
+
+    Each key is hashed (BLAKE2b, so every worker agrees) into one of
+    ``2 ** precision`` registers, which keeps the longest run of leading
+    zero bits seen. Registers merge by taking the maximum. The estimate's
+    standard error is :attr:`relative_error`.
+    """
+
+    def __init__(self, precision: int = SKETCH_HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = registers or bytearray(1 << precision)
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add(self, keys: Iterable[str]) -> None:
+        registers = self.registers
+        shift = 64 - self.precision
+        rest = (1 << shift) - 1
+        for key in keys:
+            digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "big")
+            index = value >> shift
+            rank = shift - (value & rest).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # Small range correction
+        return round(estimate)
+
+    def to_dict(self) -> dict:
+        return {
+            "precision": self.precision,
+            "registers": base64.b64encode(self.registers).decode("ascii"),
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict) -> "HyperLogLog":
+        return cls(state["precision"], bytearray(base64.b64decode(state["registers"])))
+
+
+class SalesSketches:
+    """Top departments and distinct department count of the sales seen so far.
+
+    Fed with the per-department totals of each block, so the sketches see
+    one weighted update per department per block rather than one per row.
+    Sketches of parallel ranges merge into the sketches of the whole upload.
+    """
+
+    def __init__(self, top: TopKSketch = None, distinct: HyperLogLog = None):
+        self.top = top or TopKSketch()
+        self.distinct = distinct or HyperLogLog()
+
+    def update(self, block: Dict[str, int], new: Iterable[str] = None) -> None:
+        """Add a block's totals; ``new`` are the keys not seen before, if known.
+
+        Adding a key to the distinct count again changes nothing, so callers
+        that keep exact totals can save hashing the keys they already hold.
+        """
+        self.top.update(block.items())
+        self.distinct.add(block if new is None else new)
+
+    def merge(self, other: "SalesSketches") -> None:
+        self.top.merge(other.top)
+        self.distinct.merge(other.distinct)
+
+    def to_meta(self) -> dict:
+        return {"top": self.top.to_dict(), "distinct": self.distinct.to_dict()}
+
+    @classmethod
+    def from_meta(cls, meta: dict) -> "SalesSketches":
+        return cls(
+            TopKSketch.from_dict(meta["top"]), HyperLogLog.from_dict(meta["distinct"])
+        )
+
+    def summary(self, n: int = SKETCH_TOP) -> dict:
+        return {
+            "top_departments": self.top.top(n),
+            "top_error": self.top.error,
+            "distinct_departments": self.distinct.estimate(),
+            "distinct_relative_error": self.distinct.relative_error,
+        }
+
+
+def aggregate_sketched(
+    rows: Iterable[List[str]],
+    sketches: SalesSketches,
+    progress_callback: Callable[[int, int], None] = None,
+    sales: Optional[Dict[str, int]] = None,
+    daily: Optional[Dict[str, int]] = None,
+    block_rows: int = 100_000,
+) -> Dict[str, int]:
+    """:func:`aggregate_sales` that also feeds ``sketches``, a block at a time.
+
+    The work per block grows with the departments in it rather than its
+    rows, so blocks are large enough to keep it small next to aggregating
+    them. With ``daily`` rows are aggregated by
+    :func:`aggregate_sales_by_day`, whose per-day totals are folded into it.
+    """
+    sales = defaultdict(int) if sales is None else sales
+    row_number = 0
+    for batch in itertools.batched(rows, block_rows):
+        if daily is None:
+            block = aggregate_sales(batch)
+        else:
+            block, _ = aggregate_sales_by_day(batch, daily=daily)
+        new = [dept for dept in block if dept not in sales]
+        for dept, total in block.items():
+            sales[dept] += total
+        sketches.update(block, new)
+        row_number += len(batch)
+        if progress_callback:
+            progress_callback(row_number, len(sales))
+    if progress_callback:
+        progress_callback(row_number, len(sales), "SUCCESS")
+    return sales
+
+
+def _object_size(value) -> int:
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+    return sys.getsizeof(value)
+
+
+def estimate_size(groups: dict, sample: int = 64) -> int:
+    """Rough bytes held by ``groups``, from the sizes of a sample of entries."""
+    sizes = [
+        _object_size(key) + _object_size(value)
+        for key, value in itertools.islice(groups.items(), sample)
+    ]
+    if not sizes:
+        return sys.getsizeof(groups)
+    return sys.getsizeof(groups) + len(groups) * sum(sizes) // len(sizes)
+
+
+def _load_entry(line: str):
+    key, value = json.loads(line)
+    return (tuple(key) if isinstance(key, list) else key), value
+
+
+class SpillingAggregator:
+    """Keep the groups of an aggregation within a memory budget.
+
+    The callback returned by :meth:`watch` checks the groups' estimated size
+    on every progress report. Past ``budget`` bytes they are spilled: split
+    into ``partitions`` by a hash of their key, each partition sorted by key
+    and written as a run of JSON lines, and the dict is cleared to make room.
+
+    :meth:`items` then merges the runs with :func:`heapq.merge`, folding
+    equal keys together with ``combine``, so the groups come out one at a
+    time, sorted by key, and never all in memory. Until something is
+    spilled it simply returns the groups in first-seen order.
+    """
+
+    def __init__(
+        self,
+        budget: int = AGGREGATION_MEMORY_BUDGET,
+        combine: Callable = operator.add,
+        partitions: int = SPILL_PARTITIONS,
+        directory: str = SPILL_DIR,
+    ):
+        self.budget = budget
+        self.combine = combine
+        self.partitions = partitions
+        self.directory = directory
+        self.runs = [[] for _ in range(partitions)]
+        self._spill_dir = None
+        self._adopted_dirs = set()
+        self._run_number = 0
+        self.count = 0
+
+    @property
+    def spilled(self) -> bool:
+        return any(self.runs)
+
+    def watch(self, groups: dict, progress_callback: Callable = None) -> Callable:
+        """Wrap ``progress_callback`` to spill ``groups`` once over budget."""
+
+        def check(current: int, departments: int, state: str = "PENDING"):
+            if progress_callback:
+                progress_callback(current, departments, state)
+            if state == "PENDING" and self.over_budget(groups):
+                self.spill(groups)
+
+        return check
+
+    def over_budget(self, groups: dict) -> bool:
+        return bool(self.budget) and estimate_size(groups) > self.budget
+
+    def spill(self, groups: dict) -> None:
+        """Write ``groups`` out as one sorted run per partition and clear it."""
+        if not groups:
+            return
+        partitions = [[] for _ in range(self.partitions)]
+        for key, value in groups.items():
+            line = json.dumps([key, value]) + "\n"
+            # crc32 rather than hash(), which differs between worker processes
+            partition = zlib.crc32(json.dumps(key).encode()) % self.partitions
+            partitions[partition].append((key, line))
+        groups.clear()
+        for number, entries in enumerate(partitions):
+            if entries:
+                entries.sort(key=operator.itemgetter(0))
+                self._write_run(number, (line for _, line in entries))
+
+    def _write_run(self, partition: int, lines: Iterable[str]) -> None:
+        if self._spill_dir is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._spill_dir = tempfile.mkdtemp(dir=self.directory)
+        self._run_number += 1
+        path = os.path.join(self._spill_dir, f"{partition}-{self._run_number}.jsonl")
+        with open(path, "w") as f:
+            f.writelines(lines)
+        self.runs[partition].append(path)
+
+    def adopt(self, runs: List[List[str]]) -> None:
+        """Merge the runs another aggregator spilled (see :attr:`runs`)."""
+        for number, paths in enumerate(runs):
+            self.runs[number % self.partitions].extend(paths)
+            self._adopted_dirs.update(os.path.dirname(path) for path in paths)
+
+    def fold(self, groups: dict, items: Iterable[Tuple], check_every: int = 10000):
+        """Combine ``(key, value)`` pairs into ``groups``, spilling as needed."""
+        for number, (key, value) in enumerate(items, start=1):
+            current = groups.get(key)
+            groups[key] = value if current is None else self.combine(current, value)
+            if number % check_every == 0 and self.over_budget(groups):
+                self.spill(groups)
+
+    def merged(self, groups: dict):
+        """The final groups: ``groups`` itself if nothing was spilled.
+
+        Otherwise the rest of ``groups`` is spilled too and a single pass
+        over the merged ``(key, value)`` pairs is returned; :attr:`count`
+        holds the number of groups once it is exhausted.
+        """
+        if not self.spilled:
+            return groups
+        self.spill(groups)
+        if sum(len(paths) for paths in self.runs) > SPILL_MAX_OPEN_RUNS:
+            for number, paths in enumerate(self.runs):
+                if len(paths) > 1:
+                    self._compact(number)
+        return self._count(self._merge(path for paths in self.runs for path in paths))
+
+    def _count(self, entries: Iterable[Tuple]) -> Generator[Tuple, None, None]:
+        self.count = 0
+        for entry in entries:
+            self.count += 1
+            yield entry
+
+    def _compact(self, partition: int) -> None:
+        paths, self.runs[partition] = self.runs[partition], []
+        self._write_run(
+            partition,
+            (json.dumps(list(entry)) + "\n" for entry in self._merge(paths)),
+        )
+        for path in paths:
+            os.remove(path)
+
+    def _merge(self, paths: Iterable[str]) -> Generator[Tuple, None, None]:
+        files = [open(path) for path in paths]
+        try:
+            merged = heapq.merge(
+                *(map(_load_entry, f) for f in files), key=operator.itemgetter(0)
+            )
+            current = next(merged, None)
+            for key, value in merged:
+                if key == current[0]:
+                    current = (key, self.combine(current[1], value))
+                else:
+                    yield current
+                    current = (key, value)
+            if current is not None:
+                yield current
+        finally:
+            for f in files:
+                f.close()
+
+    def close(self) -> None:
+        """Delete the spilled runs, including adopted ones."""
+        for directory in [self._spill_dir, *self._adopted_dirs]:
+            if directory is not None:
+                shutil.rmtree(directory, ignore_errors=True)
+        self._spill_dir = None
+        self._adopted_dirs.clear()
+
+
+AGGREGATE_FUNCTIONS = ("sum", "count", "min", "max", "mean")
+
+
+def normalize_spec(spec: dict) -> dict:
+    """Validate an aggregation spec and return it in canonical form.
+
+    A spec groups rows by ``keys`` and computes ``aggregates`` per group.
+    Columns are given by header name or 0-based index::
+
+        {
+            "keys": ["Region", 0],
+            "aggregates": [
+                {"function": "sum", "column": "Units"},
+                {"function": "mean", "column": 4},
+                {"function": "count"},
+            ],
+        }
+
+    ``count`` without a column counts rows; with one it counts the rows whose
+    value in that column is a number, which is what the other functions use.
+    """
+
+    def column(ref):
+        if isinstance(ref, bool) or not isinstance(ref, (str, int)):
+            raise ValueError(f"Columns are header names or indexes, got {ref!r}")
+        if isinstance(ref, int) and ref < 0:
+            raise ValueError(f"Column indexes start at 0, got {ref}")
+        return ref
+
+    keys = [column(ref) for ref in spec.get("keys") or ()]
+    if not keys:
+        raise ValueError("An aggregation spec needs at least one key column")
+    aggregates = []
+    for aggregate in spec.get("aggregates") or ():
+        function = aggregate.get("function")
+        if function not in AGGREGATE_FUNCTIONS:
+            raise ValueError(f"Unknown aggregate function: {function!r}")
+        ref = aggregate.get("column")
+        if ref is None and function != "count":
+            raise ValueError(f"{function} needs a column")
+        aggregates.append(
+            {"function": function, "column": None if ref is None else column(ref)}
+        )
+    if not aggregates:
+        raise ValueError("An aggregation spec needs at least one aggregate")
+    return {"keys": keys, "aggregates": aggregates}
+
+
+def parse_number(text: str):
+    """``int`` or finite ``float`` value of a field, or None if not a number."""
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            value = float(text)
+        except ValueError:
+            return None
+        return value if math.isfinite(value) else None
+
+
+def read_header(file_path: str) -> List[str]:
+    with open(file_path, "rb") as raw:
+        compression = sniff_compression(raw.read(4))
+        raw.seek(0)
+        text = io.TextIOWrapper(open_decompressed(raw, compression), newline="")
+        return next(csv.reader(text), [])
+
+
+def check_sketches(sketches: bool, spec: Optional[dict]):
+    if sketches and spec:
+        raise ValueError("Sketches cannot be combined with an aggregation spec")
+
+
+def check_time_buckets(time_buckets: bool, engine: str, spec: Optional[dict]):
+    if time_buckets and engine != "python":
+        raise ValueError("Time buckets are only supported by the python engine")
+    if time_buckets and spec:
+        raise ValueError("Time buckets cannot be combined with an aggregation spec")
+
+
+def aggregation_plan(file_path: str, spec: dict, engine: str = "python"):
+    """Compile ``spec`` against the header of the upload at ``file_path``."""
+    if engine != "python":
+        raise ValueError("Aggregation specs are only supported by the python engine")
+    return AggregationPlan(spec, read_header(file_path))
+
+
+class AggregationPlan:
+    """An aggregation spec compiled against the header of an upload.
+
+    Each group is a flat list of accumulator slots. Every value column the
+    spec refers to gets only the slots its functions need (``mean`` shares
+    the ``sum`` and ``count`` slots), so a row parses each value once and
+    updates a handful of list items.
+
+    Groups map a key (the field itself for a single key column, else a
+    tuple) to its slots, in first-seen order. Plans with the same spec lay
+    slots out identically, so groups of different ranges or uploads merge.
+    """
+
+    def __init__(self, spec: dict, header: List[str]):
+        self.spec = normalize_spec(spec)
+        self.header = header
+        self.key_columns = [self._resolve(ref) for ref in self.spec["keys"]]
+        self._key = operator.itemgetter(*self.key_columns)
+        self._initial = []
+        self._kinds = []
+        slots = {}  # (function, column) -> slot
+        for aggregate in self.spec["aggregates"]:
+            ref = aggregate["column"]
+            column = None if ref is None else self._resolve(ref)
+            needs = ("sum", "count") if aggregate["function"] == "mean" else None
+            for function in needs or (aggregate["function"],):
+                if (function, column) not in slots:
+                    slots[function, column] = len(self._initial)
+                    self._initial.append(0 if function in ("sum", "count") else None)
+                    self._kinds.append(function)
+        self._slots = slots
+        self._rows_slot = slots.get(("count", None))
+        self._columns = [
+            (
+                column,
+                slots.get(("sum", column)),
+                slots.get(("count", column)),
+                slots.get(("min", column)),
+                slots.get(("max", column)),
+            )
+            for column in dict.fromkeys(c for _, c in slots if c is not None)
+        ]
+        self._width = 1 + max(self.key_columns + [c for c, *_ in self._columns])
+
+    def _resolve(self, ref) -> int:
+        if isinstance(ref, int):
+            if ref >= len(self.header):
+                raise ValueError(f"Column {ref} is past the last column of the header")
+            return ref
+        try:
+            return self.header.index(ref)
+        except ValueError:
+            raise ValueError(f"Unknown column: {ref!r}") from None
+
+    @property
+    def output_columns(self) -> List[str]:
+        names = [self.header[column] for column in self.key_columns]
+        for aggregate in self.spec["aggregates"]:
+            ref = aggregate["column"]
+            if ref is None:
+                names.append(aggregate["function"])
+            else:
+                column = self.header[self._resolve(ref)]
+                names.append(f"{aggregate['function']}({column})")
+        return names
+
+    def aggregate(
+        self,
+        rows: Iterable[List[str]],
+        groups: Optional[dict] = None,
+        progress_callback: Callable[[int, int], None] = None,
+        progress_interval: int = 1000,
+    ) -> dict:
+        """Fold ``rows`` into ``groups``; rows too short for the spec are skipped."""
+        groups = {} if groups is None else groups
+        key_of, initial, width = self._key, self._initial, self._width
+        rows_slot, columns = self._rows_slot, self._columns
+        row_number = 0
+        for row_number, row in enumerate(rows, start=1):
+            if len(row) < width:
+                continue
+            key = key_of(row)
+            slots = groups.get(key)
+            if slots is None:
+                slots = groups[key] = initial[:]
+            if rows_slot is not None:
+                slots[rows_slot] += 1
+            for column, sum_slot, count_slot, min_slot, max_slot in columns:
+                value = parse_number(row[column])
+                if value is None:
+                    continue
+                if sum_slot is not None:
+                    slots[sum_slot] += value
+                if count_slot is not None:
+                    slots[count_slot] += 1
+                if min_slot is not None and (
+                    slots[min_slot] is None or value < slots[min_slot]
+                ):
+                    slots[min_slot] = value
+                if max_slot is not None and (
+                    slots[max_slot] is None or value > slots[max_slot]
+                ):
+                    slots[max_slot] = value
+            if progress_callback and row_number % progress_interval == 0:
+                progress_callback(row_number, len(groups))
+        if progress_callback:
+            progress_callback(row_number, len(groups), "SUCCESS")
+        return groups
+
+    def merge(self, partials: Iterable[dict]) -> dict:
+        """Combine groups of consecutive ranges, keeping first-seen order."""
+        groups = {}
+        for partial in partials:
+            for key, other in partial.items():
+                slots = groups.get(key)
+                if slots is None:
+                    groups[key] = other[:]
+                else:
+                    self.combine(slots, other)
+        return groups
+
+    def combine(self, slots: list, other: list) -> list:
+        """Fold the accumulators of ``other`` into ``slots`` and return it."""
+        for slot, kind in enumerate(self._kinds):
+            if other[slot] is None:
+                continue
+            if kind in ("sum", "count"):
+                slots[slot] += other[slot]
+            elif slots[slot] is None:
+                slots[slot] = other[slot]
+            elif kind == "min":
+                slots[slot] = min(slots[slot], other[slot])
+            else:
+                slots[slot] = max(slots[slot], other[slot])
+        return slots
+
+    def dump(self, groups: dict) -> list:
+        """JSON-serializable form of ``groups``, read back by :meth:`load`."""
+        return [[self.dump_key(key), slots] for key, slots in groups.items()]
+
+    def dump_key(self, key) -> list:
+        return [key] if len(self.key_columns) == 1 else list(key)
+
+    def load(self, dumped: list) -> dict:
+        single = len(self.key_columns) == 1
+        return {(key[0] if single else tuple(key)): slots for key, slots in dumped}
+
+    def results(self, groups: dict) -> Generator[list, None, None]:
+        """Output rows: the key fields followed by each aggregate's value."""
+        return self.rows(groups.items())
+
+    def rows(self, items: Iterable[Tuple]) -> Generator[list, None, None]:
+        """Output rows of ``(key, slots)`` pairs, see :meth:`results`."""
+        single = len(self.key_columns) == 1
+        outputs = []
+        for aggregate in self.spec["aggregates"]:
+            ref = aggregate["column"]
+            column = None if ref is None else self._resolve(ref)
+            if aggregate["function"] == "mean":
+                outputs.append(
+                    (self._slots["sum", column], self._slots["count", column])
+                )
+            else:
+                outputs.append((self._slots[aggregate["function"], column], None))
+        for key, slots in items:
+            row = [key] if single else list(key)
+            for slot, count_slot in outputs:
+                if count_slot is None:
+                    row.append(slots[slot])
+                else:
+                    count = slots[count_slot]
+                    row.append(slots[slot] / count if count else None)
+            yield row
+
+    def write_csv(self, groups: dict, output: typing.TextIO) -> None:
+        self.write_rows(groups.items(), output)
+
+    def write_rows(self, items: Iterable[Tuple], output: typing.TextIO) -> None:
+        writer = csv.writer(output)
+        writer.writerow(self.output_columns)
+        writer.writerows(
+            ["" if value is None else value for value in row]
+            for row in self.rows(items)
+        )
+
+    def columns(self, groups: dict) -> Dict[str, list]:
+        rows = list(self.results(groups))
+        return {
+            name: [row[i] for row in rows] for i, name in enumerate(self.output_columns)
+        }
+
+
+def store_completed_result(
+    task_id: str,
+    sales: Dict[str, int],
+    meta: dict,
+    plan: Optional["AggregationPlan"] = None,
+    daily: Optional[Dict[str, int]] = None,
+) -> dict:
+    """Write ``sales`` as the result of ``task_id`` and mark the task SUCCESS.
+
+    Used for results produced outside a worker, so ``GetProcessingResult``
+    and ``DownloadResult`` treat them like any finished task. With ``plan``,
+    ``sales`` are the groups it aggregated; ``daily`` are the per-day totals
+    of a time-bucketed aggregation.
+    """
+    if plan is None:
+        result_path = write_task_result(task_id, sales, daily)
+        if daily is not None:
+            meta = {**meta, "time_buckets": True}
+    else:
+        result_path = write_grouped_result(task_id, plan, sales)
+        meta = {**meta, "spec": plan.spec}
+    meta = {**meta, "departments": len(sales), "result_path": result_path}
+    celery_app.backend.store_result(task_id, meta, "SUCCESS")
+    return meta
+
+
+def result_path_for(task_id: str) -> str:
+    return os.path.join(RESULTS_DIR, f"{task_id}_result.csv")
+
+
+def compressed_result_path_for(task_id: str) -> str:
+    return result_path_for(task_id) + ".gz"
+
+
+def state_path_for(task_id: str) -> str:
+    return os.path.join(RESULTS_DIR, f"{task_id}_aggregate.bin")
+
+
+def daily_path_for(task_id: str) -> str:
+    return os.path.join(RESULTS_DIR, f"{task_id}_daily.bin")
+
+
+def groups_path_for(task_id: str) -> str:
+    return os.path.join(RESULTS_DIR, f"{task_id}_groups.json")
+
+
+def profile_path_for(task_id: str) -> str:
+    return os.path.join(RESULTS_DIR, f"{task_id}_profile.pstats")
+
+
+def _int_array(buffer, offset: int, typecode: str, count: int):
+    """Read-only little-endian integer array of ``count`` items at ``offset``."""
+    size = array.array(typecode).itemsize
+    view = memoryview(buffer)[offset : offset + size * count]
+    if sys.byteorder == "little":
+        return view.cast(typecode)
+    values = array.array(typecode, view)
+    values.byteswap()
+    return values
+
+
+def _int_bytes(typecode: str, values: Iterable[int]) -> bytes:
+    values = array.array(typecode, values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+
+class AggregateStore:
+    """Memory-mapped binary form of a task's per-department totals.
+
+    Departments are numbered in first-seen order, which is the order totals
+    are rendered and merged in. The little-endian layout is::
+
+        header   magic (8 bytes), department count, overflow count (uint64)
+        offsets  uint64[count + 1]  start of each name in the string table
+        totals   int64[count]       total of each department
+        index    uint32[count]      department numbers sorted by name
+        strings  UTF-8 names back to back
+        overflow (uint32 number, uint32 length, ASCII decimal) per total that
+                 does not fit in an int64; its slot in ``totals`` holds 0
+
+    Nothing is parsed up front except the overflow section, so opening a
+    store is cheap and :meth:`get` looks a department up in O(log n) by
+    bisecting ``index``.
+    """
+
+    MAGIC = b"CSVAGG\x00\x01"
+    HEADER = struct.Struct("<8sQQ")
+    OVERFLOW = struct.Struct("<II")
+    INT64_RANGE = range(-(2**63), 2**63)
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, overflow_count = self.HEADER.unpack_from(self._mmap)
+        if magic != self.MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not an aggregate store")
+        self._count = count
+        position = self.HEADER.size
+        self._offsets = _int_array(self._mmap, position, "Q", count + 1)
+        position += 8 * (count + 1)
+        self._totals = _int_array(self._mmap, position, "q", count)
+        position += 8 * count
+        self._index = _int_array(self._mmap, position, "I", count)
+        position += 4 * count
+        self._strings = position
+        position += self._offsets[count]
+        self._overflow = {}
+        for _ in range(overflow_count):
+            number, length = self.OVERFLOW.unpack_from(self._mmap, position)
+            position += self.OVERFLOW.size
+            self._overflow[number] = int(self._mmap[position : position + length])
+            position += length
+
+    @classmethod
+    def write(cls, path: str, sales: Dict[str, int]) -> None:
+        names = [dept.encode("utf-8") for dept in sales]
+        totals = list(sales.values())
+        offsets = [0]
+        for name in names:
+            offsets.append(offsets[-1] + len(name))
+        overflow = [
+            (number, str(total).encode())
+            for number, total in enumerate(totals)
+            if total not in cls.INT64_RANGE
+        ]
+        with open(path, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(names), len(overflow)))
+            f.write(_int_bytes("Q", offsets))
+            f.write(_int_bytes("q", (t if t in cls.INT64_RANGE else 0 for t in totals)))
+            f.write(_int_bytes("I", sorted(range(len(names)), key=names.__getitem__)))
+            f.write(b"".join(names))
+            for number, digits in overflow:
+                f.write(cls.OVERFLOW.pack(number, len(digits)))
+                f.write(digits)
+
+    @classmethod
+    def write_sorted(cls, path: str, items: Iterable[Tuple[str, int]]) -> None:
+        """Write a store from ``(department, total)`` pairs sorted by name.
+
+        Unlike :meth:`write`, the pairs are consumed one batch at a time.
+        Departments are numbered in name order, so the index is the identity;
+        the other sections go to temporary files until their sizes are known.
+        """
+        count = 0
+        end = 0
+        overflow = []
+        directory = os.path.dirname(path) or "."
+        with tempfile.TemporaryFile(dir=directory) as offsets, tempfile.TemporaryFile(
+            dir=directory
+        ) as totals, tempfile.TemporaryFile(dir=directory) as strings:
+            offsets.write(_int_bytes("Q", [0]))
+            for batch in itertools.batched(items, 65536):
+                names = [dept.encode("utf-8") for dept, _ in batch]
+                ends = list(itertools.accumulate(map(len, names), initial=end))[1:]
+                end = ends[-1]
+                values = []
+                for number, (_, total) in enumerate(batch, start=count):
+                    if total not in cls.INT64_RANGE:
+                        overflow.append((number, str(total).encode()))
+                        total = 0
+                    values.append(total)
+                offsets.write(_int_bytes("Q", ends))
+                totals.write(_int_bytes("q", values))
+                strings.write(b"".join(names))
+                count += len(batch)
+            with open(path, "wb") as f:
+                f.write(cls.HEADER.pack(cls.MAGIC, count, len(overflow)))
+                for section in (offsets, totals):
+                    section.seek(0)
+                    shutil.copyfileobj(section, f)
+                for start in range(0, count, 65536):
+                    f.write(_int_bytes("I", range(start, min(count, start + 65536))))
+                strings.seek(0)
+                shutil.copyfileobj(strings, f)
+                for number, digits in overflow:
+                    f.write(cls.OVERFLOW.pack(number, len(digits)))
+                    f.write(digits)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _name(self, number: int) -> bytes:
+        start = self._strings + self._offsets[number]
+        return self._mmap[start : self._strings + self._offsets[number + 1]]
+
+    def _total(self, number: int) -> int:
+        if number in self._overflow:
+            return self._overflow[number]
+        return self._totals[number]
+
+    def get(self, dept: str) -> Optional[int]:
+        """Total of ``dept``, or None if the task never saw it."""
+        name = dept.encode("utf-8")
+        i = bisect.bisect_left(
+            range(self._count), name, key=lambda i: self._name(self._index[i])
+        )
+        if i < self._count and self._name(self._index[i]) == name:
+            return self._total(self._index[i])
+        return None
+
+    def items(self) -> Generator[Tuple[str, int], None, None]:
+        for number in range(self._count):
+            yield self._name(number).decode("utf-8"), self._total(number)
+
+    def scan(
+        self, start: str = "", stop: Optional[str] = None
+    ) -> Generator[Tuple[str, int], None, None]:
+        """Entries with names in ``[start, stop)``, in name order."""
+
+        def name(i: int) -> bytes:
+            return self._name(self._index[i])
+
+        names = range(self._count)
+        i = bisect.bisect_left(names, start.encode("utf-8"), key=name)
+        end = self._count
+        if stop is not None:
+            end = bisect.bisect_left(names, stop.encode("utf-8"), lo=i, key=name)
+        for number in self._index[i:end]:
+            yield self._name(number).decode("utf-8"), self._total(number)
+
+    def to_dict(self) -> Dict[str, int]:
+        return defaultdict(int, self.items())
+
+    def close(self) -> None:
+        for view in (self._offsets, self._totals, self._index):
+            if isinstance(view, memoryview):
+                view.release()
+        self._mmap.close()
+
+    def __enter__(self) -> "AggregateStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class AggregateStoreCache:
+    """Open :class:`AggregateStore` maps, reused across lookups.
+
+    A store is reused while its file is the one it mapped: each lookup stats
+    the path, and a file deleted or replaced since, by this process or
+    another, is mapped afresh. At most ``max_open`` stores are kept. The
+    cache never closes a store it lets go of, as requests may still be
+    reading it; the map is unmapped once the last of them drops it.
+    """
+
+    def __init__(self, max_open: int = AGGREGATE_STORE_MAX_OPEN):
+        self.max_open = max_open
+        # Path -> (inode, mtime, size) of the mapped file, and its store
+        self._stores: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self, path: str) -> AggregateStore:
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            self.discard([path])
+            raise
+        identity = (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+        with self._lock:
+            cached = self._stores.get(path)
+            if cached is not None and cached[0] == identity:
+                self._stores.move_to_end(path)
+                return cached[1]
+            store = AggregateStore(path)
+            self._stores[path] = (identity, store)
+            while len(self._stores) > self.max_open:
+                self._stores.popitem(last=False)
+        return store
+
+    def discard(self, paths: Iterable[str]) -> None:
+        """Let go of the stores of ``paths``, whose files are being deleted."""
+        with self._lock:
+            for path in paths:
+                self._stores.pop(path, None)
+
+
+aggregate_stores = AggregateStoreCache()
+
+
+def period_totals(
+    store: AggregateStore,
+    granularity: str,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    department: Optional[str] = None,
+) -> List[Tuple[str, str, int]]:
+    """Roll the per-day totals in ``store`` up into ``granularity`` buckets.
+
+    Only the days from ``start`` to ``end`` (inclusive ISO dates, None for
+    no bound) are read, straight off the store's sorted index; buckets cut
+    by either bound hold the days inside the range only.
+    """
+    if granularity not in TIME_BUCKETS:
+        raise ValueError(f"Unknown time bucket: {granularity!r}")
+    low = date.fromisoformat(start).isoformat() if start else ""
+    high = None
+    if end:
+        last = date.fromisoformat(end)
+        high = None if last == date.max else (last + timedelta(days=1)).isoformat()
+    return rollup_daily(store.scan(low, high), granularity, department)
+
+
+def save_aggregate_state(task_id: str, sales: Dict[str, int]) -> None:
+    """Persist ``task_id``'s per-department totals in mergeable form.
+
+    Unlike the rendered CSV, the state keeps exact integer totals in
+    first-seen department order, so later uploads can be merged into it.
+    """
+    AggregateStore.write(state_path_for(task_id), sales)
+
+
+def load_aggregate_state(task_id: str) -> Dict[str, int]:
+    with AggregateStore(state_path_for(task_id)) as store:
+        return store.to_dict()
+
+
+def load_daily_state(task_id: str) -> Dict[str, int]:
+    with AggregateStore(daily_path_for(task_id)) as store:
+        return store.to_dict()
+
+
+RESULT_FORMATS = ("csv", "json", "arrow")
+
+
+def render_result(items: Iterable[Tuple[str, int]], result_format: str) -> bytes:
+    """Render ``(department, total)`` pairs as a downloadable result.
+
+    ``json`` is an object mapping departments to totals, ``arrow`` an Arrow
+    IPC stream with ``Department Name`` and ``Total Sales`` columns; the
+    latter needs pyarrow and totals that fit in an int64.
+    """
+    if result_format == "csv":
+        output = io.StringIO(newline="")
+        create_csv_from_aggregated(dict(items), output)
+        return output.getvalue().encode("utf-8")
+    if result_format == "json":
+        return json.dumps(dict(items)).encode("utf-8")
+    if result_format == "arrow":
+        if pyarrow is None:
+            raise RuntimeError("Arrow results require pyarrow to be installed")
+        items = list(items)
+        departments, totals = zip(*items) if items else ((), ())
+        table = pyarrow.table(
+            {
+                "Department Name": pyarrow.array(departments, pyarrow.string()),
+                "Total Sales": pyarrow.array(totals, pyarrow.int64()),
+            }
+        )
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    raise ValueError(f"Unknown result format: {result_format!r}")
+
+
+def render_table(columns: Dict[str, list], result_format: str) -> bytes:
+    """Render the columns of a grouped result, see :func:`render_result`.
+
+    ``json`` is a list of row objects; ``arrow`` infers each column's type
+    from its values.
+    """
+    if result_format == "csv":
+        output = io.StringIO(newline="")
+        writer = csv.writer(output)
+        writer.writerow(columns)
+        writer.writerows(
+            ["" if value is None else value for value in row]
+            for row in zip(*columns.values())
+        )
+        return output.getvalue().encode("utf-8")
+    if result_format == "json":
+        rows = [dict(zip(columns, row)) for row in zip(*columns.values())]
+        return json.dumps(rows).encode("utf-8")
+    if result_format == "arrow":
+        if pyarrow is None:
+            raise RuntimeError("Arrow results require pyarrow to be installed")
+        try:
+            table = pyarrow.table(columns)
+        except pyarrow.ArrowInvalid as error:
+            raise OverflowError(str(error)) from None
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    raise ValueError(f"Unknown result format: {result_format!r}")
+
+
+def _write_result_csv(task_id: str, write: Callable[[typing.TextIO], None]) -> str:
+    # A gzip copy of the CSV is written alongside so downloads can be served
+    # pre-compressed
+    result_path = result_path_for(task_id)
+    with open(result_path, "w", newline="") as f:
+        write(f)
+    with open(result_path, "rb") as source, gzip.open(
+        compressed_result_path_for(task_id), "wb"
+    ) as compressed:
+        shutil.copyfileobj(source, compressed)
+    return result_path
+
+
+def write_task_result(
+    task_id: str, sales: Dict[str, int], daily: Optional[Dict[str, int]] = None
+) -> str:
+    """Write the result CSV and aggregate state of ``task_id``.
+
+    ``sales`` may also be ``(department, total)`` pairs sorted by name, as
+    merged by a :class:`SpillingAggregator`; both files are then written in
+    a single pass over them. ``daily`` totals (see
+    :func:`aggregate_sales_by_day`) get an aggregate store of their own,
+    whose name index orders them by day.
+    """
+    if isinstance(sales, dict):
+        result_path = _write_result_csv(
+            task_id, lambda f: create_csv_from_aggregated(sales, f)
+        )
+        save_aggregate_state(task_id, sales)
+    else:
+
+        def write(f: typing.TextIO):
+            writer = csv.writer(f)
+            writer.writerow(["Department Name", "Total Sales"])
+
+            def rows():
+                for dept, total in sales:
+                    writer.writerow([dept, total])
+                    yield dept, total
+
+            AggregateStore.write_sorted(state_path_for(task_id), rows())
+
+        result_path = _write_result_csv(task_id, write)
+    if daily is not None:
+        AggregateStore.write(daily_path_for(task_id), daily)
+    return result_path
+
+
+def load_grouped_state(task_id: str) -> Tuple[AggregationPlan, dict]:
+    with open(groups_path_for(task_id)) as f:
+        state = json.load(f)
+    plan = AggregationPlan(state["spec"], state["header"])
+    return plan, plan.load(state["groups"])
+
+
+def write_grouped_result(task_id: str, plan: AggregationPlan, groups: dict) -> str:
+    """Write the result CSV and group state of a task with an aggregation spec.
+
+    The state lets later uploads merge into the groups. ``groups`` may also
+    be ``(key, slots)`` pairs, as merged by a :class:`SpillingAggregator`;
+    both files are written in a single pass over them.
+    """
+    items = groups.items() if isinstance(groups, dict) else groups
+    with open(groups_path_for(task_id), "w") as state:
+        header = json.dumps({"spec": plan.spec, "header": plan.header})
+        state.write(header[:-1] + ', "groups": [')
+
+        def entries():
+            separator = ""
+            for key, slots in items:
+                state.write(separator + json.dumps([plan.dump_key(key), slots]))
+                separator = ", "
+                yield key, slots
+
+        result_path = _write_result_csv(
+            task_id, lambda f: plan.write_rows(entries(), f)
+        )
+        state.write("]}")
+    return result_path
+
+
+def _link_or_copy(source: str, destination: str) -> None:
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class ResultCache:
+    """Content-addressed cache of task results, keyed by the upload's digest.
+
+    An entry holds a task's result CSV and aggregate state plus a JSON
+    sidecar with the progress meta of the task that produced it. Files are
+    hard-linked in and out, so a task's own result survives eviction of the
+    entry it came from. ``hits`` and ``misses`` count lookups made through
+    this instance.
+    """
+
+    META_SUFFIX = ".json"
+    # Suffix of each cached file and the task file it is linked from and to.
+    # The CSV comes last: lookups treat it as the marker of a complete entry.
+    # A task has either an aggregate store or, with an aggregation spec, a
+    # group state, and per-day totals only when bucketed by time, so those
+    # are optional.
+    ARTIFACTS = (
+        (".agg", state_path_for),
+        (".daily", daily_path_for),
+        (".groups", groups_path_for),
+        (".csv.gz", compressed_result_path_for),
+        (".csv", result_path_for),
+    )
+    OPTIONAL = (".agg", ".daily", ".groups")
+
+    def __init__(
+        self,
+        directory: str = RESULT_CACHE_DIR,
+        max_bytes: int = RESULT_CACHE_MAX_BYTES,
+        ttl: float = RESULT_CACHE_TTL_SECONDS,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _path(self, digest: str, suffix: str) -> str:
+        return os.path.join(self.directory, digest + suffix)
+
+    def lookup(self, digest: str, task_id: str) -> Optional[dict]:
+        """Materialize a cached result as the result of ``task_id``.
+
+        Returns the task meta on a hit, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        meta_path = self._path(digest, self.META_SUFFIX)
+        try:
+            if time.time() - os.path.getmtime(meta_path) > self.ttl:
+                raise FileNotFoundError(meta_path)
+            with open(meta_path) as f:
+                meta = json.load(f)
+            for suffix, path_for in self.ARTIFACTS:
+                source = self._path(digest, suffix)
+                if suffix in self.OPTIONAL and not os.path.exists(source):
+                    continue
+                _link_or_copy(source, path_for(task_id))
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        # Mark as recently used on the sidecar, the one file of the entry that
+        # is not linked to tasks' results
+        os.utime(meta_path)
+        self.hits += 1
+        return {**meta, "time_elapsed": 0.0, "result_path": result_path_for(task_id)}
+
+    def store(self, digest: str, task_id: str, meta: dict) -> None:
+        if not self.enabled:
+            return
+        with open(self._path(digest, self.META_SUFFIX), "w") as f:
+            json.dump({k: v for k, v in meta.items() if k != "result_path"}, f)
+        for suffix, path_for in self.ARTIFACTS:
+            if suffix in self.OPTIONAL and not os.path.exists(path_for(task_id)):
+                continue
+            temp_path = f"{self._path(digest, suffix)}.{uuid.uuid4()}.tmp"
+            _link_or_copy(path_for(task_id), temp_path)
+            os.replace(temp_path, self._path(digest, suffix))
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(".csv"):
+                continue
+            digest = name[: -len(".csv")]
+            try:
+                mtime = os.path.getmtime(self._path(digest, self.META_SUFFIX))
+                size = sum(
+                    os.path.getsize(self._path(digest, suffix))
+                    for suffix, _ in self.ARTIFACTS
+                    if suffix not in self.OPTIONAL
+                    or os.path.exists(self._path(digest, suffix))
+                )
+            except FileNotFoundError:
+                continue
+            if now - mtime > self.ttl:
+                self._remove(digest)
+            else:
+                entries.append((mtime, size, digest))
+        total = sum(size for _, size, _ in entries)
+        for _, size, digest in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(digest)
+            total -= size
+
+    def _remove(self, digest: str) -> None:
+        for suffix in [self.META_SUFFIX, *(suffix for suffix, _ in self.ARTIFACTS)]:
+            try:
+                os.remove(self._path(digest, suffix))
+            except FileNotFoundError:
+                pass
+
+
+result_cache = ResultCache()
+
+
+class Checkpoint:
+    """Where a task's pass over its upload stands, saved to resume it.
+
+    :meth:`due` tells a :class:`CsvRowReader` to pause once another
+    ``every_bytes`` have been read or ``every_seconds`` have passed since
+    the last save; the task then saves its partial state with :meth:`save`.
+    A checkpoint is only loaded back for the same upload file.
+    """
+
+    def __init__(
+        self,
+        task_id: str,
+        file_path: str,
+        every_bytes: int = CHECKPOINT_BYTES,
+        every_seconds: float = CHECKPOINT_SECONDS,
+        directory: str = CHECKPOINT_DIR,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.path = os.path.join(directory, f"{task_id}.json")
+        self.file_path = file_path
+        self.every_bytes = every_bytes
+        self.every_seconds = every_seconds
+        self.clock = clock
+        self.last_position = 0
+        self.last_time = clock()
+
+    @classmethod
+    def supports(cls, file_path: str, engine: str) -> bool:
+        """Whether a pass over ``file_path`` with ``engine`` can be resumed.
+
+        Only the python engine stops on exact record boundaries, and a
+        compressed upload cannot be read from the middle.
+        """
+        return (
+            engine == "python"
+            and bool(CHECKPOINT_BYTES or CHECKPOINT_SECONDS)
+            and not file_compression(file_path)
+        )
+
+    def due(self, position: int) -> bool:
+        return bool(
+            self.every_bytes and position - self.last_position >= self.every_bytes
+        ) or bool(
+            self.every_seconds and self.clock() - self.last_time >= self.every_seconds
+        )
+
+    def load(self) -> Optional[dict]:
+        """The saved state, or None if there is none for this upload."""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get("file_path") != self.file_path or state.get(
+            "file_size"
+        ) != os.path.getsize(self.file_path):
+            return None
+        self.last_position = state["position"]
+        return state
+
+    def save(self, state: dict) -> None:
+        """Replace the saved state with ``state``, which holds ``position``."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        state = {
+            **state,
+            "file_path": self.file_path,
+            "file_size": os.path.getsize(self.file_path),
+        }
+        temp_path = f"{self.path}.{uuid.uuid4()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.path)
+        self.last_position = state["position"]
+        self.last_time = self.clock()
+
+    def remove(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+PROFILE_FORMATS = ("pstats", "text")
+
+
+@contextlib.contextmanager
+def profiled(task_id: str, enabled: bool = True):
+    """Run the block under cProfile and save the stats as ``task_id``'s profile.
+
+    Only one profiler can be active per thread, so the block must not start
+    a task that profiles itself, as eager subtasks would.
+    """
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path_for(task_id))
+
+
+def combine_profiles(task_id: str, paths: Iterable[str]) -> None:
+    """Add the profiles saved at ``paths`` to ``task_id``'s, then delete them."""
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return
+    target = profile_path_for(task_id)
+    existing = [target] if os.path.exists(target) else []
+    pstats.Stats(*existing, *paths).dump_stats(target)
+    for path in paths:
+        os.remove(path)
+
+
+def render_profile(path: str, profile_format: str) -> bytes:
+    """The profile saved at ``path``: the pstats file itself, or as text.
+
+    The text lists the ``PROFILE_TOP_FUNCTIONS`` functions with the highest
+    cumulative time.
+    """
+    if profile_format not in PROFILE_FORMATS:
+        raise ValueError(f"Unknown profile format: {profile_format!r}")
+    if profile_format == "pstats":
+        with open(path, "rb") as f:
+            return f.read()
+    output = io.StringIO()
+    stats = pstats.Stats(path, stream=output)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP_FUNCTIONS)
+    return output.getvalue().encode()
+
+
+def add_phases(phases: Dict[str, float], other: Dict[str, float]) -> Dict[str, float]:
+    for phase, seconds in other.items():
+        phases[phase] = phases.get(phase, 0.0) + seconds
+    return phases
+
+
+def plan_chunks(file_path: str, chunks: Optional[int] = None) -> int:
+    if file_compression(file_path):
+        return 1  # A compressed stream can only be read from the start
+    if chunks is None:
+        size = os.path.getsize(file_path)
+        chunks = -(-size // PARALLEL_CHUNK_BYTES)
+    return max(1, min(chunks, PARALLEL_MAX_CHUNKS))
+
+
+class ProgressThrottle:
+    """Decide which progress checks are worth a write to the result backend.
+
+    Writes are spaced at least ``1 / max_per_second`` seconds apart, unless
+    ``max_per_second`` is 0, and happen
+    once another ``percent_step`` percent of ``total_bytes`` has been consumed,
+    or after ``heartbeat`` seconds so slow inputs still show signs of life.
+    """
+
+    def __init__(
+        self,
+        total_bytes: int = 0,
+        max_per_second: float = PROGRESS_MAX_UPDATES_PER_SECOND,
+        percent_step: float = PROGRESS_PERCENT_STEP,
+        heartbeat: float = PROGRESS_HEARTBEAT_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.total_bytes = total_bytes
+        self.min_interval = 1.0 / max_per_second if max_per_second > 0 else 0.0
+        self.percent_step = percent_step
+        self.heartbeat = heartbeat
+        self.clock = clock
+        self.last_time = clock()
+        self.last_bytes = 0
+
+    def ready(self, bytes_done: int) -> bool:
+        now = self.clock()
+        elapsed = now - self.last_time
+        if elapsed < self.min_interval:
+            return False
+        stepped = (
+            self.total_bytes > 0
+            and (bytes_done - self.last_bytes) * 100.0
+            >= self.percent_step * self.total_bytes
+        )
+        if not stepped and elapsed < self.heartbeat:
+            return False
+        self.last_time = now
+        self.last_bytes = bytes_done
+        return True
+
+
+def make_progress_reporter(
+    task,
+    start_time: float,
+    progress_dict: dict,
+    reader=None,
+    sketches: Optional[SalesSketches] = None,
+    phases: Optional[Dict[str, float]] = None,
+):
+    """Build the ``progress_callback`` a task hands to :func:`aggregate_sales`.
+
+    ``reader`` is the :class:`CsvRowReader` or :class:`ColumnarSalesReader`
+    being aggregated; its ``position`` gives the bytes consumed. Every call
+    refreshes ``progress_dict``; only calls let through by a
+    :class:`ProgressThrottle` are written with ``update_state``. The final
+    call is never written, the task's return value records it instead.
+    ``sketches`` are serialised into ``progress_dict`` with every write and
+    the final call. The time spent on both is added to ``phases["progress"]``.
+    Every ``CANCEL_CHECK_SECONDS``, whether or not a write is due, the task
+    checks whether it was cancelled, and raises :class:`TaskCancelled` if so.
+    """
+    offset = reader.start if reader else 0
+    total_bytes = 0
+    if reader:
+        end = reader.end
+        if end is None:
+            end = os.path.getsize(reader.file_path)
+        total_bytes = end - offset
+    throttle = ProgressThrottle(total_bytes)
+    progress_dict["total_bytes"] = total_bytes
+    cancel_checked = time.monotonic()
 
     def report_progress(current: int, departments: int, state: str = "PENDING"):
+        nonlocal cancel_checked
         time_elapsed = time.time() - start_time
+        bytes_processed = reader.position - offset if reader else 0
         progress_dict.update(
             {
                 "lines_processed": current,
                 "departments": departments,
                 "time_elapsed": time_elapsed,
+                "bytes_processed": bytes_processed,
+                "rows_per_second": current / time_elapsed if time_elapsed else 0.0,
+                "bytes_per_second": (
+                    bytes_processed / time_elapsed if time_elapsed else 0.0
+                ),
             }
         )
-        self.update_state(
-            state=state,
-            meta=progress_dict,
+        if state == "PENDING":
+            if time.monotonic() - cancel_checked >= CANCEL_CHECK_SECONDS:
+                if scheduler().cancelled(task.request.id):
+                    raise TaskCancelled(task.request.id)
+                cancel_checked = time.monotonic()
+            if not throttle.ready(bytes_processed):
+                return
+        started = time.perf_counter()
+        if sketches is not None:
+            progress_dict["sketches"] = sketches.to_meta()
+        if state == "PENDING":
+            task.update_state(
+                state=state,
+                meta=progress_dict,
+            )
+        if phases is not None:
+            add_phases(phases, {"progress": time.perf_counter() - started})
+
+    return report_progress
+
+
+def task_metas(task_ids: List[str]) -> List[Tuple[str, object]]:
+    """``(state, meta)`` of each of ``task_ids``, as :class:`AsyncResult` has them.
+
+    With the Redis result backend they are all read with one MGET.
+    """
+    backend = celery_app.backend
+    if not isinstance(backend, RedisBackend):
+        results = [AsyncResult(task_id, app=celery_app) for task_id in task_ids]
+        return [(result.state, result.info) for result in results]
+    if not task_ids:
+        return []
+    payloads = backend.mget([backend.get_key_for_task(task_id) for task_id in task_ids])
+    metas = []
+    for payload in payloads:
+        if payload is None:
+            metas.append(("PENDING", None))
+        else:
+            meta = backend.decode_result(payload)
+            metas.append((meta["status"], meta["result"]))
+    return metas
+
+
+def chunk_progress(meta: dict, chunk_infos: Optional[Dict[str, object]] = None) -> dict:
+    """Fold the progress of a parallel job's range subtasks into its meta.
+
+    Lines and bytes are summed across ranges; departments can only be known
+    after the merge, so the largest per-range count is reported as a lower
+    bound. Sketches published by the ranges are merged.
+
+    The ranges' metas are read unless ``chunk_infos`` already maps their ids
+    to them.
+    """
+    lines_processed = 0
+    bytes_processed = 0
+    departments = 0
+    sketches = None
+    chunk_ids = meta.get("chunk_task_ids", [])
+    if chunk_infos is None:
+        chunk_infos = {
+            chunk_id: info
+            for chunk_id, (_, info) in zip(chunk_ids, task_metas(chunk_ids))
+        }
+    for chunk_id in chunk_ids:
+        info = chunk_infos.get(chunk_id)
+        if isinstance(info, dict):
+            lines_processed += info.get("lines_processed", 0)
+            bytes_processed += info.get("bytes_processed", 0)
+            departments = max(departments, info.get("departments", 0))
+            if "sketches" in info:
+                sketches = merge_sketches(sketches, info["sketches"])
+    time_elapsed = time.time() - meta.get("start_time", time.time())
+    if sketches is not None:
+        meta = {**meta, "sketches": sketches.to_meta()}
+    return {
+        **meta,
+        "lines_processed": lines_processed,
+        "departments": departments,
+        "time_elapsed": time_elapsed,
+        "bytes_processed": bytes_processed,
+        "rows_per_second": lines_processed / time_elapsed if time_elapsed else 0.0,
+        "bytes_per_second": bytes_processed / time_elapsed if time_elapsed else 0.0,
+    }
+
+
+def merge_sketches(
+    sketches: Optional[SalesSketches], state: Optional[dict]
+) -> Optional[SalesSketches]:
+    """Merge serialised sketches ``state`` into ``sketches``, which may be None."""
+    if state is None:
+        return sketches
+    other = SalesSketches.from_meta(state)
+    if sketches is None:
+        return other
+    sketches.merge(other)
+    return sketches
+
+
+def base_sketches(base_task_id: Optional[str]) -> SalesSketches:
+    """Sketches to start from: those of ``base_task_id``'s result, if any."""
+    info = AsyncResult(base_task_id, app=celery_app).info if base_task_id else None
+    state = info.get("sketches") if isinstance(info, dict) else None
+    return merge_sketches(None, state) or SalesSketches()
+
+
+def task_headers(queued: bool = True) -> dict:
+    """Headers to send a task with: the current trace and when it was queued.
+
+    Leave ``queued`` off for tasks that wait on others rather than on a
+    worker, such as a chord's callback.
+    """
+    headers = telemetry.inject()
+    if queued:
+        headers["enqueued_at"] = time.time()
+    return headers
+
+
+_task_spans = defaultdict(list)
+
+
+@task_prerun.connect
+def _start_task_span(task_id=None, task=None, **kwargs):
+    # Eager tasks run their subtasks inline, sometimes under the same id
+    _task_spans[task_id].append(
+        telemetry.attach_span(task.name, telemetry.task_carrier(task.request))
+    )
+    enqueued_at = telemetry.task_header(task.request, "enqueued_at")
+    if enqueued_at is not None:
+        telemetry.observe_stage("queue_wait", max(0.0, time.time() - enqueued_at))
+
+
+@task_postrun.connect
+def _end_task_span(task_id=None, **kwargs):
+    spans = _task_spans[task_id]
+    telemetry.detach_span(spans.pop())
+    if not spans:
+        del _task_spans[task_id]
+
+
+@worker_init.connect
+def _serve_worker_metrics(**kwargs):
+    telemetry.serve_metrics(CELERY_METRICS_PORT)
+
+
+@worker_process_shutdown.connect
+def _forget_worker_process(pid=None, **kwargs):
+    telemetry.process_exited(pid)
+
+
+@functools.cache
+def scheduler() -> Scheduler:
+    """Queue positions, tenant slots and cancellations, kept in the result
+    backend's Redis."""
+    backend = celery_app.backend
+    client = backend.client if isinstance(backend, RedisBackend) else None
+    return Scheduler((FAST_QUEUE, BULK_QUEUE), client, SCHEDULER_ENTRY_TTL_SECONDS)
+
+
+def upload_queue(file_path: str) -> str:
+    """Queue for the upload at ``file_path``, by its size on disk."""
+    if os.path.getsize(file_path) <= FAST_QUEUE_MAX_BYTES:
+        return FAST_QUEUE
+    return BULK_QUEUE
+
+
+@after_task_publish.connect
+def _record_queued_task(headers=None, routing_key=None, **kwargs):
+    if headers and "id" in headers:
+        scheduler().queued(routing_key, headers["id"])
+
+
+@task_prerun.connect
+def _record_started_task(task_id=None, task=None, **kwargs):
+    delivery_info = task.request.delivery_info
+    if delivery_info and not task.request.is_eager:
+        scheduler().started(delivery_info.get("routing_key"), task_id)
+
+
+@task_postrun.connect
+def _record_finished_task(task=None, state=None, **kwargs):
+    delivery_info = task.request.delivery_info
+    # A retry goes back to the queue rather than making room in it
+    if delivery_info and not task.request.is_eager and state != "RETRY":
+        scheduler().finished(delivery_info.get("routing_key"))
+
+
+@celery_app.task
+def release_tenant_slot_task(
+    tenant: str, job_id: str, file_path: Optional[str] = None
+) -> None:
+    """Free the slot of a parallel job whose ranges failed.
+
+    The upload at ``file_path`` is deleted if the job was cancelled; its
+    ranges leave it, as they share it.
+    """
+    scheduler().release(tenant, job_id)
+    if file_path and scheduler().cancelled(job_id):
+        discard_task_files(job_id, file_path)
+
+
+class TaskCancelled(Exception):
+    """The task was cancelled with :func:`cancel_task`."""
+
+
+def cancel_task(task_id: str, meta=None) -> None:
+    """Cancel the job ``task_id``, whose progress ``meta`` lists its ranges.
+
+    Its tasks are revoked, so queued ones never start, and flagged, so
+    running ones raise :class:`TaskCancelled` at their next progress check.
+    """
+    task_ids = [task_id]
+    if isinstance(meta, dict):
+        task_ids.extend(meta.get("chunk_task_ids", []))
+    scheduler().cancel(task_ids)
+    if not celery_app.conf.task_always_eager:
+        celery_app.control.revoke(task_ids)
+
+
+def discard_task_files(task_id: str, file_path: Optional[str] = None) -> None:
+    """Delete the upload at ``file_path`` and whatever ``task_id`` wrote."""
+    paths = [
+        result_path_for(task_id),
+        compressed_result_path_for(task_id),
+        state_path_for(task_id),
+        daily_path_for(task_id),
+        groups_path_for(task_id),
+        profile_path_for(task_id),
+    ]
+    aggregate_stores.discard(paths)
+    for path in [file_path, *paths] if file_path else paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def abandon_task(task, file_path: Optional[str], meta: Optional[dict] = None):
+    """Clean up after the cancelled ``task`` and record it as CANCELLED.
+
+    ``meta`` is its last progress. Raises :class:`Ignore`, so the state
+    sticks rather than being replaced by a result.
+    """
+    discard_task_files(task.request.id, file_path)
+    meta = {
+        key: value
+        for key, value in (meta or {}).items()
+        if key not in ("result_path", "profile_path")
+    }
+    task.update_state(state="CANCELLED", meta=meta)
+    raise Ignore()
+
+
+def celery_queue_depths() -> Dict[str, int]:
+    """Messages waiting in each task queue, read from the broker."""
+    depths = {}
+    with celery_app.connection_for_read() as connection:
+        try:
+            # Metrics are read often; do not retry an unreachable broker
+            connection.ensure_connection(max_retries=0)
+            channel = connection.default_channel
+            for queue in celery_app.amqp.queues:
+                try:
+                    declared = channel.queue_declare(queue, passive=True)
+                    depths[queue] = declared.message_count
+                except connection.channel_errors:
+                    depths[queue] = 0  # Redis drops queues once they are empty
+        except (OperationalError, *connection.connection_errors):
+            return {}  # Report nothing rather than empty queues
+    return depths
+
+
+def record_aggregation(
+    reader, engine: str, seconds: float, progress: dict, phases: Dict[str, float]
+) -> None:
+    """Report the parse and aggregate stages of a pass over ``reader``.
+
+    Both are added to ``phases``, as :func:`aggregation_phases` splits them.
+    """
+    parse_seconds = reader.parse_seconds
+    telemetry.observe_stage("parse", parse_seconds, progress.get("bytes_processed", 0))
+    telemetry.observe_stage("aggregate", seconds - parse_seconds)
+    telemetry.ROWS.labels(engine).inc(progress.get("lines_processed", 0))
+    add_phases(phases, aggregation_phases(reader, seconds, phases))
+
+
+def aggregation_phases(
+    reader, seconds: float, phases: Dict[str, float]
+) -> Dict[str, float]:
+    """Split ``seconds`` spent on a pass over ``reader`` into phases.
+
+    The aggregate phase leaves out the progress writes and checkpoints
+    ``phases`` already hold.
+    """
+    parse_seconds = reader.parse_seconds
+    aggregate_seconds = (
+        seconds
+        - parse_seconds
+        - phases.get("progress", 0.0)
+        - phases.get("checkpoint", 0.0)
+    )
+    return {"parse": parse_seconds, "aggregate": aggregate_seconds}
+
+
+def fold_base_state(
+    spiller: SpillingAggregator,
+    groups: dict,
+    base_task_id: Optional[str],
+    plan: Optional[AggregationPlan] = None,
+) -> None:
+    """Start ``groups`` from the result of ``base_task_id``, if any."""
+    if not base_task_id:
+        return
+    if plan:
+        spiller.fold(groups, load_grouped_state(base_task_id)[1].items())
+        return
+    with AggregateStore(state_path_for(base_task_id)) as store:
+        spiller.fold(groups, store.items())
+
+
+@celery_app.task(bind=True)
+def aggregate_range_task(
+    self,
+    file_path: str,
+    start: int,
+    end: int,
+    engine: str = "python",
+    spec: Optional[dict] = None,
+    time_buckets: bool = False,
+    sketches: bool = False,
+    profile: bool = False,
+) -> dict:
+    if scheduler().cancelled(self.request.id):
+        # Before opening the upload, which the job may have deleted already
+        raise TaskCancelled(self.request.id)
+    reader = open_sales_reader(file_path, start, end, engine)
+    progress_dict = {"lines_processed": 0, "departments": 0, "time_elapsed": 0.0}
+    phases = {}
+    sales_sketches = SalesSketches() if sketches else None
+    report_progress = make_progress_reporter(
+        self, time.time(), progress_dict, reader, sales_sketches, phases
+    )
+    plan = aggregation_plan(file_path, spec, engine) if spec else None
+    spiller = SpillingAggregator(combine=plan.combine if plan else operator.add)
+    groups = {} if plan else defaultdict(int)
+    watch = spiller.watch(groups, report_progress)
+    partial = {"phases": phases}
+    started = time.perf_counter()
+    try:
+        with profiled(self.request.id, profile):
+            if plan:
+                plan.aggregate(reader, groups=groups, progress_callback=watch)
+            else:
+                if time_buckets:
+                    partial["daily"] = defaultdict(int)
+                aggregate_reader(
+                    reader,
+                    progress_callback=watch,
+                    sales=groups,
+                    daily=partial.get("daily"),
+                    sketches=sales_sketches,
+                )
+    except TaskCancelled:
+        # Failing the range fails the chord, whose error callback frees the
+        # job's tenant slot and deletes the upload the ranges share
+        spiller.close()
+        discard_task_files(self.request.id)
+        raise
+    seconds = time.perf_counter() - started
+    record_aggregation(reader, engine, seconds, progress_dict, phases)
+    if profile:
+        partial["profile_path"] = profile_path_for(self.request.id)
+    if spiller.spilled:
+        # Too large for the result backend: the merge reads the spilled runs
+        # instead, so they are left for it to delete
+        spiller.spill(groups)
+        partial["runs"] = spiller.runs
+    if plan:
+        partial["groups"] = plan.dump(groups)
+    else:
+        partial["sales"] = groups
+    return {**partial, **progress_dict}
+
+
+@celery_app.task(bind=True)
+def merge_partials_task(
+    self,
+    partials: List[dict],
+    start_time: float,
+    cache_key: Optional[str] = None,
+    base_task_id: Optional[str] = None,
+    spec: Optional[dict] = None,
+    header: Optional[List[str]] = None,
+    time_buckets: bool = False,
+    sketches: bool = False,
+    profile: bool = False,
+    tenant: str = "",
+    file_path: Optional[str] = None,
+) -> dict:
+    plan = AggregationPlan(spec, header) if spec else None
+    spiller = SpillingAggregator(combine=plan.combine if plan else operator.add)
+    groups = {} if plan else defaultdict(int)
+    # Phases of the ranges add up the time of every worker that ran one
+    phases = {}
+    for partial in partials:
+        add_phases(phases, partial.get("phases", {}))
+    try:
+        if scheduler().cancelled(self.request.id):
+            for partial in partials:
+                spiller.adopt(partial.get("runs", []))
+            abandon_task(self, file_path)
+        with profiled(self.request.id, profile):
+            with telemetry.timed("merge", phases):
+                fold_base_state(spiller, groups, base_task_id, plan)
+                for partial in partials:
+                    if plan:
+                        spiller.fold(groups, plan.load(partial["groups"]).items())
+                    else:
+                        spiller.fold(groups, partial["sales"].items())
+                    spiller.adopt(partial.get("runs", []))
+                daily = None
+                if time_buckets:
+                    base = [load_daily_state(base_task_id)] if base_task_id else []
+                    daily = merge_partial_sales(
+                        base + [partial["daily"] for partial in partials]
+                    )
+            # Spilled groups are merged from disk as the result is written
+            with telemetry.timed("write", phases):
+                merged = spiller.merged(groups)
+                if plan:
+                    result_path = write_grouped_result(self.request.id, plan, merged)
+                else:
+                    result_path = write_task_result(self.request.id, merged, daily)
+    finally:
+        spiller.close()
+        scheduler().release(tenant, self.request.id)
+    time_elapsed = time.time() - start_time
+    lines_processed = sum(partial["lines_processed"] for partial in partials)
+    bytes_processed = sum(partial["bytes_processed"] for partial in partials)
+    meta = {
+        "lines_processed": lines_processed,
+        "departments": spiller.count if spiller.spilled else len(groups),
+        "time_elapsed": time_elapsed,
+        "bytes_processed": bytes_processed,
+        "total_bytes": sum(partial["total_bytes"] for partial in partials),
+        "rows_per_second": lines_processed / time_elapsed if time_elapsed else 0.0,
+        "bytes_per_second": bytes_processed / time_elapsed if time_elapsed else 0.0,
+        "result_path": result_path,
+        "phases": phases,
+    }
+    if profile:
+        combine_profiles(
+            self.request.id, [partial["profile_path"] for partial in partials]
         )
+        meta["profile_path"] = profile_path_for(self.request.id)
+    if base_task_id:
+        meta["base_task_id"] = base_task_id
+    if spec:
+        meta["spec"] = plan.spec
+    if time_buckets:
+        meta["time_buckets"] = True
+    if sketches:
+        sales_sketches = base_sketches(base_task_id)
+        for partial in partials:
+            merge_sketches(sales_sketches, partial["sketches"])
+        meta["sketches"] = sales_sketches.to_meta()
+    if cache_key:
+        result_cache.store(cache_key, self.request.id, meta)
+    return meta
+
+
+# Jobs over their tenant's cap retry until a slot frees up
+@celery_app.task(bind=True, max_retries=None)
+def process_csv_task(
+    self,
+    file_path: str,
+    chunks: Optional[int] = None,
+    engine: str = "python",
+    cache_key: Optional[str] = None,
+    base_task_id: Optional[str] = None,
+    spec: Optional[dict] = None,
+    time_buckets: bool = False,
+    sketches: bool = False,
+    profile: bool = False,
+    tenant: str = "",
+) -> dict:
+    """Aggregate the upload at ``file_path`` into a result CSV.
+
+    With ``base_task_id`` the upload is a delta: its totals are merged into
+    the stored aggregate state of that task instead of starting from zero.
+    With an aggregation ``spec`` (see :func:`normalize_spec`) rows are
+    grouped and aggregated as it describes instead of as sales records.
+    With ``time_buckets`` sales are also totalled per department and day.
+    With ``sketches`` the top departments and the number of departments are
+    estimated as rows are read and published with the task's progress.
+    With ``profile`` the aggregation runs under cProfile, whose stats are
+    saved at :func:`profile_path_for` the task. Either way the result's
+    ``phases`` break its time down into parsing, aggregating, progress
+    writes, checkpoints, merging and writing the result.
+
+    A serial pass over an uncompressed upload with the python engine saves a
+    :class:`Checkpoint` as it goes. When the task is delivered again after
+    its worker died, it resumes from the last one instead of the first row.
+
+    The job holds one of ``tenant``'s slots until its result is written.
+    While the tenant already runs ``TENANT_MAX_RUNNING`` jobs, it is retried
+    from the end of its queue instead. Tasks run eagerly, such as small
+    uploads aggregated by the gRPC server, take no worker and no slot.
+
+    A cancelled job stops at its next progress check; its upload and partial
+    results are deleted and it is left in the CANCELLED state.
+    """
+    if scheduler().cancelled(self.request.id):
+        abandon_task(self, file_path)
+    if not self.request.is_eager and not scheduler().acquire(
+        tenant, self.request.id, TENANT_MAX_RUNNING
+    ):
+        raise self.retry(countdown=TENANT_RETRY_SECONDS)
+    handed_off = False
+    progress_dict = {}
+    try:
+        start_time = time.time()
+        if not self.request.is_eager:
+            # Out of its queue now, the job is known by its meta until it reports
+            self.update_state(
+                state="PENDING",
+                meta={"lines_processed": 0, "departments": 0, "time_elapsed": 0.0},
+            )
+        check_time_buckets(time_buckets, engine, spec)
+        check_sketches(sketches, spec)
+        plan = aggregation_plan(file_path, spec, engine) if spec else None
+        ranges = split_line_ranges(file_path, plan_chunks(file_path, chunks))
+        if len(ranges) > 1:
+            queue = upload_queue(file_path)
+            # Fan the ranges out to subtasks; the merge callback takes over this
+            # task's id so clients keep polling the id they were given.
+            subtasks = [
+                aggregate_range_task.s(
+                    file_path, start, end, engine, spec, time_buckets, sketches, profile
+                ).set(task_id=str(uuid.uuid4()), headers=task_headers(), queue=queue)
+                for start, end in ranges
+            ]
+            merge_args = (
+                cache_key,
+                base_task_id,
+                spec,
+                plan.header if plan else None,
+                time_buckets,
+                sketches,
+                profile,
+                tenant,
+            )
+            self.update_state(
+                state="PENDING",
+                meta={
+                    "lines_processed": 0,
+                    "departments": 0,
+                    "time_elapsed": 0.0,
+                    "total_bytes": ranges[-1][1],
+                    "start_time": start_time,
+                    "chunk_task_ids": [subtask.id for subtask in subtasks],
+                },
+            )
+            if self.request.is_eager:
+                # Eager mode (tests, benchmarks) cannot replace a task with a
+                # chord, so run the ranges and the merge inline instead
+                partials = [
+                    subtask.apply().get(disable_sync_subtasks=False)
+                    for subtask in subtasks
+                ]
+                return merge_partials_task.apply(
+                    (partials, start_time, *merge_args),
+                    {"file_path": file_path},
+                    task_id=self.request.id,
+                ).get(disable_sync_subtasks=False)
+            merge = merge_partials_task.s(
+                start_time, *merge_args, file_path=file_path
+            ).set(headers=task_headers(queued=False), queue=queue)
+            # The merge frees the slot, or this if a range fails
+            merge.on_error(
+                release_tenant_slot_task.si(tenant, self.request.id, file_path)
+            )
+            handed_off = True
+            return self.replace(chord(subtasks, merge))
+
+        reader = open_sales_reader(file_path, engine=engine)
+        checkpoint = None
+        resumed = None
+        if Checkpoint.supports(file_path, engine):
+            checkpoint = Checkpoint(self.request.id, file_path)
+            resumed = checkpoint.load()
+        if resumed:
+            # Delivered again after a worker died: carry on where it stopped
+            start_time = resumed["start_time"]
+            reader.position = resumed["position"]
+        result_path = result_path_for(self.request.id)
+        progress_dict = {
+            "lines_processed": 0,
+            "departments": 0,
+            "time_elapsed": 0.0,
+            "result_path": result_path,
+        }
+        if base_task_id:
+            progress_dict["base_task_id"] = base_task_id
+        if plan:
+            progress_dict["spec"] = plan.spec
+        if time_buckets:
+            progress_dict["time_buckets"] = True
+        phases = {}
+        # Phases of the runs before a resume
+        earlier_phases = resumed["phases"] if resumed else {}
+        lines_done = resumed["lines_processed"] if resumed else 0
+        if resumed and sketches:
+            sales_sketches = SalesSketches.from_meta(resumed["sketches"])
+        else:
+            sales_sketches = base_sketches(base_task_id) if sketches else None
+        report_progress = make_progress_reporter(
+            self, start_time, progress_dict, reader, sales_sketches, phases
+        )
+
+        def report_pass_progress(current, departments, state="PENDING"):
+            # Each pass between checkpoints counts its rows from 0
+            report_progress(lines_done + current, departments, state)
+
+        spiller = SpillingAggregator(combine=plan.combine if plan else operator.add)
+        groups = {} if plan else defaultdict(int)
+        daily = None
+        if time_buckets and not resumed:
+            daily = load_daily_state(base_task_id) if base_task_id else defaultdict(int)
+        watch = spiller.watch(groups, report_pass_progress)
+        try:
+            with profiled(self.request.id, profile):
+                if resumed:
+                    groups.update(
+                        plan.load(resumed["groups"]) if plan else resumed["groups"]
+                    )
+                    if time_buckets:
+                        daily = defaultdict(int, resumed["daily"])
+                    spiller.adopt(resumed["runs"])
+                elif base_task_id:
+                    with telemetry.timed("merge", phases):
+                        fold_base_state(spiller, groups, base_task_id, plan)
+                if checkpoint:
+                    reader.pause = checkpoint.due
+                started = time.perf_counter()
+                while True:
+                    if plan:
+                        plan.aggregate(reader, groups=groups, progress_callback=watch)
+                    else:
+                        aggregate_reader(
+                            reader,
+                            progress_callback=watch,
+                            sales=groups,
+                            daily=daily,
+                            sketches=sales_sketches,
+                        )
+                    lines_done = progress_dict["lines_processed"]
+                    if not reader.paused:
+                        break
+                    with telemetry.timed("checkpoint", phases):
+                        seconds = time.perf_counter() - started
+                        checkpoint.save(
+                            {
+                                "position": reader.position,
+                                "start_time": start_time,
+                                "lines_processed": lines_done,
+                                "groups": plan.dump(groups) if plan else groups,
+                                "daily": daily,
+                                "sketches": (
+                                    sales_sketches.to_meta() if sales_sketches else None
+                                ),
+                                "runs": spiller.runs,
+                                "phases": add_phases(
+                                    add_phases(dict(earlier_phases), phases),
+                                    aggregation_phases(reader, seconds, phases),
+                                ),
+                            }
+                        )
+                seconds = time.perf_counter() - started
+                record_aggregation(reader, engine, seconds, progress_dict, phases)
+                with telemetry.timed("write", phases):
+                    if plan:
+                        write_grouped_result(
+                            self.request.id, plan, spiller.merged(groups)
+                        )
+                    else:
+                        write_task_result(
+                            self.request.id, spiller.merged(groups), daily
+                        )
+        finally:
+            spiller.close()
+            if checkpoint:
+                checkpoint.remove()
+        add_phases(phases, earlier_phases)
+        if spiller.spilled:
+            progress_dict["departments"] = spiller.count
+        progress_dict["phases"] = phases
+        if profile:
+            progress_dict["profile_path"] = profile_path_for(self.request.id)
+        if cache_key:
+            result_cache.store(cache_key, self.request.id, progress_dict)
+
+        return progress_dict
+    except TaskCancelled:
+        abandon_task(self, file_path, progress_dict)
+    finally:
+        if not handed_off:
+            scheduler().release(tenant, self.request.id)
 
-    sales = aggregate_sales(rows, progress_callback=report_progress)
-    with open(result_path, "w", newline="") as f:
-        create_csv_from_aggregated(sales, f)
 
-    return progress_dict
+@task_revoked.connect
+def _discard_revoked_upload(request=None, sender=None, **kwargs):
+    # A task revoked before it started leaves its upload behind. Ranges share
+    # theirs, which the job's merge or error callback deletes.
+    if sender is None:
+        return
+    if sender.name == process_csv_task.name and request.args:
+        discard_task_files(request.id, request.args[0])
+    elif sender.name == merge_partials_task.name:
+        discard_task_files(request.id, (request.kwargs or {}).get("file_path"))
+    elif sender.name == aggregate_range_task.name:
+        discard_task_files(request.id)
 
 
 # Auto-discover tasks from all modules
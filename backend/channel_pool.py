@@ -0,0 +1,277 @@
+"""Client-side load balancing of the gateway's calls over gRPC servers.
+
+The gateway keeps a pool of channels, ``channels_per_address`` to each
+server address, each with a connection of its own, so uploads are not all
+multiplexed over one HTTP/2 connection. A target written ``dns:///name:port``
+stands for every address the name resolves to, and is resolved again with
+each health check so servers can come and go.
+
+Each call goes to a healthy channel: the next one in turn with
+``round_robin``, or the one with the fewest calls in flight with
+``least_request``. A channel is unhealthy while it cannot connect, which a
+health check notices within ``health_interval`` seconds and a call failing
+with UNAVAILABLE notices at once. Calls that only read are retried on
+another server when theirs is unavailable, streams only until their first
+message.
+"""
+
+import asyncio
+import functools
+import itertools
+import logging
+import socket
+from typing import Dict, Iterable, List, Optional
+
+import grpc
+
+import csv_processor_pb2
+import csv_processor_pb2_grpc
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("least_request", "round_robin")
+# RPCs without side effects, safe to send again to another server
+IDEMPOTENT_METHODS = frozenset(
+    {
+        "GetProcessingResult",
+        "GetProcessingResults",
+        "DownloadResult",
+        "DownloadProfile",
+        "GetDepartmentTotal",
+        "GetPeriodTotals",
+    }
+)
+_METHODS = csv_processor_pb2.DESCRIPTOR.services_by_name["CsvProcessor"].methods_by_name
+
+
+class PooledChannel:
+    def __init__(self, address: str, channel: grpc.aio.Channel):
+        self.address = address
+        self.channel = channel
+        self.stub = csv_processor_pb2_grpc.CsvProcessorStub(channel)
+        self.in_flight = 0
+        # Until a health check has seen it connect
+        self.healthy = False
+
+
+class ChannelPool:
+    """Channels to the gRPC servers at ``targets``, and the calls over them.
+
+    :attr:`stub` stands in for a ``CsvProcessorStub``, sending each call
+    through the pool.
+    """
+
+    def __init__(
+        self,
+        targets: Iterable[str],
+        channels_per_address: int = 1,
+        policy: str = "least_request",
+        retries: int = 2,
+        health_interval: float = 5,
+        compression: Optional[grpc.Compression] = None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown balancing policy: {policy}")
+        self.targets = [target.strip() for target in targets if target.strip()]
+        self.channels_per_address = max(1, channels_per_address)
+        self.policy = policy
+        self.retries = retries
+        self.health_interval = health_interval
+        self.compression = compression
+        self.channels: List[PooledChannel] = []
+        self.stub = BalancedStub(self)
+        self._turn = itertools.count()
+        self._resolved: Dict[str, List[str]] = {}
+        self._health_check = None
+        self._closing = set()
+
+    async def start(self) -> None:
+        await self._refresh()
+        await self._probe_all()
+        self._health_check = asyncio.create_task(self._check_health())
+
+    async def close(self) -> None:
+        if self._health_check is not None:
+            self._health_check.cancel()
+        await asyncio.gather(*(pooled.channel.close() for pooled in self.channels))
+        self.channels = []
+
+    async def _addresses(self) -> List[str]:
+        addresses = []
+        for target in self.targets:
+            if not target.startswith("dns:///"):
+                resolved = [target]
+            else:
+                try:
+                    resolved = await self._resolve(target[len("dns:///") :])
+                except OSError as error:
+                    # Keep the servers it resolved to until it resolves again
+                    logger.warning("Could not resolve %s: %s", target, error)
+                    resolved = self._resolved.get(target, [])
+                self._resolved[target] = resolved
+            addresses.extend(
+                address for address in resolved if address not in addresses
+            )
+        return addresses
+
+    @staticmethod
+    async def _resolve(host_port: str) -> List[str]:
+        host, _, port = host_port.rpartition(":")
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, port, type=socket.SOCK_STREAM
+        )
+        addresses = []
+        for family, _, _, _, sockaddr in infos:
+            ip = sockaddr[0]
+            address = f"[{ip}]:{port}" if family == socket.AF_INET6 else f"{ip}:{port}"
+            if address not in addresses:
+                addresses.append(address)
+        return addresses
+
+    async def _refresh(self) -> None:
+        """Open channels to new addresses and close those to vanished ones."""
+        addresses = await self._addresses()
+        known = {pooled.address for pooled in self.channels}
+        kept = [pooled for pooled in self.channels if pooled.address in addresses]
+        for address in addresses:
+            if address in known:
+                continue
+            for _ in range(self.channels_per_address):
+                channel = grpc.aio.insecure_channel(
+                    address,
+                    # A connection per channel rather than one shared per address
+                    options=[("grpc.use_local_subchannel_pool", 1)],
+                    compression=self.compression,
+                )
+                kept.append(PooledChannel(address, channel))
+        for pooled in self.channels:
+            if pooled.address not in addresses:
+                if pooled.healthy:
+                    telemetry.POOL_HEALTHY.labels(pooled.address).dec()
+                # Let its calls finish, up to a health interval
+                closing = asyncio.create_task(
+                    pooled.channel.close(self.health_interval)
+                )
+                self._closing.add(closing)
+                closing.add_done_callback(self._closing.discard)
+        self.channels = kept
+
+    async def _check_health(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            try:
+                await self._refresh()
+                await self._probe_all()
+            except Exception as error:  # Keep checking whatever happens
+                logger.warning("Health check of the gRPC pool failed: %r", error)
+
+    async def _probe_all(self) -> None:
+        await asyncio.gather(*(self._probe(pooled) for pooled in self.channels))
+
+    async def _probe(self, pooled: PooledChannel) -> None:
+        try:
+            await asyncio.wait_for(pooled.channel.channel_ready(), self.health_interval)
+        except asyncio.TimeoutError:
+            self._set_healthy(pooled, False)
+        else:
+            self._set_healthy(pooled, True)
+
+    def _set_healthy(self, pooled: PooledChannel, healthy: bool) -> None:
+        if pooled.healthy != healthy:
+            pooled.healthy = healthy
+            telemetry.POOL_HEALTHY.labels(pooled.address).inc(1 if healthy else -1)
+
+    def pick(self, avoid: Iterable[str] = ()) -> PooledChannel:
+        """A channel for the next call, away from the ``avoid`` addresses.
+
+        When no channel is healthy any is used, since gRPC reconnects on the
+        call.
+        """
+        if not self.channels:
+            raise grpc.aio.AioRpcError(
+                grpc.StatusCode.UNAVAILABLE,
+                grpc.aio.Metadata(),
+                grpc.aio.Metadata(),
+                details="No gRPC server to call",
+            )
+        avoid = set(avoid)
+        candidates = [
+            pooled for pooled in self.channels if pooled.address not in avoid
+        ] or self.channels
+        candidates = [pooled for pooled in candidates if pooled.healthy] or candidates
+        start = next(self._turn) % len(candidates)
+        if self.policy == "round_robin":
+            return candidates[start]
+        # Ties go round the channels in turn
+        rotated = candidates[start:] + candidates[:start]
+        return min(rotated, key=lambda pooled: pooled.in_flight)
+
+    def _begin(self, pooled: PooledChannel) -> None:
+        pooled.in_flight += 1
+        telemetry.POOL_CALLS.labels(pooled.address).inc()
+        telemetry.POOL_IN_FLIGHT.labels(pooled.address).inc()
+
+    def _end(self, pooled: PooledChannel) -> None:
+        pooled.in_flight -= 1
+        telemetry.POOL_IN_FLIGHT.labels(pooled.address).dec()
+
+    def _may_retry(self, method: str, error, pooled, tried: List[str]) -> bool:
+        if error.code() != grpc.StatusCode.UNAVAILABLE:
+            return False
+        self._set_healthy(pooled, False)
+        tried.append(pooled.address)
+        if method not in IDEMPOTENT_METHODS or len(tried) > self.retries:
+            return False
+        telemetry.POOL_RETRIES.labels(method).inc()
+        return True
+
+    async def call(self, method: str, request, **kwargs):
+        """Make a call with a single response; ``request`` may be a stream."""
+        tried = []
+        while True:
+            pooled = self.pick(tried)
+            self._begin(pooled)
+            try:
+                return await getattr(pooled.stub, method)(request, **kwargs)
+            except grpc.aio.AioRpcError as error:
+                if not self._may_retry(method, error, pooled, tried):
+                    raise
+            finally:
+                self._end(pooled)
+
+    async def stream(self, method: str, request, **kwargs):
+        """Make a call with a stream of responses, yielding them."""
+        tried = []
+        while True:
+            pooled = self.pick(tried)
+            self._begin(pooled)
+            received = False
+            call = getattr(pooled.stub, method)(request, **kwargs)
+            try:
+                async for response in call:
+                    received = True
+                    yield response
+                return
+            except grpc.aio.AioRpcError as error:
+                # Responses already passed on cannot be taken back
+                if received or not self._may_retry(method, error, pooled, tried):
+                    raise
+            finally:
+                # Stops the call when the caller gave up on the stream
+                call.cancel()
+                self._end(pooled)
+
+
+class BalancedStub:
+    """``CsvProcessorStub`` whose calls go through a :class:`ChannelPool`."""
+
+    def __init__(self, pool: ChannelPool):
+        self._pool = pool
+
+    def __getattr__(self, method: str):
+        if method not in _METHODS:
+            raise AttributeError(method)
+        if _METHODS[method].server_streaming:
+            return functools.partial(self._pool.stream, method)
+        return functools.partial(self._pool.call, method)
@@ -24,25 +24,65 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x13\x63sv_processor.proto\x12\rcsv_processor\"\x18\n\x08\x43svChunk\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\x0c\"5\n\x12ProcessCsvResponse\x12\x0f\n\x07task_id\x18\x01 \x01(\t\x12\x0e\n\x06status\x18\x02 \x01(\t\"-\n\x1aGetProcessingResultRequest\x12\x0f\n\x07task_id\x18\x01 \x01(\t\"N\n\x08Progress\x12\x17\n\x0flines_processed\x18\x01 \x01(\x05\x12\x13\n\x0b\x64\x65partments\x18\x02 \x01(\x05\x12\x14\n\x0ctime_elapsed\x18\x03 \x01(\x02\"\x87\x01\n\x1bGetProcessingResultResponse\x12\x1a\n\x12processed_csv_path\x18\x01 \x01(\t\x12\x11\n\tcompleted\x18\x02 \x01(\x08\x12\x0e\n\x06status\x18\x03 \x01(\t\x12)\n\x08progress\x18\x04 \x01(\x0b\x32\x17.csv_processor.Progress\"(\n\x15\x44ownloadResultRequest\x12\x0f\n\x07task_id\x18\x01 \x01(\t2\x9b\x02\n\x0c\x43svProcessor\x12J\n\nProcessCsv\x12\x17.csv_processor.CsvChunk\x1a!.csv_processor.ProcessCsvResponse(\x01\x12l\n\x13GetProcessingResult\x12).csv_processor.GetProcessingResultRequest\x1a*.csv_processor.GetProcessingResultResponse\x12Q\n\x0e\x44ownloadResult\x12$.csv_processor.DownloadResultRequest\x1a\x17.csv_processor.CsvChunk0\x01\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x13\x63sv_processor.proto\x12\rcsv_processor\"F\n\x08\x43svChunk\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\x0c\x12,\n\x04spec\x18\x02 \x01(\x0b\x32\x1e.csv_processor.AggregationSpec\"3\n\tColumnRef\x12\x0e\n\x04name\x18\x01 \x01(\tH\x00\x12\x0f\n\x05index\x18\x02 \x01(\x05H\x00\x42\x05\n\x03ref\"G\n\tAggregate\x12\x10\n\x08\x66unction\x18\x01 \x01(\t\x12(\n\x06\x63olumn\x18\x02 \x01(\x0b\x32\x18.csv_processor.ColumnRef\"g\n\x0f\x41ggregationSpec\x12&\n\x04keys\x18\x01 \x03(\x0b\x32\x18.csv_processor.ColumnRef\x12,\n\naggregates\x18\x02 \x03(\x0b\x32\x18.csv_processor.Aggregate\"4\n\x0e\x41ppendCsvChunk\x12\x14\n\x0c\x62\x61se_task_id\x18\x01 \x01(\t\x12\x0c\n\x04\x64\x61ta\x18\x02 \x01(\x0c\"E\n\x12ProcessCsvResponse\x12\x0f\n\x07task_id\x18\x01 \x01(\t\x12\x0e\n\x06status\x18\x02 \x01(\t\x12\x0e\n\x06result\x18\x03 \x01(\x0c\"-\n\x1aGetProcessingResultRequest\x12\x0f\n\x07task_id\x18\x01 \x01(\t\"/\n\x1bGetProcessingResultsRequest\x12\x10\n\x08task_ids\x18\x01 \x03(\t\"?\n\nThroughput\x12\x17\n\x0frows_per_second\x18\x01 \x01(\x01\x12\x18\n\x10\x62ytes_per_second\x18\x02 \x01(\x01\"\xca\x02\n\x08Progress\x12\x17\n\x0flines_processed\x18\x01 \x01(\x05\x12\x13\n\x0b\x64\x65partments\x18\x02 \x01(\x05\x12\x14\n\x0ctime_elapsed\x18\x03 \x01(\x02\x12-\n\nthroughput\x18\x04 \x01(\x0b\x32\x19.csv_processor.Throughput\x12\x17\n\x0f\x62ytes_processed\x18\x05 \x01(\x03\x12\x13\n\x0btotal_bytes\x18\x06 \x01(\x03\x12\x0e\n\x06status\x18\x07 \x01(\t\x12)\n\x08sketches\x18\x08 \x01(\x0b\x32\x17.csv_processor.Sketches\x12\x33\n\x06phases\x18\t \x03(\x0b\x32#.csv_processor.Progress.PhasesEntry\x1a-\n\x0bPhasesEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\x01:\x02\x38\x01\"5\n\rTopDepartment\x12\x12\n\ndepartment\x18\x01 \x01(\t\x12\x10\n\x08\x65stimate\x18\x02 \x01(\x03\"\x93\x01\n\x08Sketches\x12\x35\n\x0ftop_departments\x18\x01 \x03(\x0b\x32\x1c.csv_processor.TopDepartment\x12\x11\n\ttop_error\x18\x02 \x01(\x03\x12\x1c\n\x14\x64istinct_departments\x18\x03 \x01(\x03\x12\x1f\n\x17\x64istinct_relative_error\x18\x04 \x01(\x01\"\'\n\x14WatchProgressRequest\x12\x0f\n\x07task_id\x18\x01 \x01(\t\"\xcc\x02\n\x1bGetProcessingResultResponse\x12\x1a\n\x12processed_csv_path\x18\x01 \x01(\t\x12\x11\n\tcompleted\x18\x02 \x01(\x08\x12\x0e\n\x06status\x18\x03 \x01(\t\x12)\n\x08progress\x18\x04 \x01(\x0b\x32\x17.csv_processor.Progress\x12\x13\n\x0bresult_size\x18\x05 \x01(\x03\x12\x13\n\x0bresult_etag\x18\x06 \x01(\t\x12\x18\n\x10gzip_result_size\x18\x07 \x01(\x03\x12\r\n\x05queue\x18\x08 \x01(\t\x12\x1b\n\x0equeue_position\x18\t \x01(\x03H\x00\x88\x01\x01\x12$\n\x17\x65stimated_start_seconds\x18\n \x01(\x01H\x01\x88\x01\x01\x42\x11\n\x0f_queue_positionB\x1a\n\x18_estimated_start_seconds\"[\n\x1cGetProcessingResultsResponse\x12;\n\x07results\x18\x01 \x03(\x0b\x32*.csv_processor.GetProcessingResultResponse\"j\n\x15\x44ownloadResultRequest\x12\x0f\n\x07task_id\x18\x01 \x01(\t\x12\x0e\n\x06offset\x18\x02 \x01(\x03\x12\x0e\n\x06length\x18\x03 \x01(\x03\x12\x10\n\x08\x65ncoding\x18\x04 \x01(\t\x12\x0e\n\x06\x66ormat\x18\x05 \x01(\t\"@\n\x19GetDepartmentTotalRequest\x12\x0f\n\x07task_id\x18\x01 \x01(\t\x12\x12\n\ndepartment\x18\x02 \x01(\t\":\n\x1aGetDepartmentTotalResponse\x12\r\n\x05\x66ound\x18\x01 \x01(\x08\x12\r\n\x05total\x18\x02 \x01(\x03\"\x8c\x01\n\x16GetPeriodTotalsRequest\x12\x0f\n\x07task_id\x18\x01 \x01(\t\x12\x13\n\x0bgranularity\x18\x02 \x01(\t\x12\x12\n\nstart_date\x18\x03 \x01(\t\x12\x10\n\x08\x65nd_date\x18\x04 \x01(\t\x12\x17\n\ndepartment\x18\x05 \x01(\tH\x00\x88\x01\x01\x42\r\n\x0b_department\"@\n\x0bPeriodTotal\x12\x0e\n\x06period\x18\x01 \x01(\t\x12\x12\n\ndepartment\x18\x02 \x01(\t\x12\r\n\x05total\x18\x03 \x01(\x03\"E\n\x17GetPeriodTotalsResponse\x12*\n\x06totals\x18\x01 \x03(\x0b\x32\x1a.csv_processor.PeriodTotal\"9\n\x16\x44ownloadProfileRequest\x12\x0f\n\x07task_id\x18\x01 \x01(\t\x12\x0e\n\x06\x66ormat\x18\x02 \x01(\t\"$\n\x11\x43\x61ncelTaskRequest\x12\x0f\n\x07task_id\x18\x01 \x01(\t\"$\n\x12\x43\x61ncelTaskResponse\x12\x0e\n\x06status\x18\x01 \x01(\t2\xa3\x07\n\x0c\x43svProcessor\x12J\n\nProcessCsv\x12\x17.csv_processor.CsvChunk\x1a!.csv_processor.ProcessCsvResponse(\x01\x12l\n\x13GetProcessingResult\x12).csv_processor.GetProcessingResultRequest\x1a*.csv_processor.GetProcessingResultResponse\x12o\n\x14GetProcessingResults\x12*.csv_processor.GetProcessingResultsRequest\x1a+.csv_processor.GetProcessingResultsResponse\x12Q\n\x0e\x44ownloadResult\x12$.csv_processor.DownloadResultRequest\x1a\x17.csv_processor.CsvChunk0\x01\x12O\n\tAppendCsv\x12\x1d.csv_processor.AppendCsvChunk\x1a!.csv_processor.ProcessCsvResponse(\x01\x12O\n\rWatchProgress\x12#.csv_processor.WatchProgressRequest\x1a\x17.csv_processor.Progress0\x01\x12i\n\x12GetDepartmentTotal\x12(.csv_processor.GetDepartmentTotalRequest\x1a).csv_processor.GetDepartmentTotalResponse\x12`\n\x0fGetPeriodTotals\x12%.csv_processor.GetPeriodTotalsRequest\x1a&.csv_processor.GetPeriodTotalsResponse\x12S\n\x0f\x44ownloadProfile\x12%.csv_processor.DownloadProfileRequest\x1a\x17.csv_processor.CsvChunk0\x01\x12Q\n\nCancelTask\x12 .csv_processor.CancelTaskRequest\x1a!.csv_processor.CancelTaskResponseb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'csv_processor_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
+  _globals['_PROGRESS_PHASESENTRY']._loaded_options = None
+  _globals['_PROGRESS_PHASESENTRY']._serialized_options = b'8\001'
   _globals['_CSVCHUNK']._serialized_start=38
-  _globals['_CSVCHUNK']._serialized_end=62
-  _globals['_PROCESSCSVRESPONSE']._serialized_start=64
-  _globals['_PROCESSCSVRESPONSE']._serialized_end=117
-  _globals['_GETPROCESSINGRESULTREQUEST']._serialized_start=119
-  _globals['_GETPROCESSINGRESULTREQUEST']._serialized_end=164
-  _globals['_PROGRESS']._serialized_start=166
-  _globals['_PROGRESS']._serialized_end=244
-  _globals['_GETPROCESSINGRESULTRESPONSE']._serialized_start=247
-  _globals['_GETPROCESSINGRESULTRESPONSE']._serialized_end=382
-  _globals['_DOWNLOADRESULTREQUEST']._serialized_start=384
-  _globals['_DOWNLOADRESULTREQUEST']._serialized_end=424
-  _globals['_CSVPROCESSOR']._serialized_start=427
-  _globals['_CSVPROCESSOR']._serialized_end=710
+  _globals['_CSVCHUNK']._serialized_end=108
+  _globals['_COLUMNREF']._serialized_start=110
+  _globals['_COLUMNREF']._serialized_end=161
+  _globals['_AGGREGATE']._serialized_start=163
+  _globals['_AGGREGATE']._serialized_end=234
+  _globals['_AGGREGATIONSPEC']._serialized_start=236
+  _globals['_AGGREGATIONSPEC']._serialized_end=339
+  _globals['_APPENDCSVCHUNK']._serialized_start=341
+  _globals['_APPENDCSVCHUNK']._serialized_end=393
+  _globals['_PROCESSCSVRESPONSE']._serialized_start=395
+  _globals['_PROCESSCSVRESPONSE']._serialized_end=464
+  _globals['_GETPROCESSINGRESULTREQUEST']._serialized_start=466
+  _globals['_GETPROCESSINGRESULTREQUEST']._serialized_end=511
+  _globals['_GETPROCESSINGRESULTSREQUEST']._serialized_start=513
+  _globals['_GETPROCESSINGRESULTSREQUEST']._serialized_end=560
+  _globals['_THROUGHPUT']._serialized_start=562
+  _globals['_THROUGHPUT']._serialized_end=625
+  _globals['_PROGRESS']._serialized_start=628
+  _globals['_PROGRESS']._serialized_end=958
+  _globals['_PROGRESS_PHASESENTRY']._serialized_start=913
+  _globals['_PROGRESS_PHASESENTRY']._serialized_end=958
+  _globals['_TOPDEPARTMENT']._serialized_start=960
+  _globals['_TOPDEPARTMENT']._serialized_end=1013
+  _globals['_SKETCHES']._serialized_start=1016
+  _globals['_SKETCHES']._serialized_end=1163
+  _globals['_WATCHPROGRESSREQUEST']._serialized_start=1165
+  _globals['_WATCHPROGRESSREQUEST']._serialized_end=1204
+  _globals['_GETPROCESSINGRESULTRESPONSE']._serialized_start=1207
+  _globals['_GETPROCESSINGRESULTRESPONSE']._serialized_end=1539
+  _globals['_GETPROCESSINGRESULTSRESPONSE']._serialized_start=1541
+  _globals['_GETPROCESSINGRESULTSRESPONSE']._serialized_end=1632
+  _globals['_DOWNLOADRESULTREQUEST']._serialized_start=1634
+  _globals['_DOWNLOADRESULTREQUEST']._serialized_end=1740
+  _globals['_GETDEPARTMENTTOTALREQUEST']._serialized_start=1742
+  _globals['_GETDEPARTMENTTOTALREQUEST']._serialized_end=1806
+  _globals['_GETDEPARTMENTTOTALRESPONSE']._serialized_start=1808
+  _globals['_GETDEPARTMENTTOTALRESPONSE']._serialized_end=1866
+  _globals['_GETPERIODTOTALSREQUEST']._serialized_start=1869
+  _globals['_GETPERIODTOTALSREQUEST']._serialized_end=2009
+  _globals['_PERIODTOTAL']._serialized_start=2011
+  _globals['_PERIODTOTAL']._serialized_end=2075
+  _globals['_GETPERIODTOTALSRESPONSE']._serialized_start=2077
+  _globals['_GETPERIODTOTALSRESPONSE']._serialized_end=2146
+  _globals['_DOWNLOADPROFILEREQUEST']._serialized_start=2148
+  _globals['_DOWNLOADPROFILEREQUEST']._serialized_end=2205
+  _globals['_CANCELTASKREQUEST']._serialized_start=2207
+  _globals['_CANCELTASKREQUEST']._serialized_end=2243
+  _globals['_CANCELTASKRESPONSE']._serialized_start=2245
+  _globals['_CANCELTASKRESPONSE']._serialized_end=2281
+  _globals['_CSVPROCESSOR']._serialized_start=2284
+  _globals['_CSVPROCESSOR']._serialized_end=3215
 # @@protoc_insertion_point(module_scope)
@@ -44,11 +44,46 @@ class CsvProcessorStub(object):
                 request_serializer=csv__processor__pb2.GetProcessingResultRequest.SerializeToString,
                 response_deserializer=csv__processor__pb2.GetProcessingResultResponse.FromString,
                 _registered_method=True)
+        self.GetProcessingResults = channel.unary_unary(
+                '/csv_processor.CsvProcessor/GetProcessingResults',
+                request_serializer=csv__processor__pb2.GetProcessingResultsRequest.SerializeToString,
+                response_deserializer=csv__processor__pb2.GetProcessingResultsResponse.FromString,
+                _registered_method=True)
         self.DownloadResult = channel.unary_stream(
                 '/csv_processor.CsvProcessor/DownloadResult',
                 request_serializer=csv__processor__pb2.DownloadResultRequest.SerializeToString,
                 response_deserializer=csv__processor__pb2.CsvChunk.FromString,
                 _registered_method=True)
+        self.AppendCsv = channel.stream_unary(
+                '/csv_processor.CsvProcessor/AppendCsv',
+                request_serializer=csv__processor__pb2.AppendCsvChunk.SerializeToString,
+                response_deserializer=csv__processor__pb2.ProcessCsvResponse.FromString,
+                _registered_method=True)
+        self.WatchProgress = channel.unary_stream(
+                '/csv_processor.CsvProcessor/WatchProgress',
+                request_serializer=csv__processor__pb2.WatchProgressRequest.SerializeToString,
+                response_deserializer=csv__processor__pb2.Progress.FromString,
+                _registered_method=True)
+        self.GetDepartmentTotal = channel.unary_unary(
+                '/csv_processor.CsvProcessor/GetDepartmentTotal',
+                request_serializer=csv__processor__pb2.GetDepartmentTotalRequest.SerializeToString,
+                response_deserializer=csv__processor__pb2.GetDepartmentTotalResponse.FromString,
+                _registered_method=True)
+        self.GetPeriodTotals = channel.unary_unary(
+                '/csv_processor.CsvProcessor/GetPeriodTotals',
+                request_serializer=csv__processor__pb2.GetPeriodTotalsRequest.SerializeToString,
+                response_deserializer=csv__processor__pb2.GetPeriodTotalsResponse.FromString,
+                _registered_method=True)
+        self.DownloadProfile = channel.unary_stream(
+                '/csv_processor.CsvProcessor/DownloadProfile',
+                request_serializer=csv__processor__pb2.DownloadProfileRequest.SerializeToString,
+                response_deserializer=csv__processor__pb2.CsvChunk.FromString,
+                _registered_method=True)
+        self.CancelTask = channel.unary_unary(
+                '/csv_processor.CsvProcessor/CancelTask',
+                request_serializer=csv__processor__pb2.CancelTaskRequest.SerializeToString,
+                response_deserializer=csv__processor__pb2.CancelTaskResponse.FromString,
+                _registered_method=True)
 
 
 class CsvProcessorServicer(object):
@@ -66,12 +101,54 @@ class CsvProcessorServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def GetProcessingResults(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def DownloadResult(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def AppendCsv(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def WatchProgress(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetDepartmentTotal(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetPeriodTotals(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def DownloadProfile(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def CancelTask(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_CsvProcessorServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -85,11 +162,46 @@ def add_CsvProcessorServicer_to_server(servicer, server):
                     request_deserializer=csv__processor__pb2.GetProcessingResultRequest.FromString,
                     response_serializer=csv__processor__pb2.GetProcessingResultResponse.SerializeToString,
             ),
+            'GetProcessingResults': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetProcessingResults,
+                    request_deserializer=csv__processor__pb2.GetProcessingResultsRequest.FromString,
+                    response_serializer=csv__processor__pb2.GetProcessingResultsResponse.SerializeToString,
+            ),
             'DownloadResult': grpc.unary_stream_rpc_method_handler(
                     servicer.DownloadResult,
                     request_deserializer=csv__processor__pb2.DownloadResultRequest.FromString,
                     response_serializer=csv__processor__pb2.CsvChunk.SerializeToString,
             ),
+            'AppendCsv': grpc.stream_unary_rpc_method_handler(
+                    servicer.AppendCsv,
+                    request_deserializer=csv__processor__pb2.AppendCsvChunk.FromString,
+                    response_serializer=csv__processor__pb2.ProcessCsvResponse.SerializeToString,
+            ),
+            'WatchProgress': grpc.unary_stream_rpc_method_handler(
+                    servicer.WatchProgress,
+                    request_deserializer=csv__processor__pb2.WatchProgressRequest.FromString,
+                    response_serializer=csv__processor__pb2.Progress.SerializeToString,
+            ),
+            'GetDepartmentTotal': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetDepartmentTotal,
+                    request_deserializer=csv__processor__pb2.GetDepartmentTotalRequest.FromString,
+                    response_serializer=csv__processor__pb2.GetDepartmentTotalResponse.SerializeToString,
+            ),
+            'GetPeriodTotals': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetPeriodTotals,
+                    request_deserializer=csv__processor__pb2.GetPeriodTotalsRequest.FromString,
+                    response_serializer=csv__processor__pb2.GetPeriodTotalsResponse.SerializeToString,
+            ),
+            'DownloadProfile': grpc.unary_stream_rpc_method_handler(
+                    servicer.DownloadProfile,
+                    request_deserializer=csv__processor__pb2.DownloadProfileRequest.FromString,
+                    response_serializer=csv__processor__pb2.CsvChunk.SerializeToString,
+            ),
+            'CancelTask': grpc.unary_unary_rpc_method_handler(
+                    servicer.CancelTask,
+                    request_deserializer=csv__processor__pb2.CancelTaskRequest.FromString,
+                    response_serializer=csv__processor__pb2.CancelTaskResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'csv_processor.CsvProcessor', rpc_method_handlers)
@@ -155,6 +267,33 @@ class CsvProcessor(object):
             metadata,
             _registered_method=True)
 
+    @staticmethod
+    def GetProcessingResults(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/csv_processor.CsvProcessor/GetProcessingResults',
+            csv__processor__pb2.GetProcessingResultsRequest.SerializeToString,
+            csv__processor__pb2.GetProcessingResultsResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
     @staticmethod
     def DownloadResult(request,
             target,
@@ -181,3 +320,165 @@ class CsvProcessor(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def AppendCsv(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(
+            request_iterator,
+            target,
+            '/csv_processor.CsvProcessor/AppendCsv',
+            csv__processor__pb2.AppendCsvChunk.SerializeToString,
+            csv__processor__pb2.ProcessCsvResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def WatchProgress(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/csv_processor.CsvProcessor/WatchProgress',
+            csv__processor__pb2.WatchProgressRequest.SerializeToString,
+            csv__processor__pb2.Progress.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def GetDepartmentTotal(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/csv_processor.CsvProcessor/GetDepartmentTotal',
+            csv__processor__pb2.GetDepartmentTotalRequest.SerializeToString,
+            csv__processor__pb2.GetDepartmentTotalResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def GetPeriodTotals(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/csv_processor.CsvProcessor/GetPeriodTotals',
+            csv__processor__pb2.GetPeriodTotalsRequest.SerializeToString,
+            csv__processor__pb2.GetPeriodTotalsResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def DownloadProfile(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/csv_processor.CsvProcessor/DownloadProfile',
+            csv__processor__pb2.DownloadProfileRequest.SerializeToString,
+            csv__processor__pb2.CsvChunk.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def CancelTask(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/csv_processor.CsvProcessor/CancelTask',
+            csv__processor__pb2.CancelTaskRequest.SerializeToString,
+            csv__processor__pb2.CancelTaskResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
@@ -1,23 +1,69 @@
-import grpc
-from concurrent import futures
+import asyncio
+import multiprocessing
 import os
+
+import grpc
 from dotenv import load_dotenv
 import csv_processor_pb2_grpc
+import telemetry
+from celery_app import celery_queue_depths
 from csv_processor_service import CsvProcessorService
 
 load_dotenv()
 
+# Each worker process runs its own asyncio server on the shared port; the
+# kernel spreads incoming connections between them (SO_REUSEPORT).
+GRPC_WORKERS = int(os.getenv("GRPC_WORKERS", 1))
+# Compression of the messages the server sends
+GRPC_COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}[os.getenv("GRPC_COMPRESSION", "none")]
+# Port the server serves its Prometheus metrics on; 0 serves none. Several
+# workers need PROMETHEUS_MULTIPROC_DIR to report all of them.
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
 
-def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+
+async def serve_async(grpc_port: str):
+    # Blocking calls go through asyncio.to_thread, i.e. this pool
+    asyncio.get_running_loop().set_default_executor(
+        telemetry.InstrumentedThreadPoolExecutor()
+    )
+    server = grpc.aio.server(
+        options=[("grpc.so_reuseport", 1)], compression=GRPC_COMPRESSION
+    )
     csv_processor_pb2_grpc.add_CsvProcessorServicer_to_server(
         CsvProcessorService(), server
     )
-    grpc_port = os.getenv("GRPC_PORT", "50051")
     server.add_insecure_port(f"[::]:{grpc_port}")
-    server.start()
-    print(f"gRPC server started on port {grpc_port}")
-    server.wait_for_termination()
+    await server.start()
+    print(f"gRPC server started on port {grpc_port} (pid {os.getpid()})")
+    await server.wait_for_termination()
+
+
+def run_worker(grpc_port: str):
+    asyncio.run(serve_async(grpc_port))
+
+
+def serve():
+    grpc_port = os.getenv("GRPC_PORT", "50051")
+    telemetry.watch_queue_depth(celery_queue_depths)
+    telemetry.serve_metrics(METRICS_PORT)
+    if GRPC_WORKERS <= 1:
+        run_worker(grpc_port)
+        return
+    # gRPC must not be initialised before forking, so every worker builds
+    # its server after the fork
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(grpc_port,))
+        for _ in range(GRPC_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        telemetry.process_exited(worker.pid)
 
 
 if __name__ == "__main__":
@@ -1,78 +1,864 @@
+import asyncio
+import hashlib
+import json
 import os
 import tempfile
+import time
+import uuid
+import grpc
+import redis.asyncio
 import csv_processor_pb2
+import telemetry
 from csv_processor_pb2_grpc import CsvProcessorServicer
 from csv_processor_pb2 import (
+    CancelTaskResponse,
+    GetDepartmentTotalResponse,
+    GetPeriodTotalsResponse,
     ProcessCsvResponse,
     GetProcessingResultResponse,
+    GetProcessingResultsResponse,
+    PeriodTotal,
     Progress,
+    Sketches,
+    Throughput,
+    TopDepartment,
 )
-from celery.result import AsyncResult
-from celery_app import celery_app, process_csv_task
+from celery.backends.redis import RedisBackend
+from celery.states import READY_STATES
+from celery_app import (
+    ENGINES,
+    PROFILE_FORMATS,
+    RESULT_FORMATS,
+    AggregateStore,
+    SalesSketches,
+    StreamingSalesAggregator,
+    aggregate_stores,
+    aggregation_plan,
+    cancel_task,
+    celery_app,
+    check_sketches,
+    check_time_buckets,
+    chunk_progress,
+    compression_supported,
+    daily_path_for,
+    groups_path_for,
+    load_grouped_state,
+    normalize_spec,
+    open_compressed,
+    period_totals,
+    process_csv_task,
+    render_profile,
+    render_result,
+    render_table,
+    result_cache,
+    scheduler,
+    sniff_compression,
+    state_path_for,
+    store_completed_result,
+    task_headers,
+    task_metas,
+    upload_queue,
+)
+
+WATCH_POLL_SECONDS = float(os.getenv("WATCH_POLL_SECONDS", 1))
+# Compression applied to plain uploads while they are spooled to disk: "gzip",
+# "zstd" or empty to keep them as is. Compressed uploads cannot be split into
+# parallel ranges.
+SPOOL_COMPRESSION = os.getenv("SPOOL_COMPRESSION", "")
+# States after which a task's state no longer changes
+FINAL_STATES = READY_STATES | {"CANCELLED"}
+# Uploads of up to this many bytes and rows are aggregated by the gRPC server
+# itself and their result returned with the call; 0 bytes turns this off and
+# 0 rows lifts the row limit. Compressed uploads always go to a worker.
+INLINE_MAX_BYTES = int(os.getenv("INLINE_MAX_BYTES", 256 * 1024))
+INLINE_MAX_ROWS = int(os.getenv("INLINE_MAX_ROWS", 10_000))
+
+
+def sketches_from_meta(state: dict) -> Sketches:
+    summary = SalesSketches.from_meta(state).summary()
+    return Sketches(
+        top_departments=[
+            TopDepartment(department=department, estimate=estimate)
+            for department, estimate in summary["top_departments"]
+        ],
+        top_error=summary["top_error"],
+        distinct_departments=summary["distinct_departments"],
+        distinct_relative_error=summary["distinct_relative_error"],
+    )
+
+
+def progress_from_meta(info) -> Progress:
+    if not info:
+        return Progress(lines_processed=0, departments=0, time_elapsed=0.0)
+    progress = Progress(
+        lines_processed=info.get("lines_processed", 0),
+        departments=info.get("departments", 0),
+        time_elapsed=info.get("time_elapsed", 0.0),
+        throughput=Throughput(
+            rows_per_second=info.get("rows_per_second", 0.0),
+            bytes_per_second=info.get("bytes_per_second", 0.0),
+        ),
+        bytes_processed=info.get("bytes_processed", 0),
+        total_bytes=info.get("total_bytes", 0),
+    )
+    if "sketches" in info:
+        progress.sketches.CopyFrom(sketches_from_meta(info["sketches"]))
+    if "phases" in info:
+        progress.phases.update(info["phases"])
+    return progress
+
+
+def result_etag(result_path: str, stat_result: os.stat_result) -> str:
+    # A task's result never changes once written, but may be a hard link to a
+    # cached result whose mtime others' cache hits move, so the task it belongs
+    # to and its size identify the content instead
+    task_id = os.path.basename(result_path).removesuffix("_result.csv")
+    return f'"{task_id}-{stat_result.st_size:x}"'
+
+
+def result_response(
+    state: str, info, chunk_infos: dict = None
+) -> GetProcessingResultResponse:
+    if state == "RETRY":
+        # Waiting for a tenant slot; the meta holds the retry's reason
+        state, info = "PENDING", None
+    if state == "PENDING":
+        if info and "chunk_task_ids" in info:
+            info = chunk_progress(info, chunk_infos)
+        progress = progress_from_meta(info)
+        return GetProcessingResultResponse(
+            completed=False,
+            status="PENDING",
+            progress=progress,
+        )
+    elif state == "SUCCESS":
+        progress = progress_from_meta(info)
+        result_path = info.get("result_path")
+        response = GetProcessingResultResponse(
+            processed_csv_path=result_path,
+            completed=True,
+            status="SUCCESS",
+            progress=progress,
+        )
+        try:
+            stat_result = os.stat(result_path)
+        except (OSError, TypeError):
+            return response
+        response.result_size = stat_result.st_size
+        response.result_etag = result_etag(result_path, stat_result)
+        try:
+            response.gzip_result_size = os.path.getsize(result_path + ".gz")
+        except OSError:
+            pass
+        return response
+    elif state == "CANCELLED":
+        return GetProcessingResultResponse(
+            completed=False,
+            status="CANCELLED",
+            progress=progress_from_meta(info if isinstance(info, dict) else None),
+        )
+    else:
+        # Handle failure
+        return GetProcessingResultResponse(
+            completed=False,
+            status="FAILURE",
+            progress=Progress(lines_processed=0, departments=0, time_elapsed=0.0),
+        )
+
+
+def waiting(state: str, info) -> bool:
+    # Queued tasks have no meta yet; retried ones wait for a tenant slot
+    return state in ("PENDING", "RETRY") and not isinstance(info, dict)
+
+
+def set_queue_position(response: GetProcessingResultResponse, position) -> None:
+    if position is not None:
+        response.queue = position.queue
+        response.queue_position = position.ahead
+        if position.start_seconds is not None:
+            response.estimated_start_seconds = position.start_seconds
+
+
+def queued_result_response(task_id: str, state: str, info):
+    """:func:`result_response`, with the queue position of waiting tasks."""
+    response = result_response(state, info)
+    if waiting(state, info):
+        set_queue_position(response, scheduler().position(task_id))
+    return response
+
+
+def queued_result_responses(task_ids: list) -> list:
+    """:func:`queued_result_response` for each of ``task_ids``.
+
+    States, cancellations, the ranges of parallel jobs and queue positions
+    are each read in one round trip, however many tasks there are.
+    """
+    states = read_task_states(task_ids)
+    chunk_ids = [
+        chunk_id
+        for state, info in states
+        if state == "PENDING" and isinstance(info, dict)
+        for chunk_id in info.get("chunk_task_ids", ())
+    ]
+    chunk_infos = {
+        chunk_id: info for chunk_id, (_, info) in zip(chunk_ids, task_metas(chunk_ids))
+    }
+    positions = scheduler().positions(
+        task_id
+        for task_id, (state, info) in zip(task_ids, states)
+        if waiting(state, info)
+    )
+    responses = []
+    for task_id, (state, info) in zip(task_ids, states):
+        response = result_response(state, info, chunk_infos)
+        set_queue_position(response, positions.get(task_id))
+        responses.append(response)
+    return responses
+
+
+def completed_response(task_id: str, meta: dict, inline: bool) -> ProcessCsvResponse:
+    """Response to an upload that completed with the call.
+
+    It carries the result CSV when the upload was small enough to aggregate
+    ``inline``.
+    """
+    response = ProcessCsvResponse(task_id=task_id, status="SUCCESS")
+    if inline:
+        with open(meta["result_path"], "rb") as f:
+            response.result = f.read()
+    return response
+
+
+def read_task_states(task_ids: list) -> list:
+    """Return ``(state, meta)`` of each of ``task_ids``.
+
+    A cancelled task that had not succeeded is CANCELLED, whatever its
+    workers recorded while stopping.
+    """
+    states = task_metas(task_ids)
+    cancelled = scheduler().cancelled_among(
+        task_id
+        for task_id, (state, _) in zip(task_ids, states)
+        if state not in ("SUCCESS", "CANCELLED")
+    )
+    return [
+        (
+            ("CANCELLED", info if state == "PENDING" else None)
+            if task_id in cancelled
+            else (state, info)
+        )
+        for task_id, (state, info) in zip(task_ids, states)
+    ]
+
+
+async def task_state(task_id: str):
+    """Return ``(state, meta)`` of a task, read off the event loop."""
+    (state,) = await asyncio.to_thread(read_task_states, [task_id])
+    return state
+
+
+async def watch_task(task_id: str, context):
+    """Yield ``(state, meta)`` for a task each time its state is written.
+
+    With the Redis result backend this follows the pub/sub message Celery
+    publishes on every state write; otherwise the state is polled. While a
+    parallel job's ranges run, only its subtasks write progress, so the
+    job's own state is re-read every ``WATCH_POLL_SECONDS`` as well.
+    """
+    backend = celery_app.backend
+    pubsub = None
+    if isinstance(backend, RedisBackend):
+        pubsub = redis_client().pubsub(ignore_subscribe_messages=True)
+        # Subscribe before the first read so no update falls in between
+        await pubsub.subscribe(backend.get_key_for_task(task_id))
+    try:
+        state, info = await task_state(task_id)
+        while True:
+            yield state, info
+            if state in FINAL_STATES or context.done():
+                return
+            message = None
+            if pubsub is not None:
+                message = await pubsub.get_message(timeout=WATCH_POLL_SECONDS)
+            else:
+                await asyncio.sleep(WATCH_POLL_SECONDS)
+            if message is not None:
+                meta = backend.decode_result(message["data"])
+                state, info = meta["status"], meta["result"]
+                if state in READY_STATES:
+                    # A cancelled job's ranges fail it as they stop
+                    state, info = await task_state(task_id)
+            else:
+                state, info = await task_state(task_id)
+    finally:
+        if pubsub is not None:
+            await pubsub.aclose()
+
+
+def spec_from_proto(message: csv_processor_pb2.AggregationSpec) -> dict:
+    def column(ref):
+        return getattr(ref, ref.WhichOneof("ref")) if ref.WhichOneof("ref") else None
+
+    return {
+        "keys": [column(ref) for ref in message.keys],
+        "aggregates": [
+            {"function": aggregate.function, "column": column(aggregate.column)}
+            for aggregate in message.aggregates
+        ],
+    }
+
+
+def cache_salt(
+    base_task_id: str = None,
+    spec: dict = None,
+    time_buckets: bool = False,
+    sketches: bool = False,
+) -> bytes:
+    # Keeps results of the same bytes apart when they were aggregated
+    # differently
+    salt = f"append:{base_task_id}:".encode() if base_task_id else b""
+    if spec:
+        salt += f"spec:{json.dumps(spec, sort_keys=True)}:".encode()
+    if time_buckets:
+        salt += b"time-buckets:"
+    if sketches:
+        salt += b"sketches:"
+    return salt
+
+
+def render_grouped_result(task_id: str, result_format: str) -> bytes:
+    plan, groups = load_grouped_state(task_id)
+    return render_table(plan.columns(groups), result_format)
+
+
+async def _prepend(first, chunks):
+    if first is not None:
+        yield first
+    async for chunk in chunks:
+        yield chunk
+
+
+_redis_client = None
+
+
+def redis_client():
+    """Asyncio client of the Redis result backend, shared by all watchers."""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.asyncio.from_url(celery_app.conf.result_backend)
+    return _redis_client
+
+
+class _Spool:
+    """Temporary upload file that also hashes what is written to it.
+
+    gzip and zstd uploads are kept compressed as received; plain ones are
+    compressed with ``SPOOL_COMPRESSION`` when it is set. The bytes and lines
+    received are counted on the way.
+    """
+
+    def __init__(self, salt: bytes = b""):
+        self.digest = hashlib.blake2b(digest_size=32)
+        self.digest.update(salt)
+        self.file = tempfile.NamedTemporaryFile(mode="wb", suffix=".csv", delete=False)
+        self.path = self.file.name
+        self.compression = None
+        self.size = 0
+        self.lines = 0
+        self._writer = None
+
+    def write(self, data: bytes):
+        if self._writer is None:
+            self.compression = sniff_compression(data)
+            self._writer = self.file
+            if self.compression is None and SPOOL_COMPRESSION:
+                self._writer = open_compressed(self.file, SPOOL_COMPRESSION)
+        self.digest.update(data)
+        self.size += len(data)
+        self.lines += data.count(b"\n")
+        self._writer.write(data)
+
+    def small(self) -> bool:
+        """Whether the upload is small enough to aggregate inline."""
+        return (
+            INLINE_MAX_BYTES > 0
+            and self.compression is None
+            and self.size <= INLINE_MAX_BYTES
+            and (not INLINE_MAX_ROWS or self.lines <= INLINE_MAX_ROWS)
+        )
+
+    def close(self):
+        if self._writer is not None and self._writer is not self.file:
+            self._writer.close()
+        self.file.close()
 
 
 class CsvProcessorService(CsvProcessorServicer):
-    def ProcessCsv(self, request_iterator, context):
-        # Accumulate chunks into a temporary file
-        with tempfile.NamedTemporaryFile(
-            mode="wb", suffix=".csv", delete=False
-        ) as temp_file:
-            for chunk in request_iterator:
-                temp_file.write(chunk.data)
-            temp_file_path = temp_file.name
-        task = process_csv_task.delay(temp_file_path)
+    @telemetry.rpc
+    async def ProcessCsv(self, request_iterator, context):
+        metadata, engine = await self._options(context)
+        time_buckets = metadata.get("x-time-buckets") == "true"
+        sketches = metadata.get("x-sketches") == "true"
+        chunks = aiter(request_iterator)
+        first = await anext(chunks, None)
+        spec = None
+        if first is not None and first.HasField("spec"):
+            try:
+                spec = normalize_spec(spec_from_proto(first.spec))
+            except ValueError as error:
+                await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+            if engine != "python":
+                await context.abort(
+                    grpc.StatusCode.INVALID_ARGUMENT,
+                    "Aggregation specs only support the python engine",
+                )
+        try:
+            check_time_buckets(time_buckets, engine, spec)
+            check_sketches(sketches, spec)
+        except ValueError as error:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+        chunks = _prepend(first, chunks)
+        if metadata.get("x-streaming") == "true":
+            if engine != "python":
+                await context.abort(
+                    grpc.StatusCode.INVALID_ARGUMENT,
+                    "Streaming mode only supports the python engine",
+                )
+            if sketches:
+                # Streamed uploads complete with the call, exact totals and all
+                await context.abort(
+                    grpc.StatusCode.INVALID_ARGUMENT,
+                    "Streaming mode does not publish sketches",
+                )
+            if metadata.get("x-profile") == "true":
+                await context.abort(
+                    grpc.StatusCode.INVALID_ARGUMENT,
+                    "Streaming mode cannot be profiled",
+                )
+            return await self._process_streaming(chunks, context, spec, time_buckets)
+        return await self._spool_and_enqueue(
+            chunks,
+            context,
+            metadata,
+            engine,
+            spec=spec,
+            time_buckets=time_buckets,
+            sketches=sketches,
+        )
+
+    @telemetry.rpc
+    async def AppendCsv(self, request_iterator, context):
+        metadata, engine = await self._options(context)
+        chunks = aiter(request_iterator)
+        first = await anext(chunks, None)
+        base_task_id = first.base_task_id if first else ""
+        state, info = await task_state(base_task_id)
+        # A delta is aggregated like the result it extends
+        info = info if isinstance(info, dict) else {}
+        spec = info.get("spec")
+        time_buckets = info.get("time_buckets", False)
+        sketches = "sketches" in info
+        state_paths = [groups_path_for if spec else state_path_for]
+        if time_buckets:
+            state_paths.append(daily_path_for)
+        if state != "SUCCESS" or not all(
+            [
+                await asyncio.to_thread(os.path.exists, path_for(base_task_id))
+                for path_for in state_paths
+            ]
+        ):
+            await context.abort(
+                grpc.StatusCode.FAILED_PRECONDITION,
+                f"No completed result to append to for task {base_task_id!r}",
+            )
+        return await self._spool_and_enqueue(
+            _prepend(first, chunks),
+            context,
+            metadata,
+            engine,
+            base_task_id=base_task_id,
+            spec=spec,
+            time_buckets=time_buckets,
+            sketches=sketches,
+        )
+
+    async def _options(self, context):
+        metadata = dict(context.invocation_metadata())
+        engine = metadata.get("x-engine", "python")
+        if engine not in ENGINES:
+            await context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT, f"Unknown engine: {engine}"
+            )
+        return metadata, engine
+
+    async def _spool_and_enqueue(
+        self,
+        chunks,
+        context,
+        metadata,
+        engine,
+        base_task_id=None,
+        spec=None,
+        time_buckets=False,
+        sketches=False,
+    ):
+        # Accumulate chunks into a temporary file, hashing them on the way so
+        # identical uploads can reuse an earlier result. Disk writes happen
+        # off the event loop so a slow upload never holds up other calls.
+        spool = await asyncio.to_thread(
+            _Spool, cache_salt(base_task_id, spec, time_buckets, sketches)
+        )
+        started = time.perf_counter()
+        received = 0
+        complete = False
+        try:
+            async for chunk in chunks:
+                received += len(chunk.data)
+                await asyncio.to_thread(spool.write, chunk.data)
+            complete = True
+        finally:
+            await asyncio.to_thread(spool.close)
+            telemetry.observe_stage("spool", time.perf_counter() - started, received)
+            if not complete:
+                # The client broke the upload off; nothing will read it
+                await asyncio.to_thread(os.remove, spool.path)
+        if not compression_supported(spool.compression):
+            await asyncio.to_thread(os.remove, spool.path)
+            await context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT,
+                f"{spool.compression} uploads are not supported by this server",
+            )
+        if spec:
+            try:
+                # Fail on columns missing from the header before queueing
+                await asyncio.to_thread(aggregation_plan, spool.path, spec, engine)
+            except ValueError as error:
+                await asyncio.to_thread(os.remove, spool.path)
+                await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+        return await asyncio.to_thread(
+            self._enqueue,
+            spool.path,
+            spool.digest.hexdigest(),
+            metadata,
+            engine,
+            base_task_id,
+            spec,
+            time_buckets,
+            sketches,
+            spool.small(),
+        )
+
+    def _enqueue(
+        self,
+        temp_file_path,
+        cache_key,
+        metadata,
+        engine,
+        base_task_id,
+        spec=None,
+        time_buckets=False,
+        sketches=False,
+        inline=False,
+    ):
+        task_id = str(uuid.uuid4())
+        profile = metadata.get("x-profile") == "true"
+        if profile:
+            # Profile the aggregation itself rather than serve a cached
+            # result, and keep the profiled result out of the cache
+            cache_key = None
+        meta = result_cache.lookup(cache_key, task_id) if cache_key else None
+        if meta is not None:
+            os.remove(temp_file_path)
+            celery_app.backend.store_result(task_id, meta, "SUCCESS")
+            return completed_response(task_id, meta, inline)
+        chunk_count = metadata.get("x-parallel-chunks")
+        options = {
+            "chunks": int(chunk_count) if chunk_count else None,
+            "engine": engine,
+            "cache_key": cache_key,
+            "base_task_id": base_task_id,
+            "spec": spec,
+            "time_buckets": time_buckets,
+            "sketches": sketches,
+            "profile": profile,
+            "tenant": metadata.get("x-tenant", ""),
+        }
+        # cProfile cannot profile two calls of this process at once, so
+        # profiled uploads always go to a worker
+        if inline and not profile:
+            return self._process_inline(task_id, temp_file_path, options)
+        task = process_csv_task.apply_async(
+            (temp_file_path,),
+            options,
+            task_id=task_id,
+            headers=task_headers(),
+            queue=upload_queue(temp_file_path),
+        )
         return ProcessCsvResponse(task_id=task.id, status=task.state)
 
-    def GetProcessingResult(self, request, context):
-        task_result = AsyncResult(request.task_id, app=celery_app)
-        if task_result.state == "PENDING":
-            progress = (
-                Progress(
-                    lines_processed=task_result.info.get("lines_processed", 0),
-                    departments=task_result.info.get("departments", 0),
-                    time_elapsed=task_result.info.get("time_elapsed", 0.0),
+    def _process_inline(self, task_id, temp_file_path, options):
+        # Queueing a small upload, waiting for a worker and polling for its
+        # result takes longer than aggregating it, so the task runs right
+        # here. Its result is stored like a worker's under task_id.
+        try:
+            result = process_csv_task.apply(
+                (temp_file_path,), {**options, "chunks": 1}, task_id=task_id
+            )
+        finally:
+            os.remove(temp_file_path)
+        if result.failed():
+            celery_app.backend.mark_as_failure(
+                task_id, result.result, traceback=result.traceback
+            )
+            return ProcessCsvResponse(task_id=task_id, status="FAILURE")
+        celery_app.backend.store_result(task_id, result.result, "SUCCESS")
+        return completed_response(task_id, result.result, True)
+
+    async def _process_streaming(
+        self, request_iterator, context, spec=None, time_buckets=False
+    ):
+        # Aggregate chunks as they arrive instead of spooling them to disk
+        start_time = time.time()
+        digest = hashlib.blake2b(digest_size=32)
+        digest.update(cache_salt(spec=spec, time_buckets=time_buckets))
+        aggregator = StreamingSalesAggregator(spec, time_buckets)
+
+        def feed(data: bytes):
+            digest.update(data)
+            aggregator.feed(data)
+
+        try:
+            async for chunk in request_iterator:
+                await asyncio.to_thread(feed, chunk.data)
+            sales = aggregator.close()
+        except RuntimeError as error:  # Compression not available here
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+        except ValueError as error:  # The spec does not fit the header
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+        time_elapsed = time.time() - start_time
+        # Streamed uploads are received and aggregated in a single pass
+        telemetry.observe_stage("aggregate", time_elapsed, aggregator.bytes_processed)
+        telemetry.ROWS.labels("python").inc(aggregator.lines_processed)
+        task_id = str(uuid.uuid4())
+
+        def store():
+            meta = store_completed_result(
+                task_id,
+                sales,
+                {
+                    "lines_processed": aggregator.lines_processed,
+                    "time_elapsed": time_elapsed,
+                    "bytes_processed": aggregator.bytes_processed,
+                    "total_bytes": aggregator.bytes_processed,
+                    "rows_per_second": (
+                        aggregator.lines_processed / time_elapsed
+                        if time_elapsed
+                        else 0.0
+                    ),
+                    "bytes_per_second": (
+                        aggregator.bytes_processed / time_elapsed
+                        if time_elapsed
+                        else 0.0
+                    ),
+                },
+                plan=aggregator.plan,
+                daily=aggregator.daily,
+            )
+            result_cache.store(digest.hexdigest(), task_id, meta)
+
+        await asyncio.to_thread(store)
+        return ProcessCsvResponse(task_id=task_id, status="SUCCESS")
+
+    @telemetry.rpc
+    async def GetProcessingResult(self, request, context):
+        state, info = await task_state(request.task_id)
+        return await asyncio.to_thread(
+            queued_result_response, request.task_id, state, info
+        )
+
+    @telemetry.rpc
+    async def GetProcessingResults(self, request, context):
+        responses = await asyncio.to_thread(
+            queued_result_responses, list(request.task_ids)
+        )
+        return GetProcessingResultsResponse(results=responses)
+
+    @telemetry.rpc
+    async def WatchProgress(self, request, context):
+        async for state, info in watch_task(request.task_id, context):
+            response = result_response(state, info)
+            response.progress.status = response.status
+            yield response.progress
+
+    @telemetry.rpc
+    async def DownloadResult(self, request, context):
+        started = time.perf_counter()
+        sent = 0
+        try:
+            async for chunk in self._result_chunks(request, context):
+                sent += len(chunk.data)
+                yield chunk
+        finally:
+            telemetry.observe_stage("download", time.perf_counter() - started, sent)
+
+    async def _result_chunks(self, request, context):
+        state, info = await task_state(request.task_id)
+        if state != "SUCCESS":
+            # If not success, yield empty
+            return
+        if request.format not in ("", "csv"):
+            data = await self._render_result(request, info, context)
+            end = len(data)
+            if request.length:
+                end = min(end, request.offset + request.length)
+            for start in range(request.offset, end, 1024 * 1024):  # 1MB chunks
+                yield csv_processor_pb2.CsvChunk(
+                    data=data[start : min(end, start + 1024 * 1024)]
                 )
-                if task_result.info
-                else Progress(lines_processed=0, departments=0, time_elapsed=0.0)
-            )
-            return GetProcessingResultResponse(
-                completed=False,
-                status="PENDING",
-                progress=progress,
-            )
-        elif task_result.state == "SUCCESS":
-            progress = (
-                Progress(
-                    lines_processed=task_result.info.get("lines_processed", 0),
-                    departments=task_result.info.get("departments", 0),
-                    time_elapsed=task_result.info.get("time_elapsed", 0.0),
+            return
+        result_path = info.get("result_path")
+        if result_path and request.encoding == "gzip":
+            result_path += ".gz"
+        if not result_path or not await asyncio.to_thread(os.path.exists, result_path):
+            return
+        remaining = request.length or None
+        f = await asyncio.to_thread(open, result_path, "rb")
+        try:
+            await asyncio.to_thread(f.seek, request.offset)
+            while remaining is None or remaining > 0:
+                size = 1024 * 1024  # 1MB chunks
+                if remaining is not None:
+                    size = min(size, remaining)
+                    remaining -= size
+                chunk = await asyncio.to_thread(f.read, size)
+                if not chunk:
+                    break
+                yield csv_processor_pb2.CsvChunk(data=chunk)
+        finally:
+            f.close()
+
+    async def _render_result(self, request, info, context) -> bytes:
+        if request.format not in RESULT_FORMATS:
+            await context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT,
+                f"Unknown result format: {request.format}",
+            )
+        try:
+            if isinstance(info, dict) and info.get("spec"):
+                return await asyncio.to_thread(
+                    render_grouped_result, request.task_id, request.format
                 )
-                if task_result.info
-                else Progress(lines_processed=0, departments=0, time_elapsed=0.0)
-            )
-            result_path = task_result.info.get("result_path")
-            return GetProcessingResultResponse(
-                processed_csv_path=result_path,
-                completed=True,
-                status="SUCCESS",
-                progress=progress,
-            )
-        else:
-            # Handle failure
-            return GetProcessingResultResponse(
-                completed=False,
-                status="FAILURE",
-                progress=Progress(lines_processed=0, departments=0, time_elapsed=0.0),
-            )
-
-    def DownloadResult(self, request, context):
-        task_result = AsyncResult(request.task_id, app=celery_app)
-        if task_result.state == "SUCCESS":
-            result_path = task_result.info.get("result_path")
-            if result_path and os.path.exists(result_path):
-                with open(result_path, "rb") as f:
-                    while chunk := f.read(1024 * 1024):  # 1MB chunks
-                        yield csv_processor_pb2.CsvChunk(data=chunk)
-        else:
-            # If not success, yield empty
-            pass
+            store = await self._aggregate_store(request.task_id, context)
+            return await asyncio.to_thread(render_result, store.items(), request.format)
+        except FileNotFoundError:
+            await context.abort(
+                grpc.StatusCode.NOT_FOUND,
+                f"No completed result for task {request.task_id!r}",
+            )
+        except RuntimeError as error:  # pyarrow is not installed
+            await context.abort(grpc.StatusCode.FAILED_PRECONDITION, str(error))
+        except OverflowError:
+            await context.abort(
+                grpc.StatusCode.OUT_OF_RANGE, "Values do not fit in an int64"
+            )
+
+    async def _aggregate_store(
+        self, task_id: str, context, path_for=state_path_for
+    ) -> AggregateStore:
+        state, info = await task_state(task_id)
+        if state != "SUCCESS":
+            await context.abort(
+                grpc.StatusCode.NOT_FOUND, f"No completed result for task {task_id!r}"
+            )
+        try:
+            return await asyncio.to_thread(aggregate_stores.open, path_for(task_id))
+        except FileNotFoundError:
+            if path_for is daily_path_for and not info.get("time_buckets"):
+                await context.abort(
+                    grpc.StatusCode.FAILED_PRECONDITION,
+                    f"Task {task_id!r} was not processed with time buckets",
+                )
+            await context.abort(
+                grpc.StatusCode.NOT_FOUND, f"No completed result for task {task_id!r}"
+            )
+
+    @telemetry.rpc
+    async def DownloadProfile(self, request, context):
+        profile_format = request.format or "pstats"
+        if profile_format not in PROFILE_FORMATS:
+            await context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT,
+                f"Unknown profile format: {profile_format}",
+            )
+        state, info = await task_state(request.task_id)
+        profile_path = info.get("profile_path") if isinstance(info, dict) else None
+        if state != "SUCCESS" or not profile_path:
+            await context.abort(
+                grpc.StatusCode.NOT_FOUND,
+                f"No profile for task {request.task_id!r}",
+            )
+        try:
+            data = await asyncio.to_thread(render_profile, profile_path, profile_format)
+        except FileNotFoundError:
+            await context.abort(
+                grpc.StatusCode.NOT_FOUND,
+                f"No profile for task {request.task_id!r}",
+            )
+        for start in range(0, len(data), 1024 * 1024):  # 1MB chunks
+            yield csv_processor_pb2.CsvChunk(data=data[start : start + 1024 * 1024])
+
+    @telemetry.rpc
+    async def CancelTask(self, request, context):
+        state, info = await task_state(request.task_id)
+        if state == "PENDING" and waiting(state, info):
+            # Celery reports ids it has never heard of as PENDING too
+            position = await asyncio.to_thread(scheduler().position, request.task_id)
+            if position is None:
+                await context.abort(
+                    grpc.StatusCode.NOT_FOUND, f"No task {request.task_id!r}"
+                )
+        if state in READY_STATES:
+            await context.abort(
+                grpc.StatusCode.FAILED_PRECONDITION,
+                f"Task {request.task_id!r} has already finished",
+            )
+        if state != "CANCELLED":
+            await asyncio.to_thread(cancel_task, request.task_id, info)
+        return CancelTaskResponse(status="CANCELLED")
+
+    @telemetry.rpc
+    async def GetDepartmentTotal(self, request, context):
+        store = await self._aggregate_store(request.task_id, context)
+        total = await asyncio.to_thread(store.get, request.department)
+        if total is None:
+            return GetDepartmentTotalResponse(found=False)
+        if total not in AggregateStore.INT64_RANGE:
+            await context.abort(
+                grpc.StatusCode.OUT_OF_RANGE, "Total does not fit in an int64"
+            )
+        return GetDepartmentTotalResponse(found=True, total=total)
+
+    @telemetry.rpc
+    async def GetPeriodTotals(self, request, context):
+        store = await self._aggregate_store(request.task_id, context, daily_path_for)
+        try:
+            totals = await asyncio.to_thread(
+                period_totals,
+                store,
+                request.granularity or "day",
+                request.start_date or None,
+                request.end_date or None,
+                request.department if request.HasField("department") else None,
+            )
+        except ValueError as error:  # Unknown granularity or malformed date
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(error))
+        if any(total not in AggregateStore.INT64_RANGE for _, _, total in totals):
+            await context.abort(
+                grpc.StatusCode.OUT_OF_RANGE, "Totals do not fit in an int64"
+            )
+        return GetPeriodTotalsResponse(
+            totals=[
+                PeriodTotal(period=period, department=department, total=total)
+                for period, department, total in totals
+            ]
+        )
@@ -1,31 +1,85 @@
+import asyncio
+import json
+import logging
 import os
+import time
 from contextlib import asynccontextmanager
 
 import csv_processor_pb2
-import csv_processor_pb2_grpc
 import grpc
+import telemetry
 import uvicorn
+from channel_pool import ChannelPool
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, UploadFile
+from fastapi import Body, FastAPI, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    Response,
+    StreamingResponse,
+)
+from python_multipart import MultipartParser
+from python_multipart.exceptions import FormParserError
+from python_multipart.multipart import parse_options_header
 
 load_dotenv()
 
-# Global gRPC channel and stub for performance
+logger = logging.getLogger(__name__)
+
+# gRPC server to call when GRPC_BACKENDS is empty
 grpc_host = os.getenv("GRPC_HOST", "localhost")
 grpc_port = os.getenv("GRPC_PORT", "50051")
-grpc_channel = None
+# gRPC servers to balance calls over, comma separated; "dns:///name:port"
+# stands for every address the name resolves to
+GRPC_BACKENDS = os.getenv("GRPC_BACKENDS", "")
+# Channels, each its own HTTP/2 connection, to every server address
+GRPC_CHANNELS_PER_BACKEND = int(os.getenv("GRPC_CHANNELS_PER_BACKEND", 1))
+# How calls are spread over the channels: least_request or round_robin
+GRPC_BALANCING = os.getenv("GRPC_BALANCING", "least_request")
+# Further servers a read is tried on when its server is unavailable
+GRPC_RETRIES = int(os.getenv("GRPC_RETRIES", 2))
+# Seconds between health checks of the channels and DNS lookups of servers
+GRPC_HEALTH_CHECK_SECONDS = float(os.getenv("GRPC_HEALTH_CHECK_SECONDS", 5))
+# Serve downloads from RESULTS_DIR directly when the gateway can see it
+SERVE_RESULTS_FROM_DISK = os.getenv("SERVE_RESULTS_FROM_DISK", "true") == "true"
+# Compression of messages on the gRPC channel
+GRPC_COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}[os.getenv("GRPC_COMPRESSION", "none")]
+# Seconds a task's status is reused for; lookups of a task already being
+# fetched always wait for that fetch instead of asking again
+STATUS_CACHE_SECONDS = float(os.getenv("STATUS_CACHE_SECONDS", 0.5))
+# Most tasks one POST /status:batch may ask about
+STATUS_BATCH_MAX_TASKS = int(os.getenv("STATUS_BATCH_MAX_TASKS", 1000))
+# Bytes of an upload forwarded per gRPC message, below gRPC's 4 MiB limit
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", 1024 * 1024))
+# Largest form field other than the file an upload may carry
+UPLOAD_MAX_FIELD_BYTES = 1024 * 1024
+# Leading bytes of gzip and zstd files
+COMPRESSED_MAGIC = (b"\x1f\x8b", b"\x28\xb5\x2f\xfd")
+grpc_pool = None
 grpc_stub = None
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global grpc_channel, grpc_stub
-    grpc_channel = grpc.aio.insecure_channel(f"{grpc_host}:{grpc_port}")
-    grpc_stub = csv_processor_pb2_grpc.CsvProcessorStub(grpc_channel)
+    global grpc_pool, grpc_stub
+    grpc_pool = ChannelPool(
+        (GRPC_BACKENDS or f"{grpc_host}:{grpc_port}").split(","),
+        channels_per_address=GRPC_CHANNELS_PER_BACKEND,
+        policy=GRPC_BALANCING,
+        retries=GRPC_RETRIES,
+        health_interval=GRPC_HEALTH_CHECK_SECONDS,
+        compression=GRPC_COMPRESSION,
+    )
+    await grpc_pool.start()
+    # Calls through the stub go to a channel of the pool each
+    grpc_stub = grpc_pool.stub
     yield
-    await grpc_channel.close()
+    await grpc_pool.close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -39,45 +93,717 @@ app.add_middleware(
 )
 
 
+def processing_metadata(
+    chunks: int | None = None,
+    engine: str | None = None,
+    streaming: bool = False,
+    time_buckets: bool = False,
+    sketches: bool = False,
+    profile: bool = False,
+    tenant: str | None = None,
+) -> list[tuple[str, str]]:
+    # Processing options travel as gRPC metadata alongside the chunk stream
+    metadata = []
+    if chunks is not None:
+        metadata.append(("x-parallel-chunks", str(chunks)))
+    if engine is not None:
+        metadata.append(("x-engine", engine))
+    if streaming:
+        metadata.append(("x-streaming", "true"))
+    if time_buckets:
+        metadata.append(("x-time-buckets", "true"))
+    if sketches:
+        metadata.append(("x-sketches", "true"))
+    if profile:
+        metadata.append(("x-profile", "true"))
+    if tenant:
+        metadata.append(("x-tenant", tenant))
+    # So is the trace the call belongs to
+    metadata.extend(telemetry.inject().items())
+    return metadata
+
+
+# gRPC status codes that describe a bad request rather than a server failure
+RPC_ERROR_STATUS = {
+    grpc.StatusCode.INVALID_ARGUMENT: 400,
+    grpc.StatusCode.NOT_FOUND: 404,
+    grpc.StatusCode.FAILED_PRECONDITION: 409,
+    grpc.StatusCode.OUT_OF_RANGE: 422,
+}
+
+
+def rpc_error_response(error: grpc.aio.AioRpcError) -> JSONResponse:
+    if error.code() not in RPC_ERROR_STATUS:
+        raise error
+    return JSONResponse(
+        content={"error": error.details()}, status_code=RPC_ERROR_STATUS[error.code()]
+    )
+
+
+def upload_compression(first_chunk: bytes) -> grpc.Compression | None:
+    # Compressing an already compressed upload again only costs CPU
+    if first_chunk.startswith(COMPRESSED_MAGIC):
+        return grpc.Compression.NoCompression
+    return None
+
+
+def aggregation_spec(text: str) -> csv_processor_pb2.AggregationSpec:
+    """Parse a JSON aggregation spec, naming columns by header name or index.
+
+    ``{"keys": ["Region"], "aggregates": [{"function": "sum", "column": 2}]}``
+    """
+
+    def column_ref(ref) -> csv_processor_pb2.ColumnRef:
+        if isinstance(ref, str):
+            return csv_processor_pb2.ColumnRef(name=ref)
+        if isinstance(ref, int) and not isinstance(ref, bool):
+            return csv_processor_pb2.ColumnRef(index=ref)
+        raise ValueError(f"Columns are header names or indexes, got {ref!r}")
+
+    spec = json.loads(text)
+    if not isinstance(spec, dict):
+        raise ValueError("The aggregation spec must be a JSON object")
+    aggregates = []
+    for aggregate in spec.get("aggregates") or []:
+        if not isinstance(aggregate, dict):
+            raise ValueError("Each aggregate must be a JSON object")
+        column = aggregate.get("column")
+        aggregates.append(
+            csv_processor_pb2.Aggregate(
+                function=str(aggregate.get("function", "")),
+                column=None if column is None else column_ref(column),
+            )
+        )
+    return csv_processor_pb2.AggregationSpec(
+        keys=[column_ref(ref) for ref in spec.get("keys") or []],
+        aggregates=aggregates,
+    )
+
+
+class UploadError(ValueError):
+    """The request body is not an upload the gateway can stream."""
+
+
+class StreamedUpload:
+    """The file of an upload, parsed off the request body as it arrives.
+
+    A ``multipart/form-data`` body carries the file in its ``file`` part;
+    form fields must come before it and are collected in ``fields``. Any
+    other body is the file itself. Nothing is spooled: :meth:`chunks` hands
+    the file out in pieces of ``chunk_size`` bytes, ``UPLOAD_CHUNK_BYTES``
+    by default, and only reads on from the client as they are taken. gRPC
+    takes the next piece once flow control lets it send, so a slow server
+    slows the client down instead of filling memory.
+    """
+
+    def __init__(self, request: Request, chunk_size: int | None = None):
+        self.chunk_size = chunk_size or UPLOAD_CHUNK_BYTES
+        self.fields: dict[str, str] = {}
+        # Set when the body turned out to be malformed part way through
+        self.error: UploadError | None = None
+        self._body = request.stream()
+        self._data = bytearray()
+        self._parser = None
+        content_type, params = parse_options_header(
+            request.headers.get("content-type", "")
+        )
+        if content_type == b"application/x-www-form-urlencoded":
+            raise UploadError("Send the file as multipart/form-data or as the body")
+        if content_type == b"multipart/form-data":
+            if b"boundary" not in params:
+                raise UploadError("Missing boundary in multipart body")
+            self._parser = MultipartParser(
+                params[b"boundary"],
+                callbacks={
+                    "on_part_begin": self._on_part_begin,
+                    "on_header_field": self._on_header_field,
+                    "on_header_value": self._on_header_value,
+                    "on_header_end": self._on_header_end,
+                    "on_headers_finished": self._on_headers_finished,
+                    "on_part_data": self._on_part_data,
+                    "on_part_end": self._on_part_end,
+                },
+            )
+        self._file_seen = False
+        self._in_file = False
+
+    def _on_part_begin(self) -> None:
+        self._headers = {}
+        self._header_name = b""
+        self._header_value = b""
+        self._field = bytearray()
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        if self._file_seen:
+            raise UploadError("Form fields must come before the file")
+        _, options = parse_options_header(self._headers.get(b"content-disposition"))
+        self._name = options.get(b"name", b"").decode("utf-8", "replace")
+        self._in_file = self._file_seen = self._name == "file"
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_file:
+            self._data += data[start:end]
+            return
+        self._field += data[start:end]
+        if len(self._field) > UPLOAD_MAX_FIELD_BYTES:
+            raise UploadError(f"Form field {self._name!r} is too large")
+
+    def _on_part_end(self) -> None:
+        if not self._in_file:
+            self.fields[self._name] = self._field.decode("utf-8", "replace")
+        self._in_file = False
+
+    async def _read(self) -> bool:
+        """Parse the next piece of the body; False once it is all read."""
+        try:
+            piece = await anext(self._body)
+        except StopAsyncIteration:
+            if self._parser is not None:
+                self._parser.finalize()
+                if not self._file_seen:
+                    raise UploadError("The upload has no file part")
+            return False
+        if self._parser is None:
+            self._data += piece
+        else:
+            try:
+                self._parser.write(piece)
+            except FormParserError as error:
+                raise UploadError(f"Invalid multipart body: {error}") from None
+        return True
+
+    async def chunks(self):
+        try:
+            more = True
+            while more:
+                more = await self._read()
+                while len(self._data) >= self.chunk_size or (self._data and not more):
+                    chunk = bytes(self._data[: self.chunk_size])
+                    del self._data[: self.chunk_size]
+                    yield chunk
+        except UploadError as error:
+            self.error = error
+            raise
+
+
+def upload_error_response(error: UploadError) -> JSONResponse:
+    return JSONResponse(content={"error": str(error)}, status_code=400)
+
+
+def accepts_csv(accept: str | None) -> bool:
+    """Whether an ``Accept`` header names ``text/csv`` outright.
+
+    Wildcards do not count, so clients expecting the usual JSON reply keep
+    getting it.
+    """
+    for part in (accept or "").split(","):
+        media_type, _, params = part.partition(";")
+        if media_type.strip().lower() != "text/csv":
+            continue
+        name, _, value = params.partition("=")
+        if name.strip().lower() != "q":
+            return True
+        try:
+            return float(value) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def upload_response(response, request: Request):
+    download_url = str(request.url_for("download_file", task_id=response.task_id))
+    # Small uploads complete with the call; their result can come right back
+    if response.result and accepts_csv(request.headers.get("accept")):
+        return Response(
+            content=response.result,
+            media_type="text/csv",
+            headers={
+                "Content-Disposition": (
+                    f"attachment; filename={response.task_id}_result.csv"
+                ),
+                "Content-Location": download_url,
+                "X-Task-Id": response.task_id,
+            },
+        )
+    return {
+        "status": response.status,
+        "task_id": response.task_id,
+        "download_url": download_url,
+    }
+
+
 @app.post("/upload")
-async def upload_file(file: UploadFile, request: Request):
-    # Stream file content in chunks
+async def upload_file(
+    request: Request,
+    chunks: int | None = None,
+    engine: str | None = None,
+    streaming: bool = False,
+    time_buckets: bool = False,
+    sketches: bool = False,
+    profile: bool = False,
+    spec: str | None = None,
+    tenant: str | None = Header(None, alias="X-Tenant"),
+):
+    # The file is streamed from the request body straight into the gRPC
+    # call. gzip and zstd files are passed through compressed; the server
+    # recognises them by their magic bytes.
+    try:
+        upload = StreamedUpload(request)
+        file_chunks = upload.chunks()
+        first_chunk = await anext(file_chunks, b"")
+    except UploadError as error:
+        return upload_error_response(error)
+    # Optional aggregation spec, carried by the first chunk: a form field of
+    # multipart uploads, a query parameter of raw ones
+    spec = upload.fields.get("spec", spec)
+    aggregation = None
+    if spec:
+        try:
+            aggregation = aggregation_spec(spec)
+        except ValueError as error:  # Includes malformed JSON
+            return JSONResponse(
+                content={"error": f"Invalid aggregation spec: {error}"},
+                status_code=400,
+            )
+
     async def chunk_generator():
-        while True:
-            chunk = await file.read(1024 * 1024)  # 1MB chunks
-            if not chunk:
-                break
+        yield csv_processor_pb2.CsvChunk(data=first_chunk, spec=aggregation)
+        telemetry.STAGE_BYTES.labels("upload_receive").inc(len(first_chunk))
+        async for chunk in file_chunks:
             yield csv_processor_pb2.CsvChunk(data=chunk)
+            telemetry.STAGE_BYTES.labels("upload_receive").inc(len(chunk))
 
-    response = await grpc_stub.ProcessCsv(chunk_generator())
-    task_id = response.task_id
-    status = response.status
+    with telemetry.span("POST /upload", carrier=request.headers):
+        try:
+            with telemetry.timed("upload_receive"):
+                response = await grpc_stub.ProcessCsv(
+                    chunk_generator(),
+                    metadata=processing_metadata(
+                        chunks,
+                        engine,
+                        streaming,
+                        time_buckets,
+                        sketches,
+                        profile,
+                        tenant,
+                    ),
+                    compression=upload_compression(first_chunk),
+                )
+        except grpc.aio.AioRpcError as error:
+            return rpc_error_response(error)
+        except asyncio.CancelledError:
+            # A malformed body cancels the call from within
+            if upload.error is None or asyncio.current_task().cancelling():
+                raise
+            return upload_error_response(upload.error)
+    return upload_response(response, request)
 
-    return {
-        "status": status,
-        "task_id": task_id,
-        "download_url": str(request.url_for("download_file", task_id=task_id)),
+
+@app.post("/append/{base_task_id}")
+async def append_file(
+    base_task_id: str,
+    request: Request,
+    chunks: int | None = None,
+    engine: str | None = None,
+    profile: bool = False,
+    tenant: str | None = Header(None, alias="X-Tenant"),
+):
+    try:
+        upload = StreamedUpload(request)
+        file_chunks = upload.chunks()
+        first_chunk = await anext(file_chunks, b"")
+    except UploadError as error:
+        return upload_error_response(error)
+
+    # Only the first chunk needs to name the task being appended to
+    async def chunk_generator():
+        yield csv_processor_pb2.AppendCsvChunk(
+            base_task_id=base_task_id, data=first_chunk
+        )
+        telemetry.STAGE_BYTES.labels("upload_receive").inc(len(first_chunk))
+        async for chunk in file_chunks:
+            yield csv_processor_pb2.AppendCsvChunk(data=chunk)
+            telemetry.STAGE_BYTES.labels("upload_receive").inc(len(chunk))
+
+    with telemetry.span("POST /append", carrier=request.headers):
+        try:
+            with telemetry.timed("upload_receive"):
+                response = await grpc_stub.AppendCsv(
+                    chunk_generator(),
+                    metadata=processing_metadata(
+                        chunks, engine, profile=profile, tenant=tenant
+                    ),
+                    compression=upload_compression(first_chunk),
+                )
+        except grpc.aio.AioRpcError as error:
+            return rpc_error_response(error)
+        except asyncio.CancelledError:
+            # A malformed body cancels the call from within
+            if upload.error is None or asyncio.current_task().cancelling():
+                raise
+            return upload_error_response(upload.error)
+    return upload_response(response, request)
+
+
+@app.get("/metrics")
+async def metrics():
+    body, content_type = telemetry.render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+def progress_payload(progress, completed: bool) -> dict:
+    bytes_per_second = progress.throughput.bytes_per_second
+    eta_seconds = None
+    if not completed and bytes_per_second > 0 and progress.total_bytes:
+        eta_seconds = (
+            progress.total_bytes - progress.bytes_processed
+        ) / bytes_per_second
+    payload = {
+        "lines_processed": progress.lines_processed,
+        "departments": progress.departments,
+        "time_elapsed": progress.time_elapsed,
+        "bytes_processed": progress.bytes_processed,
+        "total_bytes": progress.total_bytes,
+        "throughput": {
+            "rows_per_second": progress.throughput.rows_per_second,
+            "bytes_per_second": bytes_per_second,
+        },
+        "eta_seconds": eta_seconds,
     }
+    if progress.HasField("sketches"):
+        sketches = progress.sketches
+        payload["sketches"] = {
+            "top_departments": [
+                {"department": entry.department, "estimate": entry.estimate}
+                for entry in sketches.top_departments
+            ],
+            "top_error": sketches.top_error,
+            "distinct_departments": sketches.distinct_departments,
+            "distinct_relative_error": sketches.distinct_relative_error,
+        }
+    if progress.phases:
+        payload["phases"] = dict(progress.phases)
+    return payload
 
 
-@app.get("/status/{task_id}")
-async def get_status(task_id: str):
-    response = await grpc_stub.GetProcessingResult(
-        csv_processor_pb2.GetProcessingResultRequest(task_id=task_id)
+class StatusCache:
+    """Coalesce status lookups of the same task.
+
+    A lookup of a task whose status is being fetched waits for that fetch,
+    and a fetched status is reused for ``ttl`` seconds. Tasks that are
+    neither cached nor in flight are fetched together.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._cached: dict[str, tuple[float, object]] = {}
+        self._in_flight: dict[str, asyncio.Task] = {}
+
+    async def get(self, task_ids: list[str]) -> dict:
+        now = time.monotonic()
+        self._cached = {
+            task_id: entry for task_id, entry in self._cached.items() if entry[0] > now
+        }
+        found = {}
+        fetches = {}
+        missing = []
+        for task_id in dict.fromkeys(task_ids):
+            if task_id in self._cached:
+                found[task_id] = self._cached[task_id][1]
+            elif task_id in self._in_flight:
+                fetches[task_id] = self._in_flight[task_id]
+            else:
+                missing.append(task_id)
+        if missing:
+            fetch = asyncio.create_task(self._fetch(missing))
+            for task_id in missing:
+                self._in_flight[task_id] = fetch
+                fetches[task_id] = fetch
+        for task_id, fetch in fetches.items():
+            # Shielded: a client going away must not fail the others waiting
+            found[task_id] = (await asyncio.shield(fetch))[task_id]
+        return found
+
+    async def _fetch(self, task_ids: list[str]) -> dict:
+        try:
+            responses = await fetch_statuses(task_ids)
+        finally:
+            for task_id in task_ids:
+                self._in_flight.pop(task_id, None)
+        expires = time.monotonic() + self.ttl
+        for task_id, response in responses.items():
+            self._cached[task_id] = (expires, response)
+        return responses
+
+
+async def fetch_statuses(task_ids: list[str]) -> dict:
+    if len(task_ids) == 1:
+        (task_id,) = task_ids
+        response = await grpc_stub.GetProcessingResult(
+            csv_processor_pb2.GetProcessingResultRequest(task_id=task_id)
+        )
+        return {task_id: response}
+    response = await grpc_stub.GetProcessingResults(
+        csv_processor_pb2.GetProcessingResultsRequest(task_ids=task_ids)
     )
-    return {
+    return dict(zip(task_ids, response.results))
+
+
+status_cache = StatusCache(STATUS_CACHE_SECONDS)
+
+
+def status_payload(response) -> dict:
+    status = {
         "completed": response.completed,
         "status": response.status,
-        "progress": {
-            "lines_processed": response.progress.lines_processed,
-            "departments": response.progress.departments,
-            "time_elapsed": response.progress.time_elapsed,
-        },
+        "progress": progress_payload(response.progress, response.completed),
     }
+    if response.HasField("queue_position"):
+        status["queue"] = {
+            "name": response.queue,
+            "position": response.queue_position,
+            "estimated_start_seconds": (
+                response.estimated_start_seconds
+                if response.HasField("estimated_start_seconds")
+                else None
+            ),
+        }
+    return status
+
+
+@app.get("/status/{task_id}")
+async def get_status(task_id: str):
+    responses = await status_cache.get([task_id])
+    return status_payload(responses[task_id])
+
+
+@app.post("/status:batch")
+async def get_statuses(task_ids: list[str] = Body(embed=True)):
+    # One gRPC call, and one read of the result backend, for all the tasks
+    if len(task_ids) > STATUS_BATCH_MAX_TASKS:
+        return JSONResponse(
+            content={"error": f"At most {STATUS_BATCH_MAX_TASKS} tasks per batch"},
+            status_code=400,
+        )
+    responses = await status_cache.get(task_ids)
+    return {
+        "tasks": {
+            task_id: status_payload(response) for task_id, response in responses.items()
+        }
+    }
+
+
+@app.delete("/tasks/{task_id}")
+async def cancel_task(task_id: str):
+    try:
+        response = await grpc_stub.CancelTask(
+            csv_processor_pb2.CancelTaskRequest(task_id=task_id)
+        )
+    except grpc.aio.AioRpcError as error:
+        return rpc_error_response(error)
+    # Accepted: a running task stops at its next progress check
+    return JSONResponse(
+        content={"task_id": task_id, "status": response.status}, status_code=202
+    )
+
+
+class ProgressBroadcaster:
+    """Share one upstream ``WatchProgress`` stream per task among watchers.
+
+    Each watcher's mailbox holds only the newest update, so a slow client
+    skips stale progress instead of queueing it; the end-of-stream marker is
+    never dropped. The upstream stream is cancelled when its last watcher
+    leaves.
+    """
+
+    def __init__(self):
+        self._watchers: dict[str, set[asyncio.Queue]] = {}
+        self._upstreams: dict[str, asyncio.Task] = {}
+        self._latest: dict[str, csv_processor_pb2.Progress] = {}
+
+    async def watch(self, task_id: str):
+        mailbox = asyncio.Queue()
+        self._watchers.setdefault(task_id, set()).add(mailbox)
+        if task_id in self._latest:
+            mailbox.put_nowait(self._latest[task_id])
+        upstream = self._upstreams.get(task_id)
+        if upstream is None or upstream.done():
+            self._upstreams[task_id] = asyncio.create_task(self._follow(task_id))
+        try:
+            while (progress := await mailbox.get()) is not None:
+                yield progress
+        finally:
+            watchers = self._watchers.get(task_id)
+            if watchers is not None:
+                watchers.discard(mailbox)
+                if not watchers:
+                    self._upstreams.pop(task_id).cancel()
+                    del self._watchers[task_id]
+                    self._latest.pop(task_id, None)
+
+    def _publish(self, task_id: str, progress) -> None:
+        for mailbox in self._watchers.get(task_id, ()):
+            if progress is not None:
+                while not mailbox.empty():
+                    mailbox.get_nowait()
+            mailbox.put_nowait(progress)
+
+    async def _follow(self, task_id: str) -> None:
+        try:
+            async for progress in grpc_stub.WatchProgress(
+                csv_processor_pb2.WatchProgressRequest(task_id=task_id)
+            ):
+                self._latest[task_id] = progress
+                self._publish(task_id, progress)
+        except grpc.aio.AioRpcError as error:
+            logger.warning("WatchProgress for %s ended: %s", task_id, error.code())
+        finally:
+            # Wake watchers so they finish; the last one cleans up. A stream
+            # cancelled after its watchers left has nobody to wake.
+            if self._upstreams.get(task_id) is asyncio.current_task():
+                self._publish(task_id, None)
+
+
+progress_broadcaster = ProgressBroadcaster()
+
+
+@app.get("/watch/{task_id}")
+async def watch_status(task_id: str):
+    # Server-Sent Events: one "progress" event per update, then "end"
+    async def event_stream():
+        async for progress in progress_broadcaster.watch(task_id):
+            completed = progress.status == "SUCCESS"
+            payload = {
+                "completed": completed,
+                "status": progress.status,
+                "progress": progress_payload(progress, completed),
+            }
+            yield f"event: progress\ndata: {json.dumps(payload)}\n\n"
+        yield "event: end\ndata: {}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def requested_range(
+    range_header: str | None, if_range: str | None, etag: str, size: int
+) -> tuple[int, int] | None:
+    """Return the byte range ``[start, end)`` a request asks for.
+
+    ``None`` means the whole file: no ``Range``, an ``If-Range`` that no longer
+    matches ``etag``, or a header this gateway does not honour (malformed or
+    several ranges), which HTTP allows a server to ignore.
+    """
+    if not range_header or (if_range is not None and if_range != etag):
+        return None
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            suffix = int(last)
+            if suffix <= 0:
+                raise RangeNotSatisfiable
+            return max(0, size - suffix), size
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable
+    if end <= start:
+        return None
+    return start, min(end, size)
+
+
+def accepts_gzip(accept_encoding: str | None) -> bool:
+    """Whether an ``Accept-Encoding`` header allows a gzip response."""
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.partition(";")
+        if coding.strip().lower() not in ("gzip", "*"):
+            continue
+        name, _, value = params.partition("=")
+        if name.strip().lower() != "q":
+            return True
+        try:
+            return float(value) > 0
+        except ValueError:
+            return False
+    return False
+
+
+# Media type and file extension of each result format
+RESULT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "json": ("application/json", "json"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+
+async def rendered_download(task_id: str, result_format: str, etag: str):
+    """Stream a result rendered by the server from the task's aggregate store.
+
+    The first chunk is awaited before answering, so a failure to render is
+    still reported with a proper HTTP status.
+    """
+    chunks = aiter(
+        grpc_stub.DownloadResult(
+            csv_processor_pb2.DownloadResultRequest(
+                task_id=task_id, format=result_format
+            )
+        )
+    )
+    try:
+        first = await anext(chunks, None)
+    except grpc.aio.AioRpcError as error:
+        return rpc_error_response(error)
+
+    async def stream_generator():
+        if first is not None:
+            yield first.data
+        async for chunk in chunks:
+            yield chunk.data
+
+    media_type, extension = RESULT_FORMATS[result_format]
+    headers = {
+        "Content-Disposition": f"attachment; filename={task_id}_result.{extension}"
+    }
+    if etag:
+        headers["ETag"] = f'{etag[:-1]}-{result_format}"'
+    return StreamingResponse(stream_generator(), media_type=media_type, headers=headers)
 
 
 @app.get("/download/{task_id}")
-async def download_file(task_id: str):
+async def download_file(
+    task_id: str, request: Request, result_format: str = Query("csv", alias="format")
+):
+    if result_format not in RESULT_FORMATS:
+        return JSONResponse(
+            content={"error": f"Unknown format: {result_format}"}, status_code=400
+        )
+
     # Check completion using global stub
     status_response = await grpc_stub.GetProcessingResult(
         csv_processor_pb2.GetProcessingResultRequest(task_id=task_id)
@@ -88,20 +814,162 @@ async def download_file(task_id: str):
             content={"error": "Processing not completed"}, status_code=400
         )
 
+    if result_format != "csv":
+        return await rendered_download(
+            task_id, result_format, status_response.result_etag
+        )
+
+    # Serve the gzip copy of the result to clients that accept it
+    encoding = ""
+    etag = status_response.result_etag
+    size = status_response.result_size
+    result_path = status_response.processed_csv_path
+    if status_response.gzip_result_size and accepts_gzip(
+        request.headers.get("accept-encoding")
+    ):
+        encoding = "gzip"
+        etag = etag[:-1] + '-gzip"' if etag else etag
+        size = status_response.gzip_result_size
+        result_path += ".gz"
+    headers = {"Vary": "Accept-Encoding"}
+    if etag:
+        headers["ETag"] = etag
+    if encoding:
+        headers["Content-Encoding"] = encoding
+
+    filename = f"{task_id}_result.csv"
+    if etag and request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    # Serve straight from disk (sendfile) when the results volume is shared
+    if SERVE_RESULTS_FROM_DISK and result_path and os.path.isfile(result_path):
+        return FileResponse(
+            result_path, media_type="text/csv", filename=filename, headers=headers
+        )
+
+    # Otherwise proxy the requested bytes through DownloadResult
+    headers["Content-Disposition"] = f"attachment; filename={filename}"
+    headers["Accept-Ranges"] = "bytes"
+    try:
+        # Ranges need the size, which servers predating it do not report
+        byte_range = size and requested_range(
+            request.headers.get("range"), request.headers.get("if-range"), etag, size
+        )
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    start, end = byte_range or (0, size)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    if size:
+        headers["Content-Length"] = str(end - start)
+
     # Stream using global stub
     async def stream_generator():
         async for chunk in grpc_stub.DownloadResult(
-            csv_processor_pb2.DownloadResultRequest(task_id=task_id)
+            csv_processor_pb2.DownloadResultRequest(
+                task_id=task_id,
+                offset=start,
+                length=end - start if size else 0,
+                encoding=encoding,
+            )
         ):
             yield chunk.data
 
     return StreamingResponse(
         stream_generator(),
+        status_code=206 if byte_range else 200,
         media_type="text/csv",
-        headers={"Content-Disposition": f"attachment; filename={task_id}_result.csv"},
+        headers=headers,
     )
 
 
+PROFILE_FORMATS = {
+    "pstats": ("application/octet-stream", "pstats"),
+    "text": ("text/plain; charset=utf-8", "txt"),
+}
+
+
+@app.get("/results/{task_id}/profile")
+async def download_profile(
+    task_id: str, profile_format: str = Query("pstats", alias="format")
+):
+    if profile_format not in PROFILE_FORMATS:
+        return JSONResponse(
+            content={"error": f"Unknown format: {profile_format}"}, status_code=400
+        )
+    try:
+        data = b"".join(
+            [
+                chunk.data
+                async for chunk in grpc_stub.DownloadProfile(
+                    csv_processor_pb2.DownloadProfileRequest(
+                        task_id=task_id, format=profile_format
+                    )
+                )
+            ]
+        )
+    except grpc.aio.AioRpcError as error:
+        return rpc_error_response(error)
+    media_type, extension = PROFILE_FORMATS[profile_format]
+    return Response(
+        content=data,
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f"attachment; filename={task_id}_profile.{extension}"
+        },
+    )
+
+
+@app.get("/results/{task_id}/departments/{department:path}")
+async def department_total(task_id: str, department: str):
+    try:
+        response = await grpc_stub.GetDepartmentTotal(
+            csv_processor_pb2.GetDepartmentTotalRequest(
+                task_id=task_id, department=department
+            )
+        )
+    except grpc.aio.AioRpcError as error:
+        return rpc_error_response(error)
+    if not response.found:
+        return JSONResponse(
+            content={"error": f"Unknown department: {department}"}, status_code=404
+        )
+    return {"department": department, "total": response.total}
+
+
+@app.get("/results/{task_id}/periods")
+async def period_totals(
+    task_id: str,
+    granularity: str = "day",
+    start: str | None = None,
+    end: str | None = None,
+    department: str | None = None,
+):
+    try:
+        response = await grpc_stub.GetPeriodTotals(
+            csv_processor_pb2.GetPeriodTotalsRequest(
+                task_id=task_id,
+                granularity=granularity,
+                start_date=start or "",
+                end_date=end or "",
+                department=department,
+            )
+        )
+    except grpc.aio.AioRpcError as error:
+        return rpc_error_response(error)
+    return {
+        "granularity": granularity,
+        "totals": [
+            {
+                "period": total.period,
+                "department": total.department,
+                "total": total.total,
+            }
+            for total in response.totals
+        ],
+    }
+
+
 if __name__ == "__main__":
     host = os.getenv("FASTAPI_HOST", "0.0.0.0")
     port = int(os.getenv("FASTAPI_PORT", 8000))
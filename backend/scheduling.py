@@ -0,0 +1,270 @@
+"""Bookkeeping for queue positions and per-tenant concurrency caps.
+
+Celery's brokers cannot say where a message sits in its queue, so each
+published task is recorded here with the time it was queued, and dropped
+again when a worker starts it. How often the queue's tasks finish gives an
+estimate of when a queued task will start.
+
+Tenants hold a slot per running job. A job that finds its tenant at the cap
+goes back to the end of the queue, so one tenant's backlog cannot take every
+worker while other tenants wait.
+
+Cancelled jobs are flagged here too, for workers to notice at their next
+progress check and for status reads to report.
+
+State lives in Redis when there is one, shared by the gRPC servers and the
+workers; otherwise it is kept in the process, which suits eager mode.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Set
+
+# Weight of the newest interval between task completions in a queue's pace
+PACE_SMOOTHING = 0.2
+
+_ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZSCORE', KEYS[1], ARGV[3])
+    or redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+  redis.call('ZADD', KEYS[1], ARGV[4], ARGV[3])
+  redis.call('EXPIRE', KEYS[1], ARGV[5])
+  return 1
+end
+return 0
+"""
+
+
+class QueuePosition:
+    """Where a task waits in its queue.
+
+    ``start_seconds`` estimates when it starts, None until the queue's pace
+    is known.
+    """
+
+    def __init__(self, queue: str, ahead: int, start_seconds: Optional[float]):
+        self.queue = queue
+        self.ahead = ahead
+        self.start_seconds = start_seconds
+
+
+class Scheduler:
+    """Queue and tenant bookkeeping, in Redis when ``client`` is given.
+
+    Entries older than ``entry_ttl`` seconds are forgotten, so a task lost
+    with its worker does not hold a position or a slot forever. Cancellations
+    are kept for ``cancel_ttl`` seconds, as long as Celery keeps results by
+    default.
+    """
+
+    def __init__(
+        self,
+        queues,
+        client=None,
+        entry_ttl: float = 24 * 3600,
+        cancel_ttl: float = 24 * 3600,
+    ):
+        self.queues = tuple(queues)
+        self.client = client
+        self.entry_ttl = entry_ttl
+        self.cancel_ttl = cancel_ttl
+        self._lock = threading.Lock()
+        self._queued: Dict[str, Dict[str, float]] = defaultdict(dict)
+        self._pace: Dict[str, Dict[str, float]] = defaultdict(dict)
+        self._slots: Dict[str, Dict[str, float]] = defaultdict(dict)
+        self._cancelled: Dict[str, float] = {}
+        self._acquire = client.register_script(_ACQUIRE_SCRIPT) if client else None
+
+    @staticmethod
+    def _queue_key(queue: str) -> str:
+        return f"csv-processor:queued:{queue}"
+
+    @staticmethod
+    def _pace_key(queue: str) -> str:
+        return f"csv-processor:pace:{queue}"
+
+    @staticmethod
+    def _tenant_key(tenant: str) -> str:
+        return f"csv-processor:tenant:{tenant}"
+
+    @staticmethod
+    def _cancel_key(task_id: str) -> str:
+        return f"csv-processor:cancelled:{task_id}"
+
+    def queued(self, queue: str, task_id: str) -> None:
+        """Record that ``task_id`` was published to ``queue``."""
+        if queue not in self.queues:
+            return
+        now = time.time()
+        if self.client is None:
+            with self._lock:
+                self._queued[queue][task_id] = now
+            return
+        key = self._queue_key(queue)
+        with self.client.pipeline() as pipe:
+            pipe.zadd(key, {task_id: now})
+            pipe.zremrangebyscore(key, "-inf", now - self.entry_ttl)
+            pipe.execute()
+
+    def started(self, queue: str, task_id: str) -> None:
+        """Drop ``task_id`` from ``queue``."""
+        if queue not in self.queues:
+            return
+        if self.client is None:
+            with self._lock:
+                self._queued[queue].pop(task_id, None)
+            return
+        self.client.zrem(self._queue_key(queue), task_id)
+
+    def finished(self, queue: str) -> None:
+        """Update the pace of ``queue`` as one of its tasks finishes.
+
+        The pace only learns while other tasks wait, so an idle queue does
+        not slow its estimate down.
+        """
+        if queue not in self.queues:
+            return
+        now = time.time()
+        if self.client is None:
+            with self._lock:
+                self._update_pace(self._pace[queue], now, bool(self._queued[queue]))
+            return
+        pace_key = self._pace_key(queue)
+        with self.client.pipeline() as pipe:
+            pipe.zcard(self._queue_key(queue))
+            pipe.hgetall(pace_key)
+            waiting, stored = pipe.execute()
+        pace = {field.decode(): float(value) for field, value in stored.items()}
+        self._update_pace(pace, now, bool(waiting))
+        self.client.hset(pace_key, mapping=pace)
+
+    @staticmethod
+    def _update_pace(pace: Dict[str, float], now: float, waiting: bool) -> None:
+        last = pace.get("last_finish")
+        if waiting and last is not None:
+            interval = now - last
+            previous = pace.get("interval")
+            if previous is not None:
+                interval = PACE_SMOOTHING * interval + (1 - PACE_SMOOTHING) * previous
+            pace["interval"] = interval
+        pace["last_finish"] = now
+
+    def position(self, task_id: str) -> Optional[QueuePosition]:
+        """Where ``task_id`` waits, or None if it is not queued."""
+        return self.positions([task_id]).get(task_id)
+
+    def positions(self, task_ids: Iterable[str]) -> Dict[str, QueuePosition]:
+        """Where each of ``task_ids`` waits, leaving out those not queued.
+
+        A queued task starts once the tasks ahead of it have started and a
+        worker has finished one more, a finish every pace interval. Every
+        queue is read in one round trip to Redis.
+        """
+        task_ids = list(task_ids)
+        now = time.time()
+        found = {}
+        if self.client is None:
+            with self._lock:
+                for queue in self.queues:
+                    queued = self._queued[queue]
+                    for task_id in task_ids:
+                        if task_id in queued and task_id not in found:
+                            at = queued[task_id]
+                            ahead = sum(1 for other in queued.values() if other < at)
+                            found[task_id] = (queue, ahead, dict(self._pace[queue]))
+        elif task_ids:
+            with self.client.pipeline() as pipe:
+                for queue in self.queues:
+                    key = self._queue_key(queue)
+                    pipe.zremrangebyscore(key, "-inf", now - self.entry_ttl)
+                    pipe.hgetall(self._pace_key(queue))
+                    for task_id in task_ids:
+                        pipe.zrank(key, task_id)
+                replies = iter(pipe.execute())
+            for queue in self.queues:
+                next(replies)
+                stored = next(replies)
+                pace = {field.decode(): float(value) for field, value in stored.items()}
+                for task_id in task_ids:
+                    ahead = next(replies)
+                    if ahead is not None and task_id not in found:
+                        found[task_id] = (queue, ahead, pace)
+        positions = {}
+        for task_id, (queue, ahead, pace) in found.items():
+            start_seconds = None
+            if "interval" in pace:
+                since_finish = now - pace["last_finish"]
+                start_seconds = max(0.0, (ahead + 1) * pace["interval"] - since_finish)
+            positions[task_id] = QueuePosition(queue, ahead, start_seconds)
+        return positions
+
+    def acquire(self, tenant: str, job_id: str, limit: int) -> bool:
+        """Take one of ``tenant``'s ``limit`` job slots for ``job_id``.
+
+        Returns False when the tenant already runs ``limit`` other jobs; a
+        ``limit`` of 0 never does. Taking a held slot again succeeds.
+        """
+        if not limit:
+            return True
+        now = time.time()
+        if self.client is None:
+            with self._lock:
+                slots = self._slots[tenant]
+                for held, expires in list(slots.items()):
+                    if expires <= now:
+                        del slots[held]
+                if job_id not in slots and len(slots) >= limit:
+                    return False
+                slots[job_id] = now + self.entry_ttl
+                return True
+        return bool(
+            self._acquire(
+                keys=[self._tenant_key(tenant)],
+                args=[now, limit, job_id, now + self.entry_ttl, int(self.entry_ttl)],
+            )
+        )
+
+    def release(self, tenant: str, job_id: str) -> None:
+        if self.client is None:
+            with self._lock:
+                self._slots[tenant].pop(job_id, None)
+            return
+        self.client.zrem(self._tenant_key(tenant), job_id)
+
+    def cancel(self, task_ids: Iterable[str]) -> None:
+        """Flag ``task_ids`` as cancelled and drop them from their queues."""
+        task_ids = list(task_ids)
+        if self.client is None:
+            expires = time.time() + self.cancel_ttl
+            with self._lock:
+                for task_id in task_ids:
+                    self._cancelled[task_id] = expires
+                    for queued in self._queued.values():
+                        queued.pop(task_id, None)
+            return
+        with self.client.pipeline() as pipe:
+            for task_id in task_ids:
+                pipe.set(self._cancel_key(task_id), 1, ex=int(self.cancel_ttl))
+            for queue in self.queues:
+                pipe.zrem(self._queue_key(queue), *task_ids)
+            pipe.execute()
+
+    def cancelled(self, task_id: str) -> bool:
+        return task_id in self.cancelled_among([task_id])
+
+    def cancelled_among(self, task_ids: Iterable[str]) -> Set[str]:
+        """Those of ``task_ids`` that are cancelled, read with one MGET."""
+        task_ids = list(task_ids)
+        if self.client is None:
+            now = time.time()
+            with self._lock:
+                return {
+                    task_id
+                    for task_id in task_ids
+                    if self._cancelled.get(task_id, 0) > now
+                }
+        if not task_ids:
+            return set()
+        flags = self.client.mget([self._cancel_key(task_id) for task_id in task_ids])
+        return {task_id for task_id, flag in zip(task_ids, flags) if flag is not None}
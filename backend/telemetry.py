@@ -0,0 +1,333 @@
+"""Prometheus metrics and OpenTelemetry trace propagation for the pipeline.
+
+Both are optional: without ``prometheus_client`` every metric is a no-op, and
+without ``opentelemetry-api`` no spans are started or propagated. Metrics are
+recorded per request, stage, block or task, never per row.
+
+A trace starts from the ``traceparent`` of the HTTP request, travels to the
+gRPC server as call metadata and on to Celery as task headers.
+"""
+
+import contextlib
+import functools
+import inspect
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+try:
+    import prometheus_client
+    import prometheus_client.multiprocess
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:  # Metrics are optional
+    prometheus_client = None
+
+try:
+    from opentelemetry import context as trace_context
+    from opentelemetry import propagate, trace
+except ImportError:  # Tracing is optional
+    propagate = trace = None
+
+# Stages of an upload, in order. Parse covers reading, decompressing and
+# splitting the CSV into fields; aggregate is the rest of the pass.
+STAGES = (
+    "upload_receive",
+    "spool",
+    "queue_wait",
+    "parse",
+    "aggregate",
+    "merge",
+    "write",
+    "download",
+)
+# Stages range from milliseconds for a small lookup to many minutes for a
+# multi-gigabyte upload
+STAGE_BUCKETS = (0.005, 0.025, 0.1, 0.25, 1, 2.5, 10, 30, 60, 300, 900, 3600)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs) -> "_NoopMetric":
+        return self
+
+    def observe(self, amount: float) -> None:
+        pass
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def dec(self, amount: float = 1) -> None:
+        pass
+
+
+def _metric(kind: str, name: str, documentation: str, labelnames=(), **kwargs):
+    if prometheus_client is None:
+        return _NoopMetric()
+    if kind == "Gauge":
+        # Sum the gauges of all live processes in multiprocess mode
+        kwargs.setdefault("multiprocess_mode", "livesum")
+    metric = getattr(prometheus_client, kind)
+    return metric(name, documentation, labelnames, **kwargs)
+
+
+STAGE_SECONDS = _metric(
+    "Histogram",
+    "csv_stage_seconds",
+    "Time spent in each stage of processing an upload",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+STAGE_BYTES = _metric(
+    "Counter", "csv_stage_bytes", "Bytes handled by each stage", ["stage"]
+)
+ROWS = _metric("Counter", "csv_rows", "CSV rows aggregated", ["engine"])
+RPC_SECONDS = _metric(
+    "Histogram",
+    "csv_grpc_request_seconds",
+    "Duration of gRPC calls handled by the server",
+    ["method"],
+    buckets=STAGE_BUCKETS,
+)
+RPCS_IN_FLIGHT = _metric(
+    "Gauge",
+    "csv_grpc_requests_in_flight",
+    "gRPC calls being handled by the server",
+    ["method"],
+)
+EXECUTOR_QUEUED = _metric(
+    "Gauge",
+    "csv_grpc_executor_queued",
+    "Blocking calls waiting for a thread of the gRPC server's pool",
+)
+EXECUTOR_ACTIVE = _metric(
+    "Gauge",
+    "csv_grpc_executor_active",
+    "Blocking calls running on a thread of the gRPC server's pool",
+)
+
+POOL_CALLS = _metric(
+    "Counter",
+    "csv_gateway_pool_calls",
+    "gRPC calls the gateway sent to each server",
+    ["backend"],
+)
+POOL_IN_FLIGHT = _metric(
+    "Gauge",
+    "csv_gateway_pool_in_flight",
+    "gRPC calls in flight from the gateway to each server",
+    ["backend"],
+)
+POOL_HEALTHY = _metric(
+    "Gauge",
+    "csv_gateway_pool_healthy_channels",
+    "Healthy channels from the gateway to each server",
+    ["backend"],
+)
+POOL_RETRIES = _metric(
+    "Counter",
+    "csv_gateway_pool_retries",
+    "gRPC calls the gateway retried on another server",
+    ["method"],
+)
+
+
+@functools.cache
+def metrics_registry():
+    """Registry to expose: the multiprocess one with PROMETHEUS_MULTIPROC_DIR.
+
+    Prefork servers (Celery workers, several gRPC workers) must set
+    PROMETHEUS_MULTIPROC_DIR so the parent also reports its children.
+    """
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        return prometheus_client.REGISTRY
+    registry = prometheus_client.CollectorRegistry()
+    prometheus_client.multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """The metrics in the Prometheus text format, and its content type."""
+    if prometheus_client is None:
+        return b"", "text/plain; charset=utf-8"
+    return (
+        prometheus_client.generate_latest(metrics_registry()),
+        prometheus_client.CONTENT_TYPE_LATEST,
+    )
+
+
+def serve_metrics(port: Optional[int]) -> None:
+    """Expose the metrics over HTTP on ``port``, if metrics are available."""
+    if prometheus_client is None or not port:
+        return
+    prometheus_client.start_http_server(port, registry=metrics_registry())
+
+
+def process_exited(pid: int) -> None:
+    """Drop the live gauges of a child process that exited."""
+    if prometheus_client is not None and os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        prometheus_client.multiprocess.mark_process_dead(pid)
+
+
+class _QueueDepthCollector:
+    def __init__(self, read_depths: Callable[[], Dict[str, int]]):
+        self.read_depths = read_depths
+
+    def collect(self):
+        depth = GaugeMetricFamily(
+            "csv_celery_queue_depth",
+            "Tasks waiting in a Celery queue",
+            labels=["queue"],
+        )
+        for queue, length in self.read_depths().items():
+            depth.add_metric([queue], length)
+        yield depth
+
+
+def watch_queue_depth(read_depths: Callable[[], Dict[str, int]]) -> None:
+    """Report the queue lengths ``read_depths`` returns each time metrics are read."""
+    if prometheus_client is not None:
+        metrics_registry().register(_QueueDepthCollector(read_depths))
+
+
+@contextlib.contextmanager
+def timed(stage: str, phases: Optional[Dict[str, float]] = None):
+    """Record the time spent in the block under ``stage``.
+
+    With ``phases``, a task's breakdown of its time, the time is also added
+    to ``phases[stage]``.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage).observe(seconds)
+        if phases is not None:
+            phases[stage] = phases.get(stage, 0.0) + seconds
+
+
+def observe_stage(stage: str, seconds: float, size: int = 0) -> None:
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    if size:
+        STAGE_BYTES.labels(stage).inc(size)
+
+
+class InstrumentedThreadPoolExecutor(ThreadPoolExecutor):
+    """Thread pool reporting how many calls wait for and run on its threads."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        def run():
+            EXECUTOR_QUEUED.dec()
+            EXECUTOR_ACTIVE.inc()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                EXECUTOR_ACTIVE.dec()
+
+        EXECUTOR_QUEUED.inc()
+        future = super().submit(run)
+        # A call cancelled before it started never leaves the queue
+        future.add_done_callback(lambda f: f.cancelled() and EXECUTOR_QUEUED.dec())
+        return future
+
+
+def span(name: str, carrier=None, **attributes):
+    """Context manager running ``name`` as the current span.
+
+    With ``carrier``, a mapping of trace headers, the span continues the
+    trace they describe; otherwise it is a child of the current span.
+    """
+    if trace is None:
+        return contextlib.nullcontext()
+    context = propagate.extract(carrier) if carrier else None
+    return trace.get_tracer(__name__).start_as_current_span(
+        name, context=context, attributes=attributes or None
+    )
+
+
+def attach_span(name: str, carrier=None):
+    """Start ``name`` as the current span until :func:`detach_span`.
+
+    For spans that cannot wrap a ``with`` block, such as a task's run
+    between two signals. Returns the handle to pass to :func:`detach_span`.
+    """
+    if trace is None:
+        return None
+    context = propagate.extract(carrier) if carrier else None
+    current = trace.get_tracer(__name__).start_span(name, context=context)
+    return current, trace_context.attach(trace.set_span_in_context(current))
+
+
+def detach_span(handle) -> None:
+    if handle is not None:
+        current, token = handle
+        trace_context.detach(token)
+        current.end()
+
+
+def inject(carrier: Optional[dict] = None) -> dict:
+    """Add the headers describing the current trace to ``carrier``."""
+    carrier = {} if carrier is None else carrier
+    if propagate is not None:
+        propagate.inject(carrier)
+    return carrier
+
+
+def task_header(request, name: str):
+    """Value of the custom header ``name`` of a Celery task request."""
+    # Workers copy custom headers onto the request; eager calls keep them
+    # in request.headers
+    value = getattr(request, name, None)
+    if value is None:
+        value = (getattr(request, "headers", None) or {}).get(name)
+    return value
+
+
+def task_carrier(request) -> dict:
+    """Trace headers a Celery task was sent with."""
+    if propagate is None:
+        return {}
+    carrier = {}
+    for field in propagate.get_global_textmap().fields:
+        value = task_header(request, field)
+        if value is not None:
+            carrier[field] = value
+    return carrier
+
+
+@contextlib.contextmanager
+def _rpc_scope(name: str, context):
+    RPCS_IN_FLIGHT.labels(name).inc()
+    started = time.perf_counter()
+    try:
+        metadata = dict(context.invocation_metadata() or ())
+        with span(f"CsvProcessor/{name}", carrier=metadata):
+            yield
+    finally:
+        RPC_SECONDS.labels(name).observe(time.perf_counter() - started)
+        RPCS_IN_FLIGHT.labels(name).dec()
+
+
+def rpc(method):
+    """Instrument a gRPC servicer method, unary or streaming responses alike.
+
+    The call is counted in flight and timed, and runs in a span continuing
+    the trace in its metadata.
+    """
+    name = method.__name__
+    if inspect.isasyncgenfunction(method):
+
+        @functools.wraps(method)
+        async def streaming(self, request, context):
+            with _rpc_scope(name, context):
+                async for response in method(self, request, context):
+                    yield response
+
+        return streaming
+
+    @functools.wraps(method)
+    async def unary(self, request, context):
+        with _rpc_scope(name, context):
+            return await method(self, request, context)
+
+    return unary
@@ -1,12 +1,67 @@
+import asyncio
+import concurrent.futures
 import csv
+import gzip
+import importlib.util
 import io
 import os
+import pstats
+import sys
 import tempfile
+import threading
+import time
+import weakref
 from collections import defaultdict
 
+import grpc
 import pytest
 
-from .celery_app import read_csv_rows, aggregate_sales, create_csv_from_aggregated
+from . import celery_app as celery_module
+from .scheduling import Scheduler
+from .celery_app import (
+    AggregateStore,
+    AggregateStoreCache,
+    AggregationPlan,
+    Checkpoint,
+    ColumnarSalesReader,
+    CsvRowReader,
+    HyperLogLog,
+    ProgressThrottle,
+    RecordSplitter,
+    ResultCache,
+    SalesSketches,
+    SpillingAggregator,
+    StreamingSalesAggregator,
+    aggregate_sales,
+    aggregate_sales_by_day,
+    aggregate_sketched,
+    combine_profiles,
+    create_csv_from_aggregated,
+    file_compression,
+    load_aggregate_state,
+    load_grouped_state,
+    make_progress_reporter,
+    normalize_spec,
+    merge_partial_sales,
+    open_sales_reader,
+    aggregate_reader,
+    period_totals,
+    plan_chunks,
+    profile_path_for,
+    profiled,
+    read_csv_rows,
+    render_profile,
+    render_result,
+    rollup_daily,
+    split_line_ranges,
+    write_grouped_result,
+    write_task_result,
+)
+
+
+def sample_csv(name):
+    """Path of a sample CSV, wherever the tests are run from."""
+    return os.path.join(os.path.dirname(__file__), "test_csvs", name)
 
 
 class TestReadCsvRows:
@@ -78,7 +133,7 @@ class TestAggregateSales:
         assert dict(sales) == dict(expected)
         assert len(progress_calls) == 4  # Called for each row + final
 
-    @pytest.mark.parametrize("csv_file", ["test_csvs/test_sales1.csv", "test_csvs/test_sales2.csv", "test_csvs/test_sales3.csv"])
+    @pytest.mark.parametrize("csv_file", [sample_csv("test_sales1.csv"), sample_csv("test_sales2.csv"), sample_csv("test_sales3.csv")])
     def test_aggregate_sales_with_test_csvs(self, csv_file):
         if not os.path.exists(csv_file):
             pytest.skip(f"Test CSV {csv_file} not found")
@@ -113,4 +168,941 @@ class TestCreateCsvFromAggregated:
         output.seek(0)
         reader = csv.reader(io.StringIO(output.getvalue()))
         rows = list(reader)
-        assert rows == [['Department Name', 'Total Sales']]
\ No newline at end of file
+        assert rows == [['Department Name', 'Total Sales']]
+
+
+class TestParallelChunks:
+    def test_splitter_ignores_quoted_newlines(self):
+        data = b'Home,2023-01-01,5\n"Multi\nline",2023-01-02,'
+        assert RecordSplitter().feed(data) == b'Home,2023-01-01,5\n'
+        assert RecordSplitter().feed(b'no newline yet') == b''
+
+    def test_stray_quote_does_not_hold_back_records(self):
+        # The quote in 12" is part of the value, not the start of a quoted field
+        rows = ['Department Name,Date,Number of Sales\n', 'Electronics,12" TVs,3\n']
+        rows += ['Home,2023-01-01,%d\n' % i for i in range(2000)]
+        data = ''.join(rows).encode()
+        splitter = RecordSplitter()
+        cut = b''
+        for i in range(0, len(data), 64):
+            cut += splitter.feed(data[i:i + 64])
+            assert len(splitter.pending) < 64 + len(max(rows))
+        assert cut == data and splitter.pending == b''
+
+    def test_splitter_matches_csv_reader_across_pieces(self):
+        data = b'a,"x\n""y""\n",1\nb,12" TVs,2\n"c\r\n",3\n'
+        for size in range(1, len(data) + 1):
+            splitter = RecordSplitter()
+            records = b''.join(splitter.feed(data[i:i + size]) for i in range(0, len(data), size))
+            assert records == data
+            assert list(csv.reader(io.StringIO(records.decode(), newline=''))) == [
+                ['a', 'x\n"y"\n', '1'], ['b', '12" TVs', '2'], ['c\r\n', '3'],
+            ]
+
+    def test_row_reader_small_blocks_match_full_read(self):
+        csv_file = sample_csv("test_sales1.csv")
+        expected = list(read_csv_rows(csv_file))
+        assert list(CsvRowReader(csv_file, block_size=7)) == expected
+
+    def test_row_reader_times_parsing_a_slice_at_a_time(self, monkeypatch):
+        csv_file = sample_csv("test_sales2.csv")
+        expected = list(read_csv_rows(csv_file))
+        monkeypatch.setattr(CsvRowReader, 'PARSE_ROWS', 3)
+        reader = CsvRowReader(csv_file, block_size=50)
+        assert list(reader) == expected
+        assert reader.parse_seconds > 0
+
+    @pytest.mark.parametrize("chunks", [1, 2, 3, 7, 50])
+    def test_split_line_ranges_cover_file_on_line_boundaries(self, chunks):
+        csv_file = sample_csv("test_sales2.csv")
+        ranges = split_line_ranges(csv_file, chunks)
+        assert ranges[0][0] == 0
+        assert ranges[-1][1] == os.path.getsize(csv_file)
+        with open(csv_file, 'rb') as f:
+            data = f.read()
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            assert end == start
+            assert data[start - 1:start] == b'\n'
+
+    @pytest.mark.parametrize("chunks", [2, 3, 5, 8, 13])
+    def test_ranges_never_split_quoted_newlines(self, chunks):
+        with tempfile.NamedTemporaryFile(mode='w', newline='', delete=False, suffix='.csv') as f:
+            f.write('Department Name,Date,Number of Sales\n')
+            for i in range(40):
+                # Quoted newlines that look like whole records of their own
+                f.write('"Dept %d\nHome,2023-01-01,999\n",2023-01-01,%d\n' % (i % 3, i))
+        try:
+            serial = aggregate_sales(read_csv_rows(f.name))
+            ranges = split_line_ranges(f.name, chunks)
+            assert len(ranges) > 1
+            merged = merge_partial_sales(
+                [aggregate_sales(read_csv_rows(f.name, start, end)) for start, end in ranges]
+            )
+            assert list(merged.items()) == list(serial.items())
+            assert 'Home' not in merged
+        finally:
+            os.remove(f.name)
+
+    @pytest.mark.parametrize("csv_file", [sample_csv("test_sales1.csv"), sample_csv("test_sales2.csv"), sample_csv("test_sales3.csv")])
+    def test_merged_partials_match_serial(self, csv_file):
+        serial = aggregate_sales(read_csv_rows(csv_file))
+        partials = [
+            aggregate_sales(read_csv_rows(csv_file, start, end))
+            for start, end in split_line_ranges(csv_file, 4)
+        ]
+        merged = merge_partial_sales(partials)
+        assert list(merged.items()) == list(serial.items())
+
+
+class TestProgressThrottle:
+    def make_throttle(self, **kwargs):
+        self.now = 0.0
+        return ProgressThrottle(clock=lambda: self.now, **kwargs)
+
+    def test_caps_update_rate(self):
+        throttle = self.make_throttle(total_bytes=100, max_per_second=2, percent_step=1)
+        self.now = 0.1
+        assert not throttle.ready(50)  # Too soon after the last write
+        self.now = 0.5
+        assert throttle.ready(50)
+        self.now = 0.6
+        assert not throttle.ready(90)
+
+    def test_zero_rate_is_uncapped(self):
+        throttle = self.make_throttle(total_bytes=100, max_per_second=0, percent_step=1)
+        assert throttle.ready(1)
+        assert throttle.ready(2)
+
+    def test_waits_for_percent_step_or_heartbeat(self):
+        throttle = self.make_throttle(total_bytes=1000, max_per_second=10, percent_step=10, heartbeat=5)
+        self.now = 1.0
+        assert not throttle.ready(50)
+        assert throttle.ready(100)
+        self.now = 3.0
+        assert not throttle.ready(150)
+        self.now = 6.5
+        assert throttle.ready(150)  # Heartbeat
+
+
+@pytest.mark.skipif(importlib.util.find_spec("pyarrow") is None, reason="pyarrow not installed")
+class TestColumnarSalesReader:
+    @pytest.mark.parametrize("csv_file", [sample_csv("test_sales1.csv"), sample_csv("test_sales2.csv"), sample_csv("test_sales3.csv")])
+    def test_matches_row_engine(self, csv_file):
+        expected = aggregate_sales(read_csv_rows(csv_file))
+        sales = ColumnarSalesReader(csv_file, block_size=256).aggregate()
+        assert list(sales.items()) == list(expected.items())
+
+    def test_keeps_skip_semantics_for_dirty_rows(self):
+        with tempfile.NamedTemporaryFile(mode='w', newline='', delete=False, suffix='.csv') as f:
+            f.write('Department Name,Date,Number of Sales\n')
+            f.write('Toys,2023-01-01,abc\n')  # Registers Toys with 0
+            f.write('Beauty,2023-07-15, +100 \n')
+            f.write('Sports\n')  # Short row
+            f.write('\n')
+            f.write('Beauty,2023-09-30,1_000\n')
+            f.write('Home,2023-02-18,12345678901234567890\n')
+            f.write('"Home",2023-02-19,-5\n')
+            temp_file = f.name
+
+        try:
+            expected = aggregate_sales(read_csv_rows(temp_file))
+            sales = ColumnarSalesReader(temp_file).aggregate()
+            assert list(sales.items()) == list(expected.items())
+            assert sales['Toys'] == 0
+        finally:
+            os.unlink(temp_file)
+
+    def test_aggregates_byte_ranges(self):
+        csv_file = sample_csv("test_sales3.csv")
+        partials = [
+            ColumnarSalesReader(csv_file, start, end).aggregate()
+            for start, end in split_line_ranges(csv_file, 3)
+        ]
+        expected = aggregate_sales(read_csv_rows(csv_file))
+        assert list(merge_partial_sales(partials).items()) == list(expected.items())
+
+
+class TestStreamingSalesAggregator:
+    def feed_in_chunks(self, data, chunk_size):
+        aggregator = StreamingSalesAggregator()
+        for i in range(0, len(data), chunk_size):
+            aggregator.feed(data[i:i + chunk_size])
+        return aggregator, aggregator.close()
+
+    @pytest.mark.parametrize("chunk_size", [1, 5, 64, 1024 * 1024])
+    def test_matches_file_aggregation(self, chunk_size):
+        csv_file = sample_csv("test_sales1.csv")
+        with open(csv_file, 'rb') as f:
+            data = f.read()
+        aggregator, sales = self.feed_in_chunks(data, chunk_size)
+        expected = aggregate_sales(read_csv_rows(csv_file))
+        assert list(sales.items()) == list(expected.items())
+        assert aggregator.lines_processed == len(list(read_csv_rows(csv_file)))
+        assert aggregator.bytes_processed == len(data)
+
+    @pytest.mark.parametrize("chunk_size", [1, 3, 7])
+    def test_records_spanning_chunks(self, chunk_size):
+        data = 'Department Name,Date,Number of Sales\n"Caf\u00e9\nBar",2023-01-01,5\nHome,2023-01-02,7\n"Caf\u00e9\nBar",2023-01-03,1'.encode()
+        _, sales = self.feed_in_chunks(data, chunk_size)
+        assert dict(sales) == {'Caf\u00e9\nBar': 6, 'Home': 7}
+
+    def test_stray_quote_does_not_hold_back_chunks(self):
+        rows = ['Department Name,Date,Number of Sales\n', '12" TVs,2023-01-01,4\n']
+        rows += ['Home,2023-01-%02d,1\n' % (i % 28 + 1) for i in range(1000)]
+        data = ''.join(rows).encode()
+        aggregator = StreamingSalesAggregator()
+        for i in range(0, len(data), 100):
+            aggregator.feed(data[i:i + 100])
+            assert len(aggregator._splitter.pending) < 100 + len(max(rows))
+        assert dict(aggregator.close()) == {'12" TVs': 4, 'Home': 1000}
+
+
+class TestResultCache:
+    @pytest.fixture
+    def cache(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(celery_module, "RESULTS_DIR", str(tmp_path))
+        return ResultCache(directory=str(tmp_path / "cache"), max_bytes=1024, ttl=60)
+
+    def test_lookup_materializes_hit_for_new_task(self, cache, tmp_path):
+        write_task_result("task-1", {'Home': 5})
+        assert cache.lookup("digest", "task-2") is None
+        cache.store("digest", "task-1", {"lines_processed": 3})
+
+        meta = cache.lookup("digest", "task-2")
+        assert meta["lines_processed"] == 3
+        assert meta["result_path"] == str(tmp_path / "task-2_result.csv")
+        with open(meta["result_path"], newline='') as f:
+            assert f.read() == "Department Name,Total Sales\r\nHome,5\r\n"
+        assert load_aggregate_state("task-2") == {'Home': 5}
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_hits_leave_earlier_results_untouched(self, cache, tmp_path):
+        write_task_result("task-1", {'Home': 5})
+        cache.store("digest", "task-1", {})
+        result_path = str(tmp_path / "task-1_result.csv")
+        os.utime(result_path, (1_000_000, 1_000_000))
+        meta_path = os.path.join(cache.directory, "digest.json")
+        os.utime(meta_path, (time.time() - 30,) * 2)
+        assert cache.lookup("digest", "task-2") is not None
+        assert os.stat(result_path).st_mtime == 1_000_000
+        assert time.time() - os.path.getmtime(meta_path) < 5
+
+    def test_evicts_expired_and_least_recently_used(self, cache):
+        cache.max_bytes = 10_000
+        for digest in ("old", "lru", "mru", "new"):
+            write_task_result(digest, {'x' * 300: 1})
+        for digest in ("old", "lru", "mru"):
+            cache.store(digest, digest, {})
+        os.utime(os.path.join(cache.directory, "old.json"), (0, 0))
+        os.utime(os.path.join(cache.directory, "lru.json"), (time.time() - 30,) * 2)
+        cache.max_bytes = 1600
+        cache.store("new", "new", {})
+
+        remaining = {name.split('.')[0] for name in os.listdir(cache.directory)}
+        assert remaining == {"mru", "new"}
+
+
+class TestAppendAggregation:
+    def test_delta_merged_into_base_state_matches_full_file(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(celery_module, "RESULTS_DIR", str(tmp_path))
+        csv_file = sample_csv("test_sales1.csv")
+        (base_range, delta_range) = split_line_ranges(csv_file, 2)
+        write_task_result("base", aggregate_sales(read_csv_rows(csv_file, *base_range)))
+
+        sales = aggregate_sales(read_csv_rows(csv_file, *delta_range), sales=load_aggregate_state("base"))
+        expected = aggregate_sales(read_csv_rows(csv_file))
+        assert list(sales.items()) == list(expected.items())
+
+
+class TestCompressedUploads:
+    @pytest.fixture
+    def gzip_file(self, tmp_path):
+        # Two concatenated members, as produced by ``cat a.gz b.gz``
+        with open(sample_csv("test_sales1.csv"), 'rb') as f:
+            data = f.read()
+        middle = data.index(b'\n', len(data) // 2) + 1
+        path = tmp_path / "upload.csv.gz"
+        path.write_bytes(gzip.compress(data[:middle]) + gzip.compress(data[middle:]))
+        return str(path), data
+
+    @pytest.mark.parametrize("engine", [
+        "python",
+        pytest.param("arrow", marks=pytest.mark.skipif(
+            importlib.util.find_spec("pyarrow") is None, reason="pyarrow not installed")),
+    ])
+    def test_engines_read_gzip_uploads(self, gzip_file, engine):
+        path, _ = gzip_file
+        reader = open_sales_reader(path, engine=engine)
+        sales = aggregate_reader(reader)
+        expected = aggregate_sales(read_csv_rows(sample_csv("test_sales1.csv")))
+        assert list(sales.items()) == list(expected.items())
+        assert reader.position == os.path.getsize(path)
+
+    def test_compressed_uploads_are_not_split(self, gzip_file):
+        path, _ = gzip_file
+        assert file_compression(path) == "gzip"
+        assert plan_chunks(path, 4) == 1
+
+    @pytest.mark.parametrize("chunk_size", [1, 7, 1024])
+    def test_streaming_aggregator_decompresses(self, gzip_file, chunk_size):
+        path, data = gzip_file
+        with open(path, 'rb') as f:
+            compressed = f.read()
+        aggregator = StreamingSalesAggregator()
+        for i in range(0, len(compressed), chunk_size):
+            aggregator.feed(compressed[i:i + chunk_size])
+        expected = aggregate_sales(read_csv_rows(sample_csv("test_sales1.csv")))
+        assert list(aggregator.close().items()) == list(expected.items())
+        assert aggregator.bytes_processed == len(compressed)
+
+    @pytest.mark.skipif(importlib.util.find_spec("zstandard") is None, reason="zstandard not installed")
+    def test_reads_multi_frame_zstd_uploads(self, tmp_path):
+        import zstandard
+        with open(sample_csv("test_sales2.csv"), 'rb') as f:
+            data = f.read()
+        middle = data.index(b'\n', len(data) // 2) + 1
+        path = tmp_path / "upload.csv.zst"
+        path.write_bytes(b"".join(zstandard.ZstdCompressor().compress(part) for part in (data[:middle], data[middle:])))
+        expected = aggregate_sales(read_csv_rows(sample_csv("test_sales2.csv")))
+        assert list(aggregate_sales(read_csv_rows(str(path))).items()) == list(expected.items())
+
+    def test_results_are_written_with_a_gzip_copy(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(celery_module, "RESULTS_DIR", str(tmp_path))
+        result_path = write_task_result("task", {'Home': 5})
+        with open(result_path, 'rb') as f, gzip.open(result_path + ".gz") as g:
+            assert g.read() == f.read()
+
+
+class TestAggregateStore:
+    sales = {'Toys': 5, 'Café': -3, 'Books': 2**70, 'Automotive': 0, '': 9}
+
+    @pytest.fixture
+    def store(self, tmp_path):
+        path = str(tmp_path / "aggregate.bin")
+        AggregateStore.write(path, self.sales)
+        with AggregateStore(path) as store:
+            yield store
+
+    def test_round_trips_totals_in_first_seen_order(self, store):
+        assert len(store) == len(self.sales)
+        assert list(store.items()) == list(self.sales.items())
+        assert store.to_dict()['missing'] == 0
+
+    def test_looks_up_single_departments(self, store):
+        for dept, total in self.sales.items():
+            assert store.get(dept) == total
+        assert store.get('Bookz') is None
+        assert store.get('Zzz') is None
+
+    def test_rejects_other_files(self, tmp_path):
+        path = tmp_path / "state.json"
+        path.write_bytes(b'{"departments": [], "totals": []}')
+        with pytest.raises(ValueError):
+            AggregateStore(str(path))
+
+    def test_renders_json(self, store):
+        assert render_result(store.items(), "json") == (
+            b'{"Toys": 5, "Caf\\u00e9": -3, "Books": 1180591620717411303424, "Automotive": 0, "": 9}'
+        )
+
+    @pytest.mark.skipif(importlib.util.find_spec("pyarrow") is None, reason="pyarrow not installed")
+    def test_renders_arrow(self):
+        import pyarrow.ipc
+        data = render_result([('Toys', 5), ('Home', 7)], "arrow")
+        table = pyarrow.ipc.open_stream(data).read_all()
+        assert table.to_pydict() == {'Department Name': ['Toys', 'Home'], 'Total Sales': [5, 7]}
+
+
+class TestAggregateStoreCache:
+    def test_reuses_stores_until_their_file_changes(self, tmp_path):
+        path = str(tmp_path / "aggregate.bin")
+        AggregateStore.write(path, {'Toys': 5})
+        cache = AggregateStoreCache()
+        store = cache.open(path)
+        assert cache.open(path) is store
+        AggregateStore.write(path + '.new', {'Toys': 6})
+        os.replace(path + '.new', path)
+        assert cache.open(path).get('Toys') == 6
+        assert store.get('Toys') == 5  # Still readable by whoever holds it
+        os.remove(path)
+        with pytest.raises(FileNotFoundError):
+            cache.open(path)
+        assert cache._stores == {}
+
+    def test_lets_go_of_least_recently_used_past_the_bound(self, tmp_path):
+        cache = AggregateStoreCache(max_open=2)
+        paths = [str(tmp_path / f"{name}.bin") for name in 'abc']
+        for path in paths:
+            AggregateStore.write(path, {'Toys': 1})
+        cache.open(paths[0])
+        unused = weakref.ref(cache.open(paths[1]))
+        held = cache.open(paths[0])
+        cache.open(paths[2])
+        assert list(cache._stores) == [paths[0], paths[2]]
+        assert unused() is None  # Unmapped once nobody holds it
+        assert held.get('Toys') == 1
+
+    def test_evicted_stores_stay_readable_by_concurrent_lookups(self, tmp_path):
+        cache = AggregateStoreCache(max_open=1)
+        paths = [str(tmp_path / f"{i}.bin") for i in range(4)]
+        for i, path in enumerate(paths):
+            AggregateStore.write(path, {f'Dept {n}': n + i for n in range(200)})
+
+        def look_up(worker):
+            for round_number in range(300):
+                i = (worker + round_number) % len(paths)
+                store = cache.open(paths[i])
+                assert store.get('Dept 7') == 7 + i
+                assert sum(total for _, total in store.items()) == sum(range(200)) + 200 * i
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            for future in [pool.submit(look_up, worker) for worker in range(4)]:
+                future.result()
+
+    def test_discarded_task_files_are_let_go_of(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(celery_module, "RESULTS_DIR", str(tmp_path))
+        path = celery_module.state_path_for('task')
+        AggregateStore.write(path, {'Toys': 1})
+        store = celery_module.aggregate_stores.open(path)
+        celery_module.discard_task_files('task')
+        assert path not in celery_module.aggregate_stores._stores
+        assert store.get('Toys') == 1
+        assert not os.path.exists(path)
+
+
+class TestAggregationPlan:
+    header = ['Region', 'Product', 'Units', 'Price']
+    rows = [
+        ['North', 'Tea', '3', '1.5'],
+        ['South', 'Tea', 'n/a', '2'],
+        ['North', 'Cake', '4', '2.5'],
+        ['North', 'Tea', '1', '0.5'],
+        ['short'],
+    ]
+    spec = {
+        'keys': ['Region', 1],
+        'aggregates': [
+            {'function': 'sum', 'column': 'Units'},
+            {'function': 'mean', 'column': 3},
+            {'function': 'count'},
+            {'function': 'min', 'column': 'Units'},
+            {'function': 'max', 'column': 'Price'},
+        ],
+    }
+
+    def test_groups_by_several_keys(self):
+        plan = AggregationPlan(self.spec, self.header)
+        output = io.StringIO(newline='')
+        plan.write_csv(plan.aggregate(self.rows), output)
+        assert output.getvalue().splitlines() == [
+            'Region,Product,sum(Units),mean(Price),count,min(Units),max(Price)',
+            'North,Tea,4,1.0,2,1,1.5',
+            'South,Tea,0,2.0,1,,2',
+            'North,Cake,4,2.5,1,4,2.5',
+        ]
+
+    @pytest.mark.parametrize("spec", [
+        {'keys': [], 'aggregates': [{'function': 'count'}]},
+        {'keys': ['Region'], 'aggregates': []},
+        {'keys': ['Region'], 'aggregates': [{'function': 'median', 'column': 'Units'}]},
+        {'keys': ['Region'], 'aggregates': [{'function': 'sum'}]},
+        {'keys': [-1], 'aggregates': [{'function': 'count'}]},
+    ])
+    def test_rejects_invalid_specs(self, spec):
+        with pytest.raises(ValueError):
+            normalize_spec(spec)
+
+    def test_rejects_columns_missing_from_header(self):
+        with pytest.raises(ValueError):
+            AggregationPlan({'keys': ['Store'], 'aggregates': [{'function': 'count'}]}, self.header)
+        with pytest.raises(ValueError):
+            AggregationPlan({'keys': [4], 'aggregates': [{'function': 'count'}]}, self.header)
+
+    @pytest.mark.parametrize("csv_file", [sample_csv("test_sales1.csv"), sample_csv("test_sales3.csv")])
+    def test_sum_by_name_matches_sales_aggregation(self, csv_file):
+        spec = {'keys': [0], 'aggregates': [{'function': 'sum', 'column': 'Number of Sales'}]}
+        plan = AggregationPlan(spec, ['Department Name', 'Date', 'Number of Sales'])
+        groups = plan.aggregate(read_csv_rows(csv_file))
+        expected = aggregate_sales(read_csv_rows(csv_file))
+        assert [(dept, total) for dept, total in plan.results(groups)] == list(expected.items())
+
+    def test_merged_ranges_match_serial(self):
+        csv_file = sample_csv("test_sales2.csv")
+        spec = {'keys': [1], 'aggregates': [{'function': 'mean', 'column': 2}, {'function': 'max', 'column': 2}]}
+        plan = AggregationPlan(spec, ['Department Name', 'Date', 'Number of Sales'])
+        partials = [
+            plan.aggregate(read_csv_rows(csv_file, start, end))
+            for start, end in split_line_ranges(csv_file, 4)
+        ]
+        serial = plan.aggregate(read_csv_rows(csv_file))
+        assert list(plan.merge(partials).items()) == list(serial.items())
+
+    @pytest.mark.parametrize("chunk_size", [1, 7, 1024])
+    def test_streaming_matches_file_aggregation(self, chunk_size):
+        data = ','.join(self.header) + '\n' + '\n'.join(','.join(row) for row in self.rows)
+        aggregator = StreamingSalesAggregator(self.spec)
+        for i in range(0, len(data), chunk_size):
+            aggregator.feed(data[i:i + chunk_size].encode())
+        groups = aggregator.close()
+        plan = AggregationPlan(self.spec, self.header)
+        assert groups == plan.aggregate(self.rows)
+        assert aggregator.plan.output_columns == plan.output_columns
+
+    def test_group_state_round_trips(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(celery_module, "RESULTS_DIR", str(tmp_path))
+        plan = AggregationPlan(self.spec, self.header)
+        groups = plan.aggregate(self.rows)
+        write_grouped_result("task", plan, groups)
+        loaded_plan, loaded = load_grouped_state("task")
+        assert loaded == groups
+        assert loaded_plan.output_columns == plan.output_columns
+
+
+class TestTimeBuckets:
+    rows = [
+        ['Toys', '2023-01-30', '5'],
+        ['Books', '2023-01-31', '2'],
+        ['Toys', '2023-02-01', '1'],
+        ['Toys', 'someday', '4'],
+        ['Books', '2023-02-06', 'n/a'],
+        ['Books', '2023-02-06', '3'],
+    ]
+
+    def test_sums_per_department_and_day(self):
+        sales, daily = aggregate_sales_by_day(self.rows)
+        assert dict(sales) == {'Toys': 10, 'Books': 5}
+        assert dict(daily) == {
+            '2023-01-30Toys': 5,
+            '2023-01-31Books': 2,
+            '2023-02-01Toys': 1,
+            '2023-02-06Books': 3,
+        }
+
+    @pytest.mark.parametrize("csv_file", [sample_csv("test_sales1.csv"), sample_csv("test_sales3.csv")])
+    def test_department_totals_match_sales_aggregation(self, csv_file):
+        sales, _ = aggregate_sales_by_day(read_csv_rows(csv_file))
+        assert list(sales.items()) == list(aggregate_sales(read_csv_rows(csv_file)).items())
+
+    def test_lists_departments_without_parsable_sales(self):
+        rows = [['A', '2023-01-01', 'x'], ['B', '2023-01-01', '3'], ['A', 'someday', ' ']]
+        sales, daily = aggregate_sales_by_day(rows)
+        assert list(sales.items()) == list(aggregate_sales(rows).items()) == [('A', 0), ('B', 3)]
+        assert dict(daily) == {'2023-01-01B': 3}
+
+    @pytest.mark.parametrize("granularity, expected", [
+        ("week", [('2023-01-30', 'Books', 2), ('2023-01-30', 'Toys', 6), ('2023-02-06', 'Books', 3)]),
+        ("month", [('2023-01-01', 'Books', 2), ('2023-01-01', 'Toys', 5), ('2023-02-01', 'Books', 3), ('2023-02-01', 'Toys', 1)]),
+    ])
+    def test_rolls_days_up(self, granularity, expected):
+        _, daily = aggregate_sales_by_day(self.rows)
+        assert rollup_daily(daily.items(), granularity) == expected
+
+    def test_period_totals_read_only_the_requested_days(self, tmp_path):
+        path = str(tmp_path / "daily.bin")
+        AggregateStore.write(path, aggregate_sales_by_day(self.rows)[1])
+        with AggregateStore(path) as store:
+            assert period_totals(store, "day", "2023-01-31", "2023-02-01") == [
+                ('2023-01-31', 'Books', 2),
+                ('2023-02-01', 'Toys', 1),
+            ]
+            assert period_totals(store, "month", end="2023-01-30", department='Toys') == [('2023-01-01', 'Toys', 5)]
+            with pytest.raises(ValueError):
+                period_totals(store, "year")
+
+
+class TestSpillingAggregator:
+    @pytest.fixture
+    def spiller(self, tmp_path):
+        spiller = SpillingAggregator(budget=2000, partitions=4, directory=str(tmp_path / "spill"))
+        yield spiller
+        spiller.close()
+
+    def test_unspilled_groups_are_returned_as_is(self, spiller):
+        sales = defaultdict(int, {'Toys': 1})
+        assert spiller.merged(sales) is sales
+
+    @pytest.mark.parametrize("csv_file", [sample_csv("test_sales1.csv"), sample_csv("test_sales3.csv")])
+    def test_spilled_totals_match_in_memory_sorted_by_key(self, spiller, csv_file):
+        rows = [[f'{dept} {i % 97}', day, num_sales] for i, (dept, day, num_sales) in enumerate(read_csv_rows(csv_file)) if i]
+        sales = defaultdict(int)
+        aggregate_sales(rows, progress_callback=spiller.watch(sales), progress_interval=10, sales=sales)
+        assert spiller.spilled
+        merged = list(spiller.merged(sales))
+        assert merged == sorted(aggregate_sales(rows).items())
+        assert spiller.count == len(merged)
+
+    def test_adopted_runs_merge_with_groups(self, spiller, tmp_path):
+        other = SpillingAggregator(partitions=2, directory=str(tmp_path / "spill"))
+        other.spill({'Toys': 1, 'Books': 2, 'Home': 3})
+        spiller.adopt(other.runs)
+        spiller.fold({}, [])
+        groups = {'Toys': 10, 'Zoo': 5}
+        spiller.spill(groups)
+        spiller.fold(groups, [('Books', 1), ('Attic', 4)])
+        assert list(spiller.merged(groups)) == [('Attic', 4), ('Books', 3), ('Home', 3), ('Toys', 11), ('Zoo', 5)]
+        spiller.close()
+        assert os.listdir(tmp_path / "spill") == []
+
+    def test_spilled_plan_groups_combine(self, spiller):
+        spec = {'keys': [0], 'aggregates': [{'function': 'mean', 'column': 2}, {'function': 'min', 'column': 2}]}
+        plan = AggregationPlan(spec, ['Department Name', 'Date', 'Number of Sales'])
+        spiller.combine = plan.combine
+        spiller.budget = 500
+        groups = {}
+        plan.aggregate(read_csv_rows(sample_csv("test_sales2.csv")), groups=groups, progress_callback=spiller.watch(groups), progress_interval=5)
+        expected = plan.aggregate(read_csv_rows(sample_csv("test_sales2.csv")))
+        assert spiller.spilled
+        assert list(spiller.merged(groups)) == sorted(expected.items())
+
+    def test_sorted_store_writes_in_one_pass(self, tmp_path):
+        sales = {'Toys': 5, 'Caf\u00e9': -3, 'Books': 2**70, '': 9}
+        path = str(tmp_path / "aggregate.bin")
+        AggregateStore.write_sorted(path, iter(sorted(sales.items())))
+        with AggregateStore(path) as store:
+            assert list(store.items()) == sorted(sales.items())
+            for dept, total in sales.items():
+                assert store.get(dept) == total
+            assert store.get('Bookz') is None
+
+
+class TestSketches:
+    @staticmethod
+    def skewed_rows(count=20000):
+        # Department i sells i units per row it appears in, on 1 row in i
+        return [[f'Dept {i}', '2023-01-01', str(i)] for n in range(count) for i in [n % 400 + 1] if n % i == 0 or i > 390]
+
+    def test_top_estimates_are_within_the_error_bound(self):
+        rows = self.skewed_rows()
+        sketches = SalesSketches()
+        sketches.top.capacity = 16
+        sales = aggregate_sketched(rows, sketches, block_rows=500)
+        assert sales == aggregate_sales(rows)
+        assert 0 < sketches.top.error <= sketches.top.total / 17
+        top = sketches.top.top(5)
+        for dept, estimate in top:
+            assert estimate <= sales[dept] <= estimate + sketches.top.error
+        assert [dept for dept, _ in top] == [dept for dept, _ in sorted(sales.items(), key=lambda item: -item[1])[:5]]
+
+    def test_merged_range_sketches_keep_the_bound(self):
+        rows = self.skewed_rows()
+        merged = SalesSketches()
+        for start in range(0, len(rows), 3000):
+            part = SalesSketches()
+            part.top.capacity = 16
+            aggregate_sketched(rows[start:start + 3000], part, block_rows=700)
+            merged.merge(SalesSketches.from_meta(part.to_meta()))
+        sales = aggregate_sales(rows)
+        assert merged.top.total == sum(sales.values())
+        assert merged.top.error <= merged.top.total / 17
+        for dept, estimate in merged.top.top(10):
+            assert estimate <= sales[dept] <= estimate + merged.top.error
+        assert abs(merged.distinct.estimate() - len(sales)) <= 4 * merged.distinct.relative_error * len(sales)
+
+    @pytest.mark.parametrize("count", [1000, 50000])
+    def test_distinct_count_is_close(self, count):
+        distinct = HyperLogLog()
+        distinct.add(f'Department {i}' for i in range(count))
+        distinct.add(f'Department {i}' for i in range(count // 2))
+        assert abs(distinct.estimate() - count) <= 4 * distinct.relative_error * count
+
+    @pytest.mark.parametrize("engine", ["python", "arrow"])
+    def test_range_sketches_merge_to_exact_summary_of_few_departments(self, engine):
+        if engine == "arrow":
+            pytest.importorskip("pyarrow")
+        csv_file = sample_csv("test_sales1.csv")
+        merged = SalesSketches()
+        for start, end in split_line_ranges(csv_file, 3):
+            part = SalesSketches()
+            aggregate_reader(open_sales_reader(csv_file, start, end, engine), sketches=part)
+            merged.merge(part)
+        summary = merged.summary()
+        sales = aggregate_sales(read_csv_rows(csv_file))
+        assert dict(summary["top_departments"]) == {dept: total for dept, total in sales.items() if total > 0}
+        assert summary["top_error"] == 0
+        assert summary["distinct_departments"] == len(sales)
+
+
+class TestProfiling:
+    @pytest.fixture(autouse=True)
+    def results_dir(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(celery_module, "RESULTS_DIR", str(tmp_path))
+
+    def test_disabled_profile_saves_nothing(self):
+        with profiled('task', enabled=False):
+            aggregate_sales(read_csv_rows(sample_csv("test_sales1.csv")))
+        assert not os.path.exists(profile_path_for('task'))
+
+    def test_range_profiles_combine_into_the_task_profile(self):
+        csv_file = sample_csv("test_sales1.csv")
+        calls = 0
+        for i, (start, end) in enumerate(split_line_ranges(csv_file, 2)):
+            with profiled(f'range{i}'):
+                aggregate_sales(read_csv_rows(csv_file, start, end))
+            calls += pstats.Stats(profile_path_for(f'range{i}')).total_calls
+        combine_profiles('task', [profile_path_for('range0'), profile_path_for('range1')])
+
+        assert pstats.Stats(profile_path_for('task')).total_calls == calls
+        assert not os.path.exists(profile_path_for('range0'))
+        assert b'aggregate_sales' in render_profile(profile_path_for('task'), 'text')
+
+
+class TestScheduler:
+    @pytest.fixture
+    def scheduler(self):
+        return Scheduler(['fast', 'bulk'])
+
+    def test_tenant_cap_holds_until_a_slot_is_released(self, scheduler):
+        assert scheduler.acquire('acme', 'job1', 1)
+        assert scheduler.acquire('acme', 'job1', 1)
+        assert not scheduler.acquire('acme', 'job2', 1)
+        assert scheduler.acquire('other', 'job3', 1)
+        assert scheduler.acquire('acme', 'job2', 0)
+        scheduler.release('acme', 'job1')
+        assert scheduler.acquire('acme', 'job2', 1)
+
+    def test_positions_follow_the_queue(self, scheduler, monkeypatch):
+        now = [0]
+        monkeypatch.setattr(celery_module.time, 'time', lambda: now[0])
+        for task_id in ('a', 'b', 'c', 'd'):
+            scheduler.queued('bulk', task_id)
+            now[0] += 1
+        scheduler.queued('elsewhere', 'e')
+        assert scheduler.position('d').ahead == 3
+        assert scheduler.position('d').start_seconds is None
+        assert scheduler.position('e') is None
+
+        for task_id in ('a', 'b'):
+            scheduler.started('bulk', task_id)
+            now[0] += 2
+            scheduler.finished('bulk')  # One finish every 2 seconds
+        now[0] += 1
+        position = scheduler.position('d')
+        assert (position.queue, position.ahead) == ('bulk', 1)
+        assert position.start_seconds == 2 * 2 - 1
+
+
+    def test_cancelled_tasks_leave_their_queue(self, scheduler):
+        scheduler.queued('bulk', 'a')
+        scheduler.queued('bulk', 'b')
+        scheduler.cancel(['a'])
+        assert scheduler.cancelled('a')
+        assert not scheduler.cancelled('b')
+        assert scheduler.position('a') is None
+        assert scheduler.position('b').ahead == 0
+
+    def test_batch_reads_agree_with_single_reads(self, scheduler):
+        for task_id in ('a', 'b'):
+            scheduler.queued('bulk', task_id)
+        scheduler.queued('fast', 'c')
+        scheduler.cancel(['d'])
+        positions = scheduler.positions(['b', 'c', 'x'])
+        assert sorted(positions) == ['b', 'c']
+        assert (positions['b'].queue, positions['b'].ahead) == ('bulk', 1)
+        assert (positions['c'].queue, positions['c'].ahead) == ('fast', 0)
+        assert scheduler.cancelled_among(['a', 'd', 'x']) == {'d'}
+
+
+class Aborted(Exception):
+    pass
+
+
+class FakeContext:
+    def invocation_metadata(self):
+        return ()
+
+    async def abort(self, code, details):
+        raise Aborted(code)
+
+
+class TestCancelTask:
+    @pytest.fixture
+    def service(self, monkeypatch):
+        from . import csv_processor_service as service
+        self.states = {}
+        self.cancelled = []
+        self.scheduler = Scheduler(['fast', 'bulk'])
+        monkeypatch.setattr(service, 'read_task_states', lambda ids: [self.states.get(i, ('PENDING', None)) for i in ids])
+        monkeypatch.setattr(service, 'scheduler', lambda: self.scheduler)
+        monkeypatch.setattr(service, 'cancel_task', lambda task_id, info: self.cancelled.append(task_id))
+        return service
+
+    def cancel(self, service, task_id):
+        request = service.csv_processor_pb2.CancelTaskRequest(task_id=task_id)
+        return asyncio.run(service.CsvProcessorService().CancelTask(request, FakeContext()))
+
+    def test_unknown_task_is_not_found(self, service):
+        with pytest.raises(Aborted) as raised:
+            self.cancel(service, 'nobody')
+        assert raised.value.args[0] == grpc.StatusCode.NOT_FOUND
+        assert self.cancelled == []
+
+    def test_queued_and_running_tasks_are_cancelled(self, service):
+        self.scheduler.queued('bulk', 'queued')
+        self.states['running'] = ('PENDING', {'lines_processed': 10})
+        for task_id in ('queued', 'running'):
+            assert self.cancel(service, task_id).status == 'CANCELLED'
+        assert self.cancelled == ['queued', 'running']
+
+    def test_finished_task_cannot_be_cancelled(self, service):
+        self.states['done'] = ('SUCCESS', {'result_path': 'x'})
+        with pytest.raises(Aborted) as raised:
+            self.cancel(service, 'done')
+        assert raised.value.args[0] == grpc.StatusCode.FAILED_PRECONDITION
+
+
+class TestCancelChecks:
+    class Task:
+        class request:
+            id = 'job'
+
+        def __init__(self):
+            self.writes = 0
+
+        def update_state(self, state, meta):
+            self.writes += 1
+
+    def test_checked_while_writes_are_held_back(self, monkeypatch):
+        scheduler = Scheduler(['fast', 'bulk'])
+        monkeypatch.setattr(celery_module, 'scheduler', lambda: scheduler)
+        monkeypatch.setattr(celery_module, 'CANCEL_CHECK_SECONDS', 0)
+        monkeypatch.setattr(ProgressThrottle, 'ready', lambda self, bytes_processed: False)
+        task = self.Task()
+        report_progress = make_progress_reporter(task, time.time(), {})
+        report_progress(1000, 1)
+        scheduler.cancel(['job'])
+        with pytest.raises(celery_module.TaskCancelled):
+            report_progress(2000, 1)
+        assert task.writes == 0
+
+
+class TestCachedUploads:
+    @pytest.fixture
+    def service(self, tmp_path, monkeypatch):
+        from . import csv_processor_service as service
+        tasks = sys.modules['celery_app']  # Where the service's tasks run
+        monkeypatch.setattr(tasks, 'RESULTS_DIR', str(tmp_path))
+        monkeypatch.setattr(tasks.celery_app.conf, 'result_backend', 'cache+memory://')
+        # Every thread makes its backend afresh from the conf
+        monkeypatch.setattr(tasks.celery_app, '_backend_cache', None)
+        monkeypatch.setattr(tasks.celery_app, '_local', threading.local())
+        scheduler = Scheduler(['fast', 'bulk'])
+        cache = tasks.ResultCache(directory=str(tmp_path / 'cache'), max_bytes=10**6, ttl=60)
+        for module in (tasks, service):
+            monkeypatch.setattr(module, 'scheduler', lambda: scheduler)
+            monkeypatch.setattr(module, 'result_cache', cache)
+        self.servicer = service.CsvProcessorService()
+        return service
+
+    def upload(self, service, data):
+        async def chunks():
+            yield service.csv_processor_pb2.CsvChunk(data=data)
+
+        return asyncio.run(self.servicer.ProcessCsv(chunks(), FakeContext())).task_id
+
+    def status(self, service, task_id):
+        request = service.csv_processor_pb2.GetProcessingResultRequest(task_id=task_id)
+        return asyncio.run(self.servicer.GetProcessingResult(request, FakeContext()))
+
+    def download(self, service, task_id):
+        async def collect():
+            request = service.csv_processor_pb2.DownloadResultRequest(task_id=task_id)
+            return b''.join([chunk.data async for chunk in self.servicer.DownloadResult(request, FakeContext())])
+
+        return asyncio.run(collect())
+
+    def test_identical_upload_is_served_from_the_cache(self, service):
+        data = b'Department Name,Date,Number of Sales\nHome,2023-01-01,5\nToys,2023-01-02,x\nHome,2023-01-03,2\n'
+        first = self.upload(service, data)
+        first_path = self.status(service, first).processed_csv_path
+        first_mtime = os.stat(first_path).st_mtime_ns
+        second = self.upload(service, data)
+        assert (service.result_cache.hits, service.result_cache.misses) == (1, 1)
+        status = self.status(service, second)
+        assert status.completed and status.processed_csv_path != first_path
+        assert os.path.samefile(status.processed_csv_path, first_path)  # Linked, not copied
+        expected = b'Department Name,Total Sales\r\nHome,7\r\nToys,0\r\n'
+        assert self.download(service, second) == self.download(service, first) == expected
+        assert os.stat(first_path).st_mtime_ns == first_mtime
+        assert self.upload(service, data + b'Home,2023-01-04,1\n') not in (first, second)
+        assert service.result_cache.misses == 2
+
+    def test_result_etag_survives_later_cache_hits(self, service):
+        data = b'Department Name,Date,Number of Sales\nHome,2023-01-01,5\n'
+        first = self.upload(service, data)
+        etag = self.status(service, first).result_etag
+        assert service.result_cache.misses == 1
+        time.sleep(0.01)
+        second = self.upload(service, data)
+        assert service.result_cache.hits == 1
+        assert self.status(service, first).result_etag == etag
+        assert self.status(service, second).result_etag not in ('', etag)
+
+
+class TestCancelledRanges:
+    @pytest.fixture
+    def upload(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(celery_module, "RESULTS_DIR", str(tmp_path))
+        self.scheduler = Scheduler(['fast', 'bulk'])
+        monkeypatch.setattr(celery_module, 'scheduler', lambda: self.scheduler)
+        upload = tmp_path / 'upload.csv'
+        rows = ''.join('Home,2023-01-01,%d\n' % i for i in range(3000))  # Past a progress interval
+        upload.write_text('Department Name,Date,Number of Sales\n' + rows)
+        return upload
+
+    def run_range(self, upload, task_id):
+        return celery_module.aggregate_range_task.apply((str(upload), 0, upload.stat().st_size), task_id=task_id)
+
+    def test_range_cancelled_before_it_starts_keeps_the_upload(self, upload):
+        self.scheduler.cancel(['range'])
+        assert isinstance(self.run_range(upload, 'range').result, celery_module.TaskCancelled)
+        assert upload.exists()
+
+    def test_range_cancelled_while_running_keeps_the_upload(self, upload, monkeypatch):
+        monkeypatch.setattr(celery_module, 'CANCEL_CHECK_SECONDS', 0)
+        checks = []
+        monkeypatch.setattr(self.scheduler, 'cancelled', lambda task_id: checks.append(task_id) or len(checks) > 1)
+        assert isinstance(self.run_range(upload, 'range').result, celery_module.TaskCancelled)
+        assert upload.exists()
+
+    def test_error_callback_deletes_the_upload_of_a_cancelled_job(self, upload):
+        celery_module.release_tenant_slot_task('acme', 'job', str(upload))
+        assert upload.exists()  # Failed rather than cancelled
+        self.scheduler.cancel(['job'])
+        celery_module.release_tenant_slot_task('acme', 'job', str(upload))
+        assert not upload.exists()
+
+
+class TestCheckpoints:
+    def test_reader_resumes_where_it_paused(self):
+        csv_file = sample_csv("test_sales1.csv")
+        reader = CsvRowReader(csv_file, block_size=7)
+        reader.pause = lambda position: True
+        rows, passes = [], 0
+        while True:
+            rows.extend(reader)
+            passes += 1
+            if not reader.paused:
+                break
+        assert rows == list(read_csv_rows(csv_file))
+        assert passes > 1
+
+    def test_checkpoint_is_due_by_bytes_or_time(self, tmp_path):
+        now = [0]
+        checkpoint = Checkpoint('t', sample_csv("test_sales1.csv"), every_bytes=100,
+                                every_seconds=10, directory=tmp_path, clock=lambda: now[0])
+        assert not checkpoint.due(99)
+        assert checkpoint.due(100)
+        now[0] = 10
+        assert checkpoint.due(0)
+        checkpoint.save({'position': 60, 'sales': {'Books': 3}})
+        assert not checkpoint.due(159)
+        assert checkpoint.due(160)
+
+    def test_checkpoint_only_resumes_the_same_upload(self, tmp_path):
+        checkpoint = Checkpoint('t', sample_csv("test_sales1.csv"), directory=tmp_path)
+        assert checkpoint.load() is None
+        checkpoint.save({'position': 60, 'sales': {'Books': 3}})
+        assert checkpoint.load()['sales'] == {'Books': 3}
+        assert Checkpoint('t', sample_csv("test_sales2.csv"), directory=tmp_path).load() is None
+        checkpoint.remove()
+        assert checkpoint.load() is None
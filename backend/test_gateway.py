@@ -0,0 +1,505 @@
+import asyncio
+import gzip
+
+import grpc
+import pytest
+from fastapi import Request
+from fastapi.testclient import TestClient
+
+from . import gateway
+from .channel_pool import ChannelPool
+from .gateway import (
+    ProgressBroadcaster,
+    RangeNotSatisfiable,
+    StreamedUpload,
+    UploadError,
+    accepts_gzip,
+    aggregation_spec,
+    progress_payload,
+    requested_range,
+)
+from .csv_processor_pb2 import (
+    CancelTaskResponse,
+    CsvChunk,
+    GetProcessingResultResponse,
+    GetProcessingResultsResponse,
+    ProcessCsvResponse,
+    Progress,
+    Sketches,
+    TopDepartment,
+)
+
+
+class FakeStub:
+    def __init__(self, updates):
+        self.updates = updates
+        self.calls = 0
+
+    async def WatchProgress(self, request):
+        self.calls += 1
+        while (progress := await self.updates.get()) is not None:
+            yield progress
+
+
+class TestProgressBroadcaster:
+    @pytest.fixture
+    def stub(self, monkeypatch):
+        stub = FakeStub(asyncio.Queue())
+        monkeypatch.setattr(gateway, "grpc_stub", stub)
+        return stub
+
+    async def collect(self, broadcaster, task_id):
+        return [progress.status async for progress in broadcaster.watch(task_id)]
+
+    def test_watchers_share_one_upstream_stream(self, stub):
+        async def scenario():
+            broadcaster = ProgressBroadcaster()
+            watchers = [
+                asyncio.create_task(self.collect(broadcaster, "t")) for _ in range(3)
+            ]
+            await asyncio.sleep(0)
+            await stub.updates.put(Progress(status="PENDING"))
+            await stub.updates.put(Progress(status="SUCCESS"))
+            await stub.updates.put(None)
+            return await asyncio.gather(*watchers)
+
+        results = asyncio.run(scenario())
+        assert stub.calls == 1
+        for statuses in results:
+            assert statuses[-1] == "SUCCESS"
+
+    def test_last_watcher_leaving_cancels_upstream(self, stub):
+        async def scenario():
+            broadcaster = ProgressBroadcaster()
+            stream = broadcaster.watch("t")
+            await stub.updates.put(Progress(status="PENDING"))
+            assert (await anext(stream)).status == "PENDING"
+            upstream = broadcaster._upstreams["t"]
+            await stream.aclose()
+            await asyncio.sleep(0)
+            return upstream, broadcaster
+
+        upstream, broadcaster = asyncio.run(scenario())
+        assert upstream.cancelled()
+        assert broadcaster._upstreams == {}
+
+    def test_upstream_error_is_logged_and_ends_watchers(self, monkeypatch, caplog):
+        class FailingStub:
+            async def WatchProgress(self, request):
+                raise grpc.aio.AioRpcError(
+                    grpc.StatusCode.UNAVAILABLE,
+                    grpc.aio.Metadata(),
+                    grpc.aio.Metadata(),
+                )
+                yield
+
+        monkeypatch.setattr(gateway, "grpc_stub", FailingStub())
+        statuses = asyncio.run(self.collect(ProgressBroadcaster(), "t"))
+        assert statuses == []
+        assert "WatchProgress for t ended: StatusCode.UNAVAILABLE" in caplog.text
+
+
+class TestRequestedRange:
+    @pytest.mark.parametrize(
+        "header, expected",
+        [
+            (None, None),
+            ("bytes=0-9", (0, 10)),
+            ("bytes=90-", (90, 100)),
+            ("bytes=-10", (90, 100)),
+            ("bytes=95-200", (95, 100)),
+            ("bytes=0-1,5-6", None),
+            ("items=0-9", None),
+            ("bytes=abc", None),
+        ],
+    )
+    def test_parses_single_ranges(self, header, expected):
+        assert requested_range(header, None, '"e"', 100) == expected
+
+    def test_stale_if_range_serves_whole_file(self):
+        assert requested_range("bytes=0-9", '"old"', '"new"', 100) is None
+        assert requested_range("bytes=0-9", '"new"', '"new"', 100) == (0, 10)
+
+    def test_range_past_end_is_not_satisfiable(self):
+        with pytest.raises(RangeNotSatisfiable):
+            requested_range("bytes=100-", None, '"e"', 100)
+
+
+class FakeDownloadStub:
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self.gzip_data = b""
+        self.requests = []
+
+    async def GetProcessingResult(self, request):
+        return GetProcessingResultResponse(
+            processed_csv_path=str(self.path),
+            completed=True,
+            status="SUCCESS",
+            result_size=len(self.data),
+            result_etag='"v1"',
+            gzip_result_size=len(self.gzip_data),
+        )
+
+    async def DownloadResult(self, request):
+        self.requests.append(request)
+        data = self.gzip_data if request.encoding == "gzip" else self.data
+        end = request.offset + request.length if request.length else None
+        yield CsvChunk(data=data[request.offset : end])
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        (None, False),
+        ("gzip", True),
+        ("deflate, gzip;q=0.5", True),
+        ("gzip;q=0", False),
+        ("*", True),
+        ("br", False),
+    ],
+)
+def test_accepts_gzip(header, expected):
+    assert accepts_gzip(header) is expected
+
+
+def test_aggregation_spec_refers_to_columns_by_name_or_index():
+    spec = aggregation_spec(
+        '{"keys": ["Region", 1], "aggregates": [{"function": "sum", "column": 2}, {"function": "count"}]}'
+    )
+    assert [key.WhichOneof("ref") for key in spec.keys] == ["name", "index"]
+    assert spec.aggregates[0].column.index == 2
+    assert not spec.aggregates[1].HasField("column")
+    for bad in ("{", "[]", '{"keys": [1.5]}', '{"keys": [true]}'):
+        with pytest.raises(ValueError):
+            aggregation_spec(bad)
+
+
+def test_progress_payload_includes_sketches_when_published():
+    assert "sketches" not in progress_payload(Progress(lines_processed=10), False)
+    progress = Progress(
+        sketches=Sketches(
+            top_departments=[TopDepartment(department="Books", estimate=40)],
+            top_error=2,
+            distinct_departments=7,
+            distinct_relative_error=0.016,
+        )
+    )
+    sketches = progress_payload(progress, False)["sketches"]
+    assert sketches["top_departments"] == [{"department": "Books", "estimate": 40}]
+    assert (sketches["top_error"], sketches["distinct_departments"]) == (2, 7)
+
+
+def test_progress_payload_includes_phases_once_completed():
+    assert "phases" not in progress_payload(Progress(lines_processed=10), False)
+    progress = Progress(phases={"parse": 1.5, "aggregate": 2.0})
+    assert progress_payload(progress, True)["phases"] == {
+        "parse": 1.5,
+        "aggregate": 2.0,
+    }
+    assert ("x-profile", "true") in gateway.processing_metadata(profile=True)
+
+
+def test_status_reports_the_queue_position_of_waiting_tasks(monkeypatch):
+    class QueuedStub:
+        async def GetProcessingResult(self, request):
+            return GetProcessingResultResponse(
+                status="PENDING", queue="csv_bulk", queue_position=3
+            )
+
+    monkeypatch.setattr(gateway, "grpc_stub", QueuedStub())
+    response = TestClient(gateway.app).get("/status/t")
+    assert response.json()["queue"] == {
+        "name": "csv_bulk",
+        "position": 3,
+        "estimated_start_seconds": None,
+    }
+    assert ("x-tenant", "acme") in gateway.processing_metadata(tenant="acme")
+
+
+def test_upload_returns_an_inline_result_when_csv_is_accepted(monkeypatch):
+    class InlineStub:
+        async def ProcessCsv(self, chunks, **kwargs):
+            async for _ in chunks:
+                pass
+            return ProcessCsvResponse(
+                task_id="t", status="SUCCESS", result=b"Department Name,Total Sales\r\n"
+            )
+
+    monkeypatch.setattr(gateway, "grpc_stub", InlineStub())
+    client = TestClient(gateway.app)
+    files = {"file": ("a.csv", b"x")}
+    response = client.post("/upload", files=files, headers={"Accept": "text/csv"})
+    assert response.content == b"Department Name,Total Sales\r\n"
+    assert response.headers["x-task-id"] == "t"
+    response = client.post("/upload", files=files, headers={"Accept": "*/*"})
+    assert response.json()["task_id"] == "t"
+    assert not gateway.accepts_csv("text/csv;q=0, */*")
+
+
+class TestStreamedUpload:
+    def upload(self, body, content_type, piece_size=7):
+        pieces = [body[i : i + piece_size] for i in range(0, len(body), piece_size)]
+        messages = [
+            {"type": "http.request", "body": piece, "more_body": True}
+            for piece in pieces
+        ]
+        messages.append({"type": "http.request", "body": b"", "more_body": False})
+
+        async def receive():
+            return messages.pop(0)
+
+        headers = [(b"content-type", content_type.encode())]
+        request = Request({"type": "http", "headers": headers}, receive)
+        return StreamedUpload(request, 10)
+
+    def multipart(self, *parts):
+        body = b""
+        for name, data in parts:
+            body += (
+                b'--XYZ\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                % (name, data)
+            )
+        return body + b"--XYZ--\r\n"
+
+    async def collect(self, upload):
+        return [chunk async for chunk in upload.chunks()]
+
+    def test_multipart_file_arrives_in_chunks_after_its_fields(self):
+        data = b"Department Name,Total Sales\r\n" * 3
+        upload = self.upload(
+            self.multipart((b"spec", b'{"keys": [0]}'), (b"file", data)),
+            "multipart/form-data; boundary=XYZ",
+        )
+        chunks = asyncio.run(self.collect(upload))
+        assert b"".join(chunks) == data
+        assert {len(chunk) for chunk in chunks[:-1]} == {10}
+        assert upload.fields == {"spec": '{"keys": [0]}'}
+
+    def test_raw_body_is_the_file(self):
+        upload = self.upload(b"a,b\r\n" * 5, "text/csv")
+        assert b"".join(asyncio.run(self.collect(upload))) == b"a,b\r\n" * 5
+
+    def test_fields_after_the_file_are_rejected(self):
+        upload = self.upload(
+            self.multipart((b"file", b"a,b\r\n" * 5), (b"spec", b"{}")),
+            "multipart/form-data; boundary=XYZ",
+        )
+        with pytest.raises(UploadError):
+            asyncio.run(self.collect(upload))
+        assert upload.error is not None
+
+
+def test_raw_upload_takes_its_spec_from_the_query(monkeypatch):
+    class RecordingStub:
+        async def ProcessCsv(self, chunks, **kwargs):
+            self.chunks = [chunk async for chunk in chunks]
+            return ProcessCsvResponse(task_id="t", status="PENDING")
+
+    stub = RecordingStub()
+    monkeypatch.setattr(gateway, "grpc_stub", stub)
+    monkeypatch.setattr(gateway, "UPLOAD_CHUNK_BYTES", 4)
+    response = TestClient(gateway.app).post(
+        "/upload",
+        params={"spec": '{"keys": [0]}'},
+        content=b"a,b\r\n1,2\r\n",
+        headers={"Content-Type": "text/csv"},
+    )
+    assert response.json()["task_id"] == "t"
+    assert [chunk.data for chunk in stub.chunks] == [b"a,b\r", b"\n1,2", b"\r\n"]
+    assert stub.chunks[0].spec.keys[0].index == 0
+
+
+def test_cancelling_a_task(monkeypatch):
+    class CancelStub:
+        async def CancelTask(self, request):
+            return CancelTaskResponse(status="CANCELLED")
+
+    monkeypatch.setattr(gateway, "grpc_stub", CancelStub())
+    response = TestClient(gateway.app).delete("/tasks/t")
+    assert response.status_code == 202
+    assert response.json() == {"task_id": "t", "status": "CANCELLED"}
+
+
+def test_batch_status_coalesces_identical_lookups(monkeypatch):
+    class BatchStub:
+        def __init__(self):
+            self.requests = []
+
+        async def GetProcessingResults(self, request):
+            self.requests.append(list(request.task_ids))
+            await asyncio.sleep(0.01)
+            return GetProcessingResultsResponse(
+                results=[
+                    GetProcessingResultResponse(status=task_id.upper())
+                    for task_id in request.task_ids
+                ]
+            )
+
+    stub = BatchStub()
+    monkeypatch.setattr(gateway, "grpc_stub", stub)
+    monkeypatch.setattr(gateway, "status_cache", gateway.StatusCache(60))
+
+    async def scenario():
+        return await asyncio.gather(
+            gateway.status_cache.get(["a", "b"]),
+            gateway.status_cache.get(["b", "a", "b"]),
+        )
+
+    first, second = asyncio.run(scenario())
+    assert stub.requests == [["a", "b"]]
+    assert first == second
+    response = TestClient(gateway.app).post(
+        "/status:batch", json={"task_ids": ["a", "c", "d"]}
+    )
+    assert stub.requests == [["a", "b"], ["c", "d"]]
+    statuses = response.json()["tasks"]
+    assert [statuses[task_id]["status"] for task_id in "acd"] == ["A", "C", "D"]
+
+
+def test_upload_metadata_continues_the_request_trace():
+    pytest.importorskip("opentelemetry")
+    traceparent = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+    with gateway.telemetry.span("POST /upload", carrier={"traceparent": traceparent}):
+        metadata = dict(gateway.processing_metadata(engine="python"))
+    assert metadata["traceparent"].split("-")[1] == "0af7651916cd43dd8448eb211c80319c"
+    assert "traceparent" not in dict(gateway.processing_metadata())
+
+
+def test_metrics_are_exposed():
+    pytest.importorskip("prometheus_client")
+    gateway.telemetry.observe_stage("download", 0.5, 100)
+    response = TestClient(gateway.app).get("/metrics")
+    assert response.status_code == 200
+    assert 'csv_stage_seconds_count{stage="download"}' in response.text
+
+
+class TestDownload:
+    @pytest.fixture
+    def stub(self, tmp_path, monkeypatch):
+        data = b"Department Name,Total Sales\r\n" + b"Books,1\r\n" * 100
+        path = tmp_path / "result.csv"
+        path.write_bytes(data)
+        stub = FakeDownloadStub(path, data)
+        monkeypatch.setattr(gateway, "grpc_stub", stub)
+        return stub
+
+    @pytest.mark.parametrize("from_disk", [True, False])
+    def test_serves_requested_range(self, stub, monkeypatch, from_disk):
+        monkeypatch.setattr(gateway, "SERVE_RESULTS_FROM_DISK", from_disk)
+        response = TestClient(gateway.app).get(
+            "/download/t", headers={"Range": "bytes=10-19", "If-Range": '"v1"'}
+        )
+        assert response.status_code == 206
+        assert response.content == stub.data[10:20]
+        assert response.headers["content-range"] == f"bytes 10-19/{len(stub.data)}"
+        assert response.headers["etag"] == '"v1"'
+        assert bool(stub.requests) is not from_disk
+
+    def test_remote_download_asks_only_for_the_range(self, stub, monkeypatch):
+        monkeypatch.setattr(gateway, "SERVE_RESULTS_FROM_DISK", False)
+        TestClient(gateway.app).get("/download/t", headers={"Range": "bytes=-5"})
+        (request,) = stub.requests
+        assert (request.offset, request.length) == (len(stub.data) - 5, 5)
+
+    def test_matching_etag_is_not_modified(self, stub):
+        response = TestClient(gateway.app).get(
+            "/download/t", headers={"If-None-Match": '"v1"'}
+        )
+        assert response.status_code == 304
+
+    @pytest.mark.parametrize("from_disk", [True, False])
+    def test_serves_gzip_copy_when_accepted(self, stub, monkeypatch, from_disk):
+        monkeypatch.setattr(gateway, "SERVE_RESULTS_FROM_DISK", from_disk)
+        stub.gzip_data = gzip.compress(stub.data)
+        (stub.path.parent / (stub.path.name + ".gz")).write_bytes(stub.gzip_data)
+        client = TestClient(gateway.app)
+
+        response = client.get("/download/t", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["etag"] == '"v1-gzip"'
+        assert response.content == stub.data
+
+        response = client.get("/download/t", headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in response.headers
+        assert response.content == stub.data
+
+
+class TestChannelPool:
+    def unavailable(self):
+        return grpc.aio.AioRpcError(
+            grpc.StatusCode.UNAVAILABLE, grpc.aio.Metadata(), grpc.aio.Metadata()
+        )
+
+    def run(self, scenario, policy="least_request"):
+        async def with_pool():
+            pool = ChannelPool(["a:1", "b:1", "c:1"], policy=policy)
+            await pool._refresh()
+            for pooled in pool.channels:
+                pooled.healthy = True
+            try:
+                return await scenario(pool)
+            finally:
+                await pool.close()
+
+        return asyncio.run(with_pool())
+
+    def test_least_request_picks_the_idlest_healthy_channel(self):
+        async def scenario(pool):
+            a, b, c = pool.channels
+            a.in_flight, b.in_flight, c.in_flight = 3, 1, 0
+            c.healthy = False
+            return pool.pick().address, pool.pick(avoid=["b:1"]).address
+
+        assert self.run(scenario) == ("b:1", "a:1")
+
+    def test_round_robin_takes_turns(self):
+        async def scenario(pool):
+            return [pool.pick().address for _ in range(4)]
+
+        assert self.run(scenario, "round_robin") == ["a:1", "b:1", "c:1", "a:1"]
+
+    def test_reads_are_retried_on_another_server(self):
+        error = self.unavailable()
+
+        class DownStub:
+            async def GetProcessingResult(self, request):
+                raise error
+
+            async def ProcessCsv(self, request):
+                raise error
+
+        class UpStub:
+            async def GetProcessingResult(self, request):
+                return GetProcessingResultResponse(status="SUCCESS")
+
+        async def scenario(pool):
+            a, b, c = pool.channels
+            a.stub, b.stub, c.stub = DownStub(), UpStub(), UpStub()
+            b.healthy = c.healthy = False  # So a is picked first
+            response = await pool.stub.GetProcessingResult(None)
+            assert not a.healthy
+            a.healthy = True
+            with pytest.raises(grpc.aio.AioRpcError):
+                await pool.stub.ProcessCsv(None)
+            return response
+
+        assert self.run(scenario).status == "SUCCESS"
+
+    def test_failed_resolution_keeps_the_last_addresses(self, monkeypatch, caplog):
+        answers = [["10.0.0.1:1"], OSError("no such host")]
+
+        async def resolve(host_port):
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        async def scenario():
+            pool = ChannelPool(["dns:///csv:1"])
+            monkeypatch.setattr(pool, "_resolve", resolve)
+            return await pool._addresses(), await pool._addresses()
+
+        assert asyncio.run(scenario()) == (["10.0.0.1:1"], ["10.0.0.1:1"])
+        assert "Could not resolve dns:///csv:1: no such host" in caplog.text
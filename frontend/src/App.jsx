@@ -9,6 +9,27 @@ function App() {
     setFile(e.target.files[0])
   }
 
+  const statusMap = {
+    PENDING: 'Pending',
+    STARTED: 'Processing',
+    SUCCESS: 'Completed',
+    FAILURE: 'Failed',
+    RETRY: 'Retrying'
+  }
+
+  const watchProgress = (uploadId, taskId) => {
+    const source = new EventSource(`http://localhost:8000/watch/${taskId}`)
+    source.addEventListener('progress', (event) => {
+      const data = JSON.parse(event.data)
+      const friendlyStatus = statusMap[data.status] || data.status
+      setUploads(prev => prev.map(u =>
+        u.id === uploadId ? { ...u, status: friendlyStatus, progress: data.progress } : u
+      ))
+    })
+    source.addEventListener('end', () => source.close())
+    source.onerror = () => source.close()
+  }
+
   const handleUpload = async () => {
     if (!file) return
     const uploadId = Date.now() + Math.random()
@@ -23,17 +44,13 @@ function App() {
         body: formData,
       })
       const data = await response.json()
-      const statusMap = {
-        PENDING: 'Pending',
-        STARTED: 'Processing',
-        SUCCESS: 'Completed',
-        FAILURE: 'Failed',
-        RETRY: 'Retrying'
-      }
       const friendlyStatus = statusMap[data.status] || data.status
       setUploads(prev => prev.map(upload =>
         upload.id === uploadId ? { ...upload, status: friendlyStatus, downloadUrl: data.download_url } : upload
       ))
+      if (friendlyStatus !== 'Completed' && friendlyStatus !== 'Failed') {
+        watchProgress(uploadId, data.task_id)
+      }
     } catch (error) {
       console.error('Upload failed:', error)
       setUploads(prev => prev.map(upload =>
@@ -47,13 +64,6 @@ function App() {
       const taskId = upload.downloadUrl.split('/').pop()
       const response = await fetch(`http://localhost:8000/status/${taskId}`)
       const data = await response.json()
-      const statusMap = {
-        PENDING: 'Pending',
-        STARTED: 'Processing',
-        SUCCESS: 'Completed',
-        FAILURE: 'Failed',
-        RETRY: 'Retrying'
-      }
       const friendlyStatus = statusMap[data.status] || data.status
       setUploads(prev => prev.map(u =>
         u.id === upload.id ? { ...u, status: friendlyStatus, progress: data.progress } : u
@@ -78,6 +88,7 @@ function App() {
             <th>Lines</th>
             <th>Depts</th>
             <th>Time (s)</th>
+            <th>ETA (s)</th>
             <th>Download</th>
           </tr>
         </thead>
@@ -89,6 +100,7 @@ function App() {
               <td>{upload.progress ? upload.progress.lines_processed : ''}</td>
               <td>{upload.progress ? upload.progress.departments : ''}</td>
               <td>{upload.progress ? upload.progress.time_elapsed.toFixed(2) : ''}</td>
+              <td>{upload.progress && upload.progress.eta_seconds != null ? upload.progress.eta_seconds.toFixed(0) : ''}</td>
               <td>
                 {upload.status === 'Completed' ? (
                   <button onClick={() => window.open(upload.downloadUrl, '_blank')}>📥</button>